@@ -1,5 +1,7 @@
 import os, json
-import util
+import util, stages, journal, scheduler, tracing
+
+tracing.begin_stage(__file__)
 
 ##################
 ##### PART 1 #####
@@ -11,36 +13,52 @@ all_website_entries = util.retrieve_saved_website_entries()
 ##### PART 2 #####
 ##################
 
-OUTPUT_DIR = "data"
-CACHE_DIR = "cache"
-os.makedirs(OUTPUT_DIR, exist_ok=True)
-os.makedirs(CACHE_DIR, exist_ok=True)
-
-
-for entry in all_website_entries:
-    snapshot_dir = entry["snapshot_dir"]
-    cdx_entry = entry["cdx_entry"]
+os.makedirs(util.OUTPUT_DIR, exist_ok=True)
+os.makedirs(util.CACHE_DIR, exist_ok=True)
 
-    # Check if snapshot has already been downloaded
-    html_filename = f"{cdx_entry['digest']}.html"
-    html_path = os.path.join(snapshot_dir, html_filename)
+# Remove half-written snapshots left behind by a crash, so they are downloaded again
+journal.recover_journal()
 
-    if os.path.exists(html_path):
-        print(f"  Skipping {cdx_entry['timestamp']} - already downloaded")
-        continue
+# Fetch each digest once, however many snapshots share it
+plans = stages.plan_snapshot_downloads(all_website_entries)
+print(f"Found {len(all_website_entries)} snapshots with {len(plans)} unique digests")
 
-    # Check if snapshot has already been cached
-    cache_snapshot_dir = os.path.join(CACHE_DIR, cdx_entry["digest"])
-    if util.find_and_copy_cached_snapshot(cache_snapshot_dir, snapshot_dir):
-        print(f"  Loaded from cache {cdx_entry['timestamp']}, skipping")
-        continue
-
-    print(f"  Downloading snapshot from {cdx_entry['timestamp']}")
+# Smallest payloads first, within the size cap of this run
+schedule = scheduler.plan_downloads(
+    [plan for plan in plans if stages.pending_snapshot_entries(plan)],
+    stages.snapshot_plan_bytes,
+)
+print(scheduler.describe_plan(schedule))
+track = scheduler.progress_tracker(schedule["scheduled_bytes"])
 
+totals = {"snapshots": 0, "downloaded_bytes": 0, "saved_bytes": 0}
+over_budget = []
+for number, plan in enumerate(schedule["scheduled"]):
+    # The budget is charged with the bytes actually received (see scheduler.charge)
+    if scheduler.budget_spent():
+        over_budget = schedule["scheduled"][number:]
+        print(
+            f"Byte budget spent after {scheduler.format_size(scheduler.received['bytes'])}"
+            f", {len(over_budget)} digests left"
+        )
+        break
     try:
-        snapshot = util.download_website_snapshot(cdx_entry)
-        util.save_website_snapshot(snapshot, snapshot_dir)
-        util.save_website_snapshot(snapshot, cache_snapshot_dir)
-        print(f"    Saved snapshot to {snapshot_dir}")
+        for key, value in stages.download_snapshot_group(plan).items():
+            totals[key] += value
     except Exception as e:
-        print(f"    Error downloading {cdx_entry['timestamp']}: {e}")
+        print(
+            f"    Error downloading {plan['entries'][0]['cdx_entry']['timestamp']}: {e}"
+        )
+    track(stages.snapshot_plan_bytes(plan))
+
+needed_bytes = totals["downloaded_bytes"] + totals["saved_bytes"]
+print(
+    f"Saved {totals['snapshots']} snapshots: downloaded {totals['downloaded_bytes']} bytes, "
+    f"saved {totals['saved_bytes']} bytes"
+    + (f" ({totals['saved_bytes'] / needed_bytes:.0%})" if needed_bytes else "")
+)
+if schedule["deferred"] or over_budget:
+    print(
+        "Run again to continue: raise WAYBACK_BYTE_BUDGET or WAYBACK_MAX_ITEM_BYTES "
+        "for the remaining digests"
+    )
@@ -1,110 +1,111 @@
-import os, json, csv
-import util
-from datetime import datetime
+import os, json
+import util, summary_store, search_index, advertisers, tracing
 
-OUTPUT_DIR = "data"
-CACHE_DIR = "cache"
-os.makedirs(OUTPUT_DIR, exist_ok=True)
-os.makedirs(CACHE_DIR, exist_ok=True)
+tracing.begin_stage(__file__)
+
+os.makedirs(util.OUTPUT_DIR, exist_ok=True)
+os.makedirs(util.CACHE_DIR, exist_ok=True)
 
 
 def detect_images(snapshot_dir: str):
-    """Walk through website directory and find all image files using util.image_extensions"""
+    """Walk through website directory and find all saved banner images using util.find_image_snapshot"""
     images = []
 
     # Walk through all subdirectories
     for root, dirs, files in os.walk(snapshot_dir):
-        for filename in files:
-            # Check if file has an image extension
-            if filename.endswith(tuple(util.image_extensions)):
-                file_path = os.path.join(root, filename)
-
-                # Look for associated metadata files in the same directory
-                cdx_entry_path = os.path.join(root, "cdx_entry.json")
-                image_tag_attrs_path = os.path.join(root, "image_tag_attrs.json")
-
-                # Get image metadata using util function
-                metadata = util.get_image_metadata(file_path)
-
-                # Load CDX entry and image tag attributes
-                with open(cdx_entry_path, "r") as f:
-                    cdx_entry = json.load(f)
-
-                with open(image_tag_attrs_path, "r") as f:
-                    image_tag_attrs = json.load(f)
-
-                images.append(
-                    {
-                        "path": file_path,
-                        "metadata": metadata,
-                        "cdx_entry": cdx_entry,
-                        "image_tag_attrs": image_tag_attrs,
-                    }
-                )
+        # Banner directories hold the CDX entry and the image tag attributes of their image
+        if "cdx_entry.json" not in files or "image_tag_attrs.json" not in files:
+            continue
+        cdx_entry_path = os.path.join(root, "cdx_entry.json")
+        image_tag_attrs_path = os.path.join(root, "image_tag_attrs.json")
+
+        # Load CDX entry and image tag attributes
+        with open(cdx_entry_path, "r") as f:
+            cdx_entry = json.load(f)
+        if not cdx_entry:
+            continue
+
+        # A file path, or a file object when images are stored in WARC files
+        image = util.find_image_snapshot(root, cdx_entry)
+        if image is None:
+            continue
+
+        with open(image_tag_attrs_path, "r") as f:
+            image_tag_attrs = json.load(f)
+
+        # Get image metadata using util function
+        metadata = util.get_image_metadata(image)
+
+        images.append(
+            {
+                "path": image if isinstance(image, str) else None,
+                "metadata": metadata,
+                "cdx_entry": cdx_entry,
+                "image_tag_attrs": image_tag_attrs,
+            }
+        )
 
     return images
 
 
-all_images = []
-
-for website in os.listdir(OUTPUT_DIR):
-    website_dir = os.path.join(OUTPUT_DIR, website)
-    for timestamp in os.listdir(website_dir):
-        snapshot_dir = os.path.join(website_dir, timestamp)
-        print(snapshot_dir)
-        if os.path.isdir(snapshot_dir):
-            for image in detect_images(snapshot_dir):
-
-                image_tag_height = image["image_tag_attrs"].get("height", None)
-                image_tag_width = image["image_tag_attrs"].get("width", None)
-                if image_tag_height and image_tag_width:
-                    image_tag_banner_properties = util.check_banner_properties(
-                        int(image_tag_width), int(image_tag_height)
-                    )
-
-                website_timestamp_datetime = datetime.strptime(
-                    timestamp, "%Y%m%d%H%M%S"
-                )
-                image_timestamp_datetime = datetime.strptime(
-                    image["cdx_entry"].get("timestamp", None), "%Y%m%d%H%M%S"
-                )
-
-                time_skew = (
-                    image_timestamp_datetime - website_timestamp_datetime
-                ).total_seconds()
-
-                all_images.append(
-                    {
-                        "website": website,
-                        "website_timestamp": timestamp,
-                        **image["cdx_entry"],
-                        **image["metadata"],
-                        "time_skew": time_skew,
-                        "image_tag_width": image_tag_width,
-                        "image_tag_height": image_tag_height,
-                        "image_tag_banner_iab_size": image_tag_banner_properties.get(
-                            "iab_size", None
-                        ),
-                        "image_tag_banner_jiaa_size": image_tag_banner_properties.get(
-                            "jiaa_size", None
-                        ),
-                        "image_tag_parent_href": image["image_tag_attrs"].get(
-                            "parent_href", None
-                        ),
-                        "image_tag_full_parent_href": image["image_tag_attrs"].get(
-                            "full_parent_href", None
-                        ),
-                        "image_tag_alt_text": image["image_tag_attrs"].get("alt", None),
-                    }
-                )
-
-
-with open("banner-ads-summary.csv", "w", newline="", encoding="utf-8") as f:
-    fieldnames = ["website", "website_timestamp"] + [
-        k for k in all_images[0].keys() if k not in ["website", "website_timestamp"]
-    ]
-    writer = csv.DictWriter(f, fieldnames=fieldnames)
-    writer.writeheader()
-    writer.writerows(all_images)
-
-print(f"Found {len(all_images)} images")
+def snapshot_batch(website: str, timestamp: str, images: list[dict]) -> dict:
+    """The summary rows of the images of one snapshot, as columns (see summary_store.SUMMARY_SCHEMA)
+    time_skew and the banner sizes of the image tags are derived by summary_store.write_summary
+    """
+    batch = {
+        "website": [website] * len(images),
+        "website_timestamp": [timestamp] * len(images),
+    }
+    for name in [
+        "urlkey",
+        "timestamp",
+        "original",
+        "mimetype",
+        "statuscode",
+        "digest",
+        "length",
+    ]:
+        batch[name] = [image["cdx_entry"].get(name) for image in images]
+    for name in [
+        "width",
+        "height",
+        "size",
+        "animated",
+        "frame_count",
+        "animation_duration",
+        "loop_count",
+        "iab_size",
+        "jiaa_size",
+        "corrupt",
+    ]:
+        batch[name] = [image["metadata"].get(name) for image in images]
+    for name, attr in [
+        ("image_tag_width", "width"),
+        ("image_tag_height", "height"),
+        ("image_tag_parent_href", "parent_href"),
+        ("image_tag_full_parent_href", "full_parent_href"),
+        ("image_tag_alt_text", "alt"),
+    ]:
+        batch[name] = [image["image_tag_attrs"].get(attr) for image in images]
+    return batch
+
+
+def snapshot_batches():
+    """One batch of summary rows per saved snapshot, read as the summary is written"""
+    for website in os.listdir(util.OUTPUT_DIR):
+        website_dir = os.path.join(util.OUTPUT_DIR, website)
+        # Skip files such as the journal
+        if not os.path.isdir(website_dir):
+            continue
+        for timestamp in os.listdir(website_dir):
+            snapshot_dir = os.path.join(website_dir, timestamp)
+            util.log(snapshot_dir)
+            if os.path.isdir(snapshot_dir):
+                yield snapshot_batch(website, timestamp, detect_images(snapshot_dir))
+
+
+# The search and advertiser indexes are updated as the summary is written
+num_images = summary_store.write_summary(
+    advertisers.index_batches(search_index.index_batches(snapshot_batches()))
+)
+print(f"Found {num_images} images")
@@ -1,11 +1,24 @@
 import os
-import csv
 import glob
+from html import escape
+import util
+import warc_store
+import summary_store
+import advertisers
+import tracing
 from collections import defaultdict
 from datetime import datetime
 
+tracing.begin_stage(__file__)
 
-def find_image_by_digest(digest, data_dir="data"):
+# The summary the gallery is built from; progressive-crawl.py points it at the
+# banner-ads-summary.csv written by stage 7, so the gallery grows with each pass
+SUMMARY_CSV = os.environ.get("WAYBACK_GALLERY_CSV", "banner-ads-summary-reference.csv")
+# The gallery shows every column of the summary (CSV or Parquet, see summary_store.py)
+GALLERY_COLUMNS = list(summary_store.SUMMARY_SCHEMA)
+
+
+def find_image_by_digest(digest, data_dir=util.OUTPUT_DIR):
     """
     Recursively search for an image file with the given digest name
     """
@@ -20,7 +33,23 @@ def find_image_by_digest(digest, data_dir="data"):
         if ext in image_extensions:
             return match
 
-    return None
+    return extract_image_from_warc_store(digest)
+
+
+def extract_image_from_warc_store(digest, images_dir="gallery-images"):
+    """
+    Write an image held in the WARC store (WAYBACK_STORAGE=warc) to a file the gallery can link to
+    """
+    record = warc_store.find_record(digest)
+    if record is None or "extension" not in record:
+        return None
+
+    image_path = os.path.join(images_dir, f"{digest}.{record['extension']}")
+    if not os.path.exists(image_path):
+        os.makedirs(images_dir, exist_ok=True)
+        with open(image_path, "wb") as f:
+            f.write(warc_store.read_payload(digest))
+    return image_path
 
 
 def format_timestamp(timestamp_str):
@@ -81,11 +110,11 @@ def load_banner_data():
     """
     data_by_digest = defaultdict(list)
 
-    with open("banner-ads-summary-reference.csv", "r", encoding="utf-8") as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            digest = row["digest"]
-            data_by_digest[digest].append(row)
+    for row in summary_store.read_rows(SUMMARY_CSV, GALLERY_COLUMNS):
+        # The page shows the values as written to the CSV summary
+        row = {name: summary_store.csv_text(value) for name, value in row.items()}
+        digest = row["digest"]
+        data_by_digest[digest].append(row)
 
     return data_by_digest
 
@@ -224,6 +253,21 @@ def generate_html(gallery_data):
             overflow-x: auto;
             margin: 20px 0;
         }}
+        
+        .search {{
+            text-align: center;
+            font-size: 14px;
+        }}
+        
+        .search input {{
+            width: 400px;
+            font-size: 14px;
+        }}
+        
+        .advertiser-link {{
+            color: #0066cc;
+            cursor: pointer;
+        }}
     </style>
 </head>
 <body>
@@ -233,6 +277,11 @@ def generate_html(gallery_data):
         <b>Total unique websites: {unique_website_count}</b>
     </div>
     
+    <div class="search">
+        <input type="search" id="search" placeholder="Search alt text, image URLs, links and advertisers">
+        <span id="search-count"></span>
+    </div>
+    
     <div class="table-container">
         <table class="main-table" cellpadding="0" cellspacing="0">
             <thead>
@@ -241,6 +290,7 @@ def generate_html(gallery_data):
                     <th>Occurrences</th>
                     <th>Image Metadata</th>
                     <th>Image Tag Metadata</th>
+                    <th>advertiser</th>
                     <th>Website Wayback Link</th>
                     <th>website</th>
                     <th>website_timestamp</th>
@@ -405,12 +455,34 @@ def generate_html(gallery_data):
                 else ""
             )
 
+            # The landing page behind the ad server's click-through link
+            advertiser, landing_url = advertisers.decode_click_through(full_href)
+            advertiser_cell = (
+                f'<a class="advertiser-link" data-advertiser="{escape(advertiser)}" title="{escape(landing_url)}">{escape(advertiser)}</a>'
+                if advertiser
+                else ""
+            )
+
+            # Searched by the search box, like search_index.py searches the summary
+            search_text = " ".join(
+                [
+                    row.get(name, "")
+                    for name in [
+                        "image_tag_alt_text",
+                        "original",
+                        "image_tag_full_parent_href",
+                    ]
+                ]
+                + [f"advertiser:{advertiser}" if advertiser else ""]
+            ).lower()
+
             html += f"""
-                <tr>
+                <tr data-digest="{item["digest"]}" data-search="{escape(search_text)}">
                     <td class="center">{image_element}</td>
                     <td class="center">{occurrence_cell}</td>
                     <td>{metadata_cell}</td>
                     <td>{tag_metadata_cell}</td>
+                    <td class="nowrap">{advertiser_cell}</td>
                     <td class="center">
                         {f'<a href="{wayback_url}" target="_blank" class="website-link">View Page</a>' if wayback_url else ''}
                     </td>
@@ -426,10 +498,39 @@ def generate_html(gallery_data):
                     <td class="center">{row.get('statuscode', '')}</td>
                 </tr>"""
 
-    html += """
+    html += r"""
             </tbody>
         </table>
     </div>
+    <script>
+        // Show the images with at least one occurrence matching every term of the search
+        var rows = Array.prototype.slice.call(document.querySelectorAll("tr[data-digest]"));
+        var searchInput = document.getElementById("search");
+        var searchCount = document.getElementById("search-count");
+        searchInput.addEventListener("input", function () {
+            var terms = searchInput.value.toLowerCase().split(/\s+/).filter(Boolean);
+            var matchingDigests = {};
+            rows.forEach(function (row) {
+                var text = row.getAttribute("data-search");
+                if (terms.every(function (term) { return text.indexOf(term) >= 0; })) {
+                    matchingDigests[row.getAttribute("data-digest")] = true;
+                }
+            });
+            rows.forEach(function (row) {
+                row.style.display = matchingDigests[row.getAttribute("data-digest")] ? "" : "none";
+            });
+            searchCount.textContent = terms.length
+                ? Object.keys(matchingDigests).length + " matching images"
+                : "";
+        });
+        // Clicking an advertiser shows all of its banners
+        document.querySelectorAll(".advertiser-link").forEach(function (link) {
+            link.addEventListener("click", function () {
+                searchInput.value = "advertiser:" + link.getAttribute("data-advertiser");
+                searchInput.dispatchEvent(new Event("input"));
+            });
+        });
+    </script>
 </body>
 </html>"""
 
@@ -0,0 +1,116 @@
+"""Find ad creatives referenced outside <img> tags by scanning the raw bytes of a page.
+
+Many ads of the period were written by <script>document.write(...)</script>,
+<embed>, <iframe> or inline URLs that BeautifulSoup's find_all("img") never
+sees. Stage 5 scans the original bytes of every page for the patterns listed
+in ad-patterns.txt (WAYBACK_AD_PATTERNS) without building a DOM, and saves the
+URLs around the matches that are not <img> sources to ad_candidates.json.
+Stage 6 downloads them like image tags without a size: the real size of each
+candidate is probed first, and only images of a banner size are downloaded.
+
+Set WAYBACK_AD_SCAN=off to skip the scan.
+"""
+
+import os, re, html, functools
+
+AD_SCAN = os.environ.get("WAYBACK_AD_SCAN", "on")
+AD_PATTERNS = os.environ.get("WAYBACK_AD_PATTERNS", "ad-patterns.txt")
+
+if AD_SCAN not in ("on", "off"):
+    raise ValueError(f"WAYBACK_AD_SCAN must be on or off, not {AD_SCAN}")
+
+# Bytes that cannot be part of a URL written in a page: quotes, brackets, whitespace
+# and the backslash of escaped quotes in scripts
+URL_DELIMITERS = b"\"'<>()\\ \t\r\n"
+URL_TAIL = re.compile(rb"[^\"'<>()\\\s]*")
+# How far before a match the start of its URL is looked for
+MAX_URL_LENGTH = 2048
+
+# Candidates that are neither absolute URLs nor paths must name a file of these types
+CREATIVE_EXTENSIONS = (b".gif", b".jpg", b".jpeg", b".png")
+# Candidates naming a page rather than a creative
+PAGE_SUFFIXES = (b".htm", b".html", b"/")
+
+
+@functools.lru_cache(maxsize=None)
+def load_patterns(
+    path: str = AD_PATTERNS,
+) -> tuple[tuple[bytes, ...], tuple[bytes, ...]]:
+    """The patterns of a pattern file, and its exclusions (lines starting with "!"),
+    lowercased, skipping comments and blank lines
+    """
+    patterns, exclusions = [], []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            if line.startswith("!"):
+                exclusions.append(line[1:].lower().encode("ascii"))
+            else:
+                patterns.append(line.lower().encode("ascii"))
+    return tuple(patterns), tuple(exclusions)
+
+
+def find_patterns(data: bytes, patterns: tuple[bytes, ...]) -> list[tuple[int, bytes]]:
+    """The positions of every pattern in data, in order
+    Each pattern is searched with bytes.find, which runs at memory speed, rather than
+    with one regex alternation, which Python's re tries at every offset
+    """
+    hits = []
+    for pattern in patterns:
+        position = data.find(pattern)
+        while position >= 0:
+            hits.append((position, pattern))
+            position = data.find(pattern, position + 1)
+    hits.sort()
+    return hits
+
+
+def url_around(data: bytes, start: int, end: int) -> tuple[int, int]:
+    """The bounds of the URL containing data[start:end]"""
+    window_start = max(0, start - MAX_URL_LENGTH)
+    url_start = max(
+        data.rfind(bytes([byte]), window_start, start) for byte in URL_DELIMITERS
+    )
+    url_start = window_start if url_start < 0 and window_start > 0 else url_start + 1
+    url_end = URL_TAIL.match(data, end).end()
+    return url_start, url_end
+
+
+def is_candidate_url(url: bytes, exclusions: tuple[bytes, ...]) -> bool:
+    """Whether the lowercased text around a match can be fetched as a creative"""
+    if any(exclusion in url for exclusion in exclusions):
+        return False
+    path = url.split(b"?", 1)[0]
+    if path.endswith(PAGE_SUFFIXES):
+        return False
+    if url.startswith((b"http://", b"https://", b"//", b"/")):
+        return True
+    return path.endswith(CREATIVE_EXTENSIONS) and b"=" not in path
+
+
+def scan_ad_candidates(data: bytes, patterns: tuple | None = None) -> list[dict]:
+    """Find the URLs containing an ad pattern in the raw bytes of a page
+    patterns defaults to the patterns and exclusions of AD_PATTERNS (see load_patterns)
+    Returns a list of dicts, in page order and without repeated URLs, with the following keys:
+    - src: the URL as written in the page (relative URLs are resolved by stage 6)
+    - ad_pattern: the pattern found in it
+    """
+    patterns, exclusions = patterns or load_patterns()
+    # Patterns are case-insensitive, and lowercasing keeps every byte in place
+    lowered = data.lower()
+
+    candidates = {}
+    url_end = 0
+    for start, pattern in find_patterns(lowered, patterns):
+        # Each URL is reported once, for its first pattern
+        if start < url_end:
+            continue
+        url_start, url_end = url_around(lowered, start, start + len(pattern))
+        if not is_candidate_url(lowered[url_start:url_end], exclusions):
+            continue
+        src = html.unescape(data[url_start:url_end].decode("ascii", errors="replace"))
+        if src not in candidates:
+            candidates[src] = {"src": src, "ad_pattern": pattern.decode("ascii")}
+    return list(candidates.values())
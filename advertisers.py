@@ -0,0 +1,328 @@
+"""Decode the advertiser behind each banner from its click-through link, and index banners by advertiser.
+
+Banner links rarely point at the advertiser directly: they go through the ad
+server of the website, which redirects to the landing page given in one of its
+parameters, e.g.
+
+    http://bizad.nikkeibp.co.jp/event.ng/Type=click&...&Redirect=http:%2F%2Fwww.super-h.com%2F
+    http://www.infoseek.co.jp/redirect?sv=JP&...&rd=http://www.cashnavi.com/
+    http://www.excite.co.jp/relocate/co=jp/miniad-11;http://www.ana.co.jp
+
+decode_click_through follows such links (REDIRECT_PARAMS, or any URL embedded
+in the link) down to the landing page, and the advertiser is the registered
+domain of that page. Click-through links that name no landing page (the ad
+server looks it up itself, as doubleclick's /jump/ links do) have no known
+advertiser.
+
+Stage 7 keeps advertisers.sqlite (WAYBACK_ADVERTISER_DB) in step with
+banner-ads-summary.csv, like search_index.py: rows are added as they are
+summarized, and rows no longer in the summary are removed. Set
+WAYBACK_ADVERTISER_INDEX=off to skip it.
+
+    python advertisers.py lookup super-h.com    # banners of an advertiser, and where they ran
+    python advertisers.py list                  # advertisers by number of banners
+    python advertisers.py decode "<link>"       # the landing page of a link
+    python advertisers.py rebuild               # reindex an existing summary
+"""
+
+import os, re, time, sqlite3, argparse, functools, urllib.parse
+import util, summary_store
+
+ADVERTISER_DB = os.environ.get("WAYBACK_ADVERTISER_DB", "advertisers.sqlite")
+ADVERTISER_INDEX = os.environ.get("WAYBACK_ADVERTISER_INDEX", "on")
+
+if ADVERTISER_INDEX not in ("on", "off"):
+    raise ValueError(
+        f"WAYBACK_ADVERTISER_INDEX must be on or off, not {ADVERTISER_INDEX}"
+    )
+
+# Parameters holding the landing page in the links of ad servers and redirectors
+REDIRECT_PARAMS = [
+    "redirect",
+    "rd",
+    "url",
+    "forward_url",
+    "target",
+    "dest",
+    "goto",
+    "link",
+    "location",
+]
+REDIRECT_PARAM = re.compile(
+    r"[?&;/](?:" + "|".join(REDIRECT_PARAMS) + r")=([^&]*)", re.IGNORECASE
+)
+# The start of a URL embedded in a link, URL-encoded or not
+EMBEDDED_URL = re.compile(r"https?(?::|%3a)(?://|%2f%2f)", re.IGNORECASE)
+# Path fragments of click-through links, to tell them apart from direct links
+CLICK_PATTERNS = ("event.ng", "click", "/jump/", "redirect", "relocate", "forward")
+# Redirectors are followed down to this many levels
+MAX_REDIRECTS = 5
+
+# Summary columns stored for each placement of a banner
+PLACEMENT_COLUMNS = [
+    "digest",
+    "website",
+    "website_timestamp",
+    "timestamp",
+    "original",
+    "image_tag_full_parent_href",
+]
+
+
+##################
+##### DECODE #####
+##################
+
+
+def unquote_url(value: str) -> str:
+    """Undo the URL encoding of a parameter, however many times it was applied"""
+    for _ in range(MAX_REDIRECTS):
+        unquoted = urllib.parse.unquote(value)
+        if unquoted == value:
+            break
+        value = unquoted
+    return value
+
+
+def embedded_url(url: str) -> str | None:
+    """The URL a redirector link sends to: a redirect parameter holding a URL, or else
+    the first URL embedded in the link after its own scheme
+    """
+    for match in REDIRECT_PARAM.finditer(url):
+        value = unquote_url(match.group(1)).strip()
+        if EMBEDDED_URL.match(value):
+            return value
+        if value.lower().startswith("www."):
+            return "http://" + value
+    match = EMBEDDED_URL.search(url, 1)
+    if match:
+        return unquote_url(url[match.start() :]).strip()
+    return None
+
+
+def is_click_through(url: str) -> bool:
+    parts = urllib.parse.urlsplit(url.lower())
+    return any(pattern in f"{parts.path}?{parts.query}" for pattern in CLICK_PATTERNS)
+
+
+@functools.lru_cache(maxsize=None)
+def decode_click_through(href: str) -> tuple[str, str]:
+    """The advertiser (registered domain) and landing page of a banner link
+    Returns ("", "") for links without a landing page: empty or relative links,
+    javascript: links and click-through links that do not name their destination
+    """
+    url = href.strip()
+    for _ in range(MAX_REDIRECTS):
+        target = embedded_url(url)
+        if target is None:
+            break
+        url = target
+    if url == href.strip() and is_click_through(url):
+        return "", ""
+    try:
+        parts = urllib.parse.urlsplit(url)
+    except ValueError:
+        return "", ""
+    if parts.scheme not in ("http", "https") or not parts.hostname:
+        return "", ""
+    return util.registered_domain(url), url
+
+
+####################
+##### INDEXING #####
+####################
+
+
+def get_connection(db_path: str = ADVERTISER_DB) -> sqlite3.Connection:
+    conn = sqlite3.connect(db_path, timeout=60)
+    conn.execute("PRAGMA journal_mode=WAL")
+    # One row per summary row whose link names an advertiser
+    conn.execute("""CREATE TABLE IF NOT EXISTS placements (
+            key TEXT PRIMARY KEY,
+            advertiser TEXT NOT NULL,
+            landing_url TEXT NOT NULL,
+            digest TEXT NOT NULL,
+            website TEXT NOT NULL,
+            website_timestamp TEXT NOT NULL,
+            timestamp TEXT NOT NULL,
+            original TEXT NOT NULL
+        )""")
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS placements_by_advertiser"
+        " ON placements (advertiser, digest)"
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS placements_by_digest ON placements (digest)"
+    )
+    return conn
+
+
+def index_batches(batches, db_path: str = ADVERTISER_DB):
+    """Index the placements of each batch of summary columns as it passes through to
+    the summary writer, then remove the placements that were not seen. The index
+    changes in one transaction, once every batch has been seen
+    """
+    if ADVERTISER_INDEX == "off":
+        yield from batches
+        return
+
+    conn = get_connection(db_path)
+    try:
+        conn.execute("BEGIN")
+        conn.execute("CREATE TEMP TABLE seen_placements (key TEXT PRIMARY KEY)")
+        for batch in batches:
+            index_batch(conn, batch)
+            yield batch
+        conn.execute(
+            "DELETE FROM placements WHERE key NOT IN (SELECT key FROM seen_placements)"
+        )
+        conn.commit()
+    finally:
+        conn.rollback()
+        conn.close()
+
+
+def index_batch(conn: sqlite3.Connection, batch: dict):
+    rows = zip(
+        *[
+            [summary_store.csv_text(value) for value in batch[name]]
+            for name in PLACEMENT_COLUMNS
+        ]
+    )
+    for digest, website, website_timestamp, timestamp, original, href in rows:
+        advertiser, landing_url = decode_click_through(href)
+        if not advertiser:
+            continue
+        key = "\x1f".join([digest, website, website_timestamp, timestamp, href])
+        conn.execute("INSERT OR IGNORE INTO seen_placements VALUES (?)", (key,))
+        # Replaced rather than ignored, so that reindexing picks up decoder changes
+        conn.execute(
+            "INSERT OR REPLACE INTO placements VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                key,
+                advertiser,
+                landing_url,
+                digest,
+                website,
+                website_timestamp,
+                timestamp,
+                original,
+            ),
+        )
+
+
+def rebuild(
+    summary_path: str = summary_store.SUMMARY_CSV, db_path: str = ADVERTISER_DB
+) -> int:
+    """Index an existing summary (CSV or Parquet), e.g. one written before the index existed
+    Returns the number of indexed placements
+    """
+    columns = summary_store.read_columns(summary_path, PLACEMENT_COLUMNS)
+    for batch in index_batches([columns], db_path):
+        pass
+    conn = get_connection(db_path)
+    try:
+        return conn.execute("SELECT COUNT(*) FROM placements").fetchone()[0]
+    finally:
+        conn.close()
+
+
+##################
+##### LOOKUP #####
+##################
+
+
+def lookup(advertiser: str, db_path: str = ADVERTISER_DB) -> dict:
+    """The banners of an advertiser (a domain, or any URL or host under it)
+    Returns a dict mapping each banner digest to a list of dicts, one per placement, with
+    the following keys: website, website_timestamp, timestamp, original, landing_url
+    """
+    conn = get_connection(db_path)
+    try:
+        rows = conn.execute(
+            "SELECT digest, website, website_timestamp, timestamp, original, landing_url"
+            " FROM placements WHERE advertiser = ?"
+            " ORDER BY digest, website, website_timestamp",
+            (util.registered_domain(advertiser),),
+        ).fetchall()
+    finally:
+        conn.close()
+    banners = {}
+    for digest, *placement in rows:
+        banners.setdefault(digest, []).append(
+            dict(
+                zip(
+                    [
+                        "website",
+                        "website_timestamp",
+                        "timestamp",
+                        "original",
+                        "landing_url",
+                    ],
+                    placement,
+                )
+            )
+        )
+    return banners
+
+
+def list_advertisers(limit: int = 50, db_path: str = ADVERTISER_DB) -> list[dict]:
+    """The advertisers with the most banners
+    Returns a list of dicts with the following keys:
+    - advertiser: the registered domain of the landing pages
+    - banners: the number of distinct banner images
+    - websites: the number of websites they ran on
+    - placements: the number of summary rows
+    """
+    conn = get_connection(db_path)
+    try:
+        rows = conn.execute(
+            "SELECT advertiser, COUNT(DISTINCT digest), COUNT(DISTINCT website), COUNT(*)"
+            " FROM placements GROUP BY advertiser"
+            " ORDER BY COUNT(DISTINCT digest) DESC, COUNT(*) DESC, advertiser LIMIT ?",
+            (limit,),
+        ).fetchall()
+    finally:
+        conn.close()
+    return [
+        dict(zip(["advertiser", "banners", "websites", "placements"], row))
+        for row in rows
+    ]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    lookup_parser = subparsers.add_parser("lookup", help="banners of an advertiser")
+    lookup_parser.add_argument("advertiser")
+    list_parser = subparsers.add_parser("list", help="advertisers by banners")
+    list_parser.add_argument("--limit", type=int, default=50)
+    decode_parser = subparsers.add_parser("decode", help="decode a banner link")
+    decode_parser.add_argument("href")
+    rebuild_parser = subparsers.add_parser("rebuild", help="index an existing summary")
+    rebuild_parser.add_argument("--summary", default=summary_store.SUMMARY_CSV)
+    args = parser.parse_args()
+
+    if args.command == "rebuild":
+        print(f"Indexed {rebuild(args.summary)} placements of {args.summary}")
+    elif args.command == "decode":
+        advertiser, landing_url = decode_click_through(args.href)
+        print(f"advertiser: {advertiser}\nlanding page: {landing_url}")
+    elif args.command == "list":
+        for row in list_advertisers(args.limit):
+            print(
+                f"{row['advertiser']}: {row['banners']} banners on {row['websites']}"
+                f" websites ({row['placements']} placements)"
+            )
+    else:
+        start = time.perf_counter()
+        banners = lookup(args.advertiser)
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        for digest, placements in banners.items():
+            print(f"{digest} {placements[0]['original']}")
+            for placement in placements:
+                print(
+                    f"  {placement['website']} {placement['website_timestamp']}"
+                    f" -> {placement['landing_url']}"
+                )
+        print(f"{len(banners)} banners in {elapsed_ms:.1f} ms")
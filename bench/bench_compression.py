@@ -0,0 +1,150 @@
+"""Compare the disk space and read throughput of the ways to store website snapshots.
+
+Runs on the pages saved under data/ by stage 2 (WAYBACK_STORAGE=files):
+
+    python bench/bench_compression.py
+    python bench/bench_compression.py --level 19 --dict-size 65536
+
+Every storage mode is measured on the same pages: the current layout (the
+original page and its UTF-8 copy), gzip, zstd alone, and zstd with a
+dictionary. The dictionary is trained on one half of the pages and measured on
+the other half, so that it is not measured on the pages it was trained on.
+Reading is timed from bytes to the decoded text that stages 3 and 5 parse.
+The results are stored as JSON in bench/results/.
+"""
+
+import os, sys, glob, gzip, time, random, argparse, subprocess
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+RESULTS_DIR = os.path.join(BENCH_DIR, "results")
+sys.path.insert(0, REPO_DIR)
+os.chdir(REPO_DIR)
+
+import util, zstd_store
+from run_benchmarks import timed_run
+
+
+def load_pages(data_dir: str) -> list[dict]:
+    """The original bytes, encoding and UTF-8 copy of every page saved under data_dir"""
+    pages = []
+    for html_path in glob.glob(os.path.join(data_dir, "**", "*.html"), recursive=True):
+        # Frame directories are named after their URL, which can end with .html
+        if html_path.endswith("_utf8.html") or not os.path.isfile(html_path):
+            continue
+        snapshot_dir = os.path.dirname(html_path)
+        digest = os.path.basename(html_path)[: -len(".html")]
+        utf8_html_path = os.path.join(snapshot_dir, f"{digest}_utf8.html")
+        encoding_path = os.path.join(snapshot_dir, "encoding.txt")
+        if not os.path.exists(utf8_html_path) or not os.path.exists(encoding_path):
+            continue
+        with open(html_path, "rb") as f:
+            original = f.read()
+        with open(utf8_html_path, "rb") as f:
+            utf8 = f.read()
+        with open(encoding_path, "r") as f:
+            encoding = f.read().strip()
+        pages.append({"original": original, "utf8": utf8, "encoding": encoding})
+    return pages
+
+
+def measure(name: str, stored: list[tuple[bytes, str]], read, repeat: int) -> dict:
+    """Disk space of the stored pages, and the time to read them all back as text
+    stored holds the bytes and the encoding of each page, read turns them into text
+    """
+    return {
+        "name": name,
+        "stored_bytes": sum(len(data) for data, encoding in stored),
+        "read_seconds": timed_run(
+            lambda: [read(data, encoding) for data, encoding in stored], repeat
+        ),
+    }
+
+
+def bench_compression(pages: list[dict], level: int, dict_size: int, repeat: int):
+    import zstandard
+
+    random.shuffle(pages)
+    training, test = pages[: len(pages) // 2], pages[len(pages) // 2 :]
+    dictionary = zstandard.train_dictionary(
+        dict_size, [page["original"] for page in training]
+    )
+
+    # Current layout: both files are stored, and stages 3 and 5 read the UTF-8 copy
+    current_bytes = sum(len(page["original"]) + len(page["utf8"]) for page in test)
+    result = measure(
+        "files",
+        [(page["utf8"], "utf-8") for page in test],
+        lambda data, encoding: data.decode(encoding),
+        repeat,
+    )
+    result["stored_bytes"] = current_bytes
+    results = [result]
+
+    candidates = [
+        ("original only", lambda data: data, lambda data: data),
+        ("gzip -6", lambda data: gzip.compress(data, 6), gzip.decompress),
+        (
+            f"zstd -{level}",
+            zstandard.ZstdCompressor(level=level).compress,
+            zstandard.ZstdDecompressor().decompress,
+        ),
+        (
+            f"zstd -{level} + {dict_size // 1024} KB dictionary",
+            zstandard.ZstdCompressor(level=level, dict_data=dictionary).compress,
+            zstandard.ZstdDecompressor(dict_data=dictionary).decompress,
+        ),
+    ]
+    for name, compress, decompress in candidates:
+        stored = [(compress(page["original"]), page["encoding"]) for page in test]
+        read = lambda data, encoding: decompress(data).decode(
+            encoding, errors="replace"
+        )
+        results.append(measure(name, stored, read, repeat))
+
+    original_bytes = sum(len(page["original"]) for page in test)
+    for result in results:
+        result["ratio"] = result["stored_bytes"] / current_bytes
+        result["read_mb_per_second"] = original_bytes / 1024**2 / result["read_seconds"]
+    return {
+        "pages": len(test),
+        "training_pages": len(training),
+        "original_bytes": original_bytes,
+        "results": results,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--data-dir", default=util.OUTPUT_DIR)
+    parser.add_argument("--level", type=int, default=zstd_store.LEVEL)
+    parser.add_argument("--dict-size", type=int, default=zstd_store.DICT_SIZE)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    pages = load_pages(args.data_dir)
+    if len(pages) < 2:
+        raise SystemExit(f"Not enough pages under {args.data_dir}, run stage 2 first")
+    print(f"Benchmarking {len(pages)} pages...")
+    results = bench_compression(pages, args.level, args.dict_size, args.repeat)
+
+    print(f"{'storage':40} {'bytes':>12} {'of files':>9} {'read MB/s':>10}")
+    for result in results["results"]:
+        print(
+            f"{result['name']:40} {result['stored_bytes']:12} "
+            f"{result['ratio']:9.1%} {result['read_mb_per_second']:10.1f}"
+        )
+
+    commit = subprocess.run(
+        ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True
+    ).stdout.strip()
+    results.update(
+        {"time": time.strftime("%Y-%m-%dT%H:%M:%S"), "commit": commit, **vars(args)}
+    )
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    results_path = os.path.join(
+        RESULTS_DIR,
+        f"compression-{time.strftime('%Y%m%d-%H%M%S')}-{commit or 'nogit'}.json",
+    )
+    util.atomic_write_json(results_path, results, indent=2)
+    print(f"Saved results to {results_path}")
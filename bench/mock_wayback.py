@@ -0,0 +1,266 @@
+"""Local stand-in for the Wayback Machine, serving the data/ and cache/ trees.
+
+Serves the CDX API (/cdx/search/cdx) and the id_/im_ replay endpoints
+(/web/<timestamp>id_/<url>) from the CDX entries and payloads that earlier
+runs saved, with optional latency and error injection. Point the scraper at
+it with WAYBACK_BASE_URL:
+
+    python bench/mock_wayback.py --port 8765 --latency 0.05
+    WAYBACK_BASE_URL=http://127.0.0.1:8765 python 2-download-snapshot.py
+"""
+
+import os, sys, json, time, random, re, argparse, threading
+import urllib.parse
+from collections import defaultdict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import util
+
+DIGEST_PATTERN = re.compile(r"^[A-Z2-7]{32}$")
+REPLAY_PATTERN = re.compile(r"^/web/(\d{1,14})(id_|im_)/(.+)$")
+
+
+def load_fixtures(data_dir: str = "data", cache_dir: str = "cache") -> dict:
+    """Collect the CDX entries and payload files saved by earlier runs
+    Returns a dict with the following keys:
+    - entries: {urlkey: [cdx_entry, ...]} sorted by timestamp
+    - payloads: {digest: path of the raw payload file}
+    """
+    entries = defaultdict(dict)
+    payloads = {}
+    for tree in [data_dir, cache_dir]:
+        for root, dirs, files in os.walk(tree):
+            for filename in files:
+                name, extension = os.path.splitext(filename)
+                if DIGEST_PATTERN.match(name):
+                    payloads.setdefault(name, os.path.join(root, filename))
+            if "cdx_entry.json" in files:
+                with open(os.path.join(root, "cdx_entry.json"), "r") as f:
+                    cdx_entry = json.load(f)
+                if cdx_entry:
+                    key = (cdx_entry["timestamp"], cdx_entry["digest"])
+                    entries[cdx_entry["urlkey"]][key] = cdx_entry
+
+    return {
+        "entries": {
+            urlkey: [by_key[key] for key in sorted(by_key)]
+            for urlkey, by_key in entries.items()
+        },
+        "payloads": payloads,
+    }
+
+
+def closest_entry(cdx_entries: list[dict], timestamp: str) -> dict | None:
+    """The CDX entry closest in time to a (possibly partial) timestamp"""
+    target = int(timestamp.ljust(14, "0"))
+    return min(
+        cdx_entries,
+        key=lambda cdx_entry: abs(int(cdx_entry["timestamp"]) - target),
+        default=None,
+    )
+
+
+def matching_entries(entries: dict, url: str, match_type: str) -> list[dict]:
+    """The CDX entries of a URL for matchType exact, prefix or domain, sorted like the CDX API"""
+    urlkey = util.surt_urlkey(url)
+    if match_type == "exact":
+        return entries.get(urlkey, [])
+    if match_type == "domain":
+        host_key = urlkey.split(")", 1)[0]
+        matches = lambda key: key.startswith((host_key + ")", host_key + ","))
+    else:
+        matches = lambda key: key.startswith(urlkey.rstrip("/"))
+    return [
+        cdx_entry
+        for key in sorted(entries)
+        if matches(key)
+        for cdx_entry in entries[key]
+    ]
+
+
+def apply_filter(cdx_entries: list[dict], cdx_filter: str) -> list[dict]:
+    """Apply a filter parameter such as urlkey:^jp,co,.*$ or !statuscode:200"""
+    negate = cdx_filter.startswith("!")
+    field, _, pattern = cdx_filter.lstrip("!").partition(":")
+    regex = re.compile(pattern)
+    return [
+        cdx_entry
+        for cdx_entry in cdx_entries
+        if bool(regex.fullmatch(cdx_entry[field])) != negate
+    ]
+
+
+def apply_collapse(cdx_entries: list[dict], collapse: str) -> list[dict]:
+    """Apply a collapse parameter such as timestamp:10: keep the first of adjacent entries sharing the field prefix"""
+    field, _, length = collapse.partition(":")
+    length = int(length) if length else None
+    collapsed = []
+    previous = None
+    for cdx_entry in cdx_entries:
+        value = cdx_entry[field][:length]
+        if value != previous:
+            collapsed.append(cdx_entry)
+        previous = value
+    return collapsed
+
+
+class MockWaybackHandler(BaseHTTPRequestHandler):
+    fixtures = {"entries": {}, "payloads": {}}
+    latency = 0.0
+    error_rate = 0.0
+    rng = random.Random(0)
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, status: int, body: bytes, content_type: str = "text/plain"):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.latency:
+            time.sleep(self.latency * self.rng.uniform(0.5, 1.5))
+        if self.error_rate and self.rng.random() < self.error_rate:
+            self.send_body(503, b"Service Unavailable (injected)")
+            return
+
+        if self.path.startswith("/cdx/search/cdx?"):
+            self.handle_cdx(self.path.split("?", 1)[1])
+            return
+
+        match = REPLAY_PATTERN.match(self.path)
+        if match:
+            self.handle_replay(*match.groups())
+            return
+
+        self.send_body(404, b"Not Found")
+
+    def handle_cdx(self, query_string: str):
+        # Like the real API, everything after url= up to the next & is the URL
+        params = dict(urllib.parse.parse_qsl(query_string, keep_blank_values=True))
+        cdx_entries = matching_entries(
+            self.fixtures["entries"],
+            params.get("url", ""),
+            params.get("matchType", "exact"),
+        )
+        if "filter" in params:
+            cdx_entries = apply_filter(cdx_entries, params["filter"])
+
+        if params.get("sort") == "closest":
+            cdx_entries = [closest_entry(cdx_entries, params.get("closest", ""))]
+            cdx_entries = [cdx_entry for cdx_entry in cdx_entries if cdx_entry]
+        else:
+            from_time = params.get("from", "").ljust(14, "0")
+            to_time = params.get("to", "").ljust(14, "9")
+            cdx_entries = [
+                cdx_entry
+                for cdx_entry in cdx_entries
+                if from_time <= cdx_entry["timestamp"] <= to_time
+            ]
+
+        if "collapse" in params:
+            cdx_entries = apply_collapse(cdx_entries, params["collapse"])
+        # Resume keys are opaque to clients: here, the offset of the next capture
+        offset = int(params.get("resumeKey") or 0)
+        cdx_entries = cdx_entries[offset:]
+        resume_key = None
+        if "limit" in params:
+            limit = int(params["limit"])
+            if len(cdx_entries) > limit and params.get("showResumeKey") == "true":
+                resume_key = str(offset + limit)
+            cdx_entries = cdx_entries[:limit]
+
+        body = "".join(
+            util.format_wm_cdx_line(cdx_entry) + "\n" for cdx_entry in cdx_entries
+        )
+        if resume_key:
+            body += f"\n{resume_key}\n"
+        self.send_body(200, body.encode("utf-8"))
+
+    def handle_replay(self, timestamp: str, flag: str, url: str):
+        cdx_entries = [
+            cdx_entry
+            for cdx_entry in self.fixtures["entries"].get(util.surt_urlkey(url), [])
+            if cdx_entry["digest"] in self.fixtures["payloads"]
+        ]
+        cdx_entry = closest_entry(cdx_entries, timestamp)
+        if cdx_entry is None:
+            self.send_body(404, b"Not Found")
+            return
+
+        with open(self.fixtures["payloads"][cdx_entry["digest"]], "rb") as f:
+            body = f.read()
+
+        # Single byte ranges, as sent by util.probe_image_dimensions
+        range_match = re.match(r"^bytes=(\d+)-(\d*)$", self.headers.get("Range", ""))
+        if range_match and int(range_match.group(1)) < len(body):
+            start = int(range_match.group(1))
+            end = min(int(range_match.group(2) or len(body) - 1), len(body) - 1)
+            self.send_response(206)
+            self.send_header("Content-Type", cdx_entry["mimetype"])
+            self.send_header("Content-Range", f"bytes {start}-{end}/{len(body)}")
+            self.send_header("Content-Length", str(end - start + 1))
+            self.end_headers()
+            self.wfile.write(body[start : end + 1])
+            return
+        self.send_body(200, body, cdx_entry["mimetype"])
+
+
+def start_mock_server(
+    fixtures: dict,
+    port: int = 0,
+    latency: float = 0.0,
+    error_rate: float = 0.0,
+    seed: int = 0,
+) -> tuple[ThreadingHTTPServer, str]:
+    """Start the mock server in a background thread
+    Returns the server (call server.shutdown() to stop it) and its base URL
+    """
+    handler = type(
+        "ConfiguredMockWaybackHandler",
+        (MockWaybackHandler,),
+        {
+            "fixtures": fixtures,
+            "latency": latency,
+            "error_rate": error_rate,
+            "rng": random.Random(seed),
+        },
+    )
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Local stand-in for the Wayback Machine"
+    )
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--data-dir", default="data")
+    parser.add_argument("--cache-dir", default="cache")
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="mean seconds per request"
+    )
+    parser.add_argument(
+        "--error-rate", type=float, default=0.0, help="share of 503 responses"
+    )
+    args = parser.parse_args()
+
+    fixtures = load_fixtures(args.data_dir, args.cache_dir)
+    print(
+        f"Loaded {sum(map(len, fixtures['entries'].values()))} CDX entries "
+        f"and {len(fixtures['payloads'])} payloads"
+    )
+    server, base_url = start_mock_server(
+        fixtures, args.port, args.latency, args.error_rate
+    )
+    print(f"Serving on {base_url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,249 @@
+"""Benchmark the scraper against the local mock Wayback server.
+
+Times the hot functions on their own and stages 1-8 end to end (in a
+temporary working directory, against bench/mock_wayback.py), then stores the
+results as JSON in bench/results/ so that runs can be compared:
+
+    python bench/run_benchmarks.py --latency 0.02
+    python bench/run_benchmarks.py --compare bench/results/<earlier run>.json
+"""
+
+import os, sys, json, time, shutil, argparse, platform, subprocess, tempfile
+import importlib.util
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+RESULTS_DIR = os.path.join(BENCH_DIR, "results")
+sys.path.insert(0, REPO_DIR)
+os.chdir(REPO_DIR)
+
+import util
+import ad_scanner
+import mock_wayback
+
+STAGE_SCRIPTS = [
+    "1-query-cdx.py",
+    "2-download-snapshot.py",
+    "3-detect-frame-tags.py",
+    "4-download-frames.py",
+    "5-detect-image-tags.py",
+    "6-download-banner-ads.py",
+    "7-summarize-banner-ads.py",
+    "8-generate-gallery.py",
+]
+
+# Inputs that the stages read from their working directory
+STAGE_INPUTS = [
+    "nikkeibp-may2000.csv",
+    "banner-ads-summary-reference.csv",
+    "ad-patterns.txt",
+]
+
+
+def timed_run(fn, repeat: int) -> float:
+    """Best wall-clock time of repeat calls, in seconds"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def result(seconds: float, items: int) -> dict:
+    return {
+        "seconds": seconds,
+        "items": items,
+        "us_per_item": seconds / items * 1e6 if items else None,
+    }
+
+
+def load_gallery_module():
+    spec = importlib.util.spec_from_file_location(
+        "generate_gallery", os.path.join(REPO_DIR, "8-generate-gallery.py")
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def bench_functions(fixtures: dict, repeat: int) -> dict:
+    """Time the hot functions on the fixtures"""
+    from bs4 import BeautifulSoup
+
+    results = {}
+
+    cdx_entries = [
+        cdx_entry
+        for cdx_entries in fixtures["entries"].values()
+        for cdx_entry in cdx_entries
+    ]
+    cdx_lines = [util.format_wm_cdx_line(cdx_entry) for cdx_entry in cdx_entries]
+    # Scale up to a large domain-sized response
+    response_str = "\n".join(cdx_lines * max(1, 100_000 // len(cdx_lines)))
+    results["parse_wm_cdx_api_response_str"] = result(
+        timed_run(lambda: util.parse_wm_cdx_api_response_str(response_str), repeat),
+        response_str.count("\n") + 1,
+    )
+
+    html_documents = []
+    for root, dirs, files in os.walk(util.OUTPUT_DIR):
+        for filename in files:
+            if filename.endswith("_utf8.html"):
+                with open(os.path.join(root, filename), "r", encoding="utf-8") as f:
+                    html_documents.append(f.read())
+    results["beautifulsoup_parse"] = result(
+        timed_run(
+            lambda: [BeautifulSoup(html, "html.parser") for html in html_documents],
+            repeat,
+        ),
+        len(html_documents),
+    )
+
+    # The scanner reads the original bytes, which BeautifulSoup never parses
+    raw_documents = []
+    for root, dirs, files in os.walk(util.OUTPUT_DIR):
+        for filename in files:
+            if filename.endswith(".html") and not filename.endswith("_utf8.html"):
+                with open(os.path.join(root, filename), "rb") as f:
+                    raw_documents.append(f.read())
+    results["scan_ad_candidates"] = result(
+        timed_run(
+            lambda: [ad_scanner.scan_ad_candidates(data) for data in raw_documents],
+            repeat,
+        ),
+        len(raw_documents),
+    )
+
+    parent_cdx_entry = {"original": "http://www.example.co.jp/"}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+
+        def detect_all():
+            # The soup is modified in place, so parse it again outside of the timing
+            for soup in [BeautifulSoup(html, "html.parser") for html in html_documents]:
+                start = time.perf_counter()
+                util.detect_and_save_image_tag_attrs(soup, tmp_dir, parent_cdx_entry)
+                timings.append(time.perf_counter() - start)
+
+        best = float("inf")
+        for _ in range(repeat):
+            timings = []
+            detect_all()
+            best = min(best, sum(timings))
+        results["detect_and_save_image_tag_attrs"] = result(best, len(html_documents))
+
+    image_paths = [
+        path
+        for path in fixtures["payloads"].values()
+        if path.endswith(tuple(util.image_extensions))
+    ]
+    results["get_image_metadata"] = result(
+        timed_run(
+            lambda: [util.get_image_metadata(path) for path in image_paths], repeat
+        ),
+        len(image_paths),
+    )
+
+    gallery = load_gallery_module()
+    gallery_data = [
+        {
+            "digest": digest,
+            "image_path": gallery.find_image_by_digest(digest),
+            "rows": rows,
+            "count": len(rows),
+        }
+        for digest, rows in gallery.load_banner_data().items()
+    ]
+    results["generate_html"] = result(
+        timed_run(lambda: gallery.generate_html(gallery_data), repeat),
+        sum(item["count"] for item in gallery_data),
+    )
+
+    return results
+
+
+def bench_stages(base_url: str) -> dict:
+    """Run stages 1-8 end to end in a temporary working directory"""
+    results = {}
+    with tempfile.TemporaryDirectory() as work_dir:
+        for filename in STAGE_INPUTS:
+            shutil.copy(os.path.join(REPO_DIR, filename), work_dir)
+        env = {**os.environ, "WAYBACK_BASE_URL": base_url, "WAYBACK_QUIET": "1"}
+
+        for script in STAGE_SCRIPTS:
+            start = time.perf_counter()
+            completed = subprocess.run(
+                [sys.executable, os.path.join(REPO_DIR, script)],
+                cwd=work_dir,
+                env=env,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.PIPE,
+                text=True,
+            )
+            seconds = time.perf_counter() - start
+            results[script] = {"seconds": seconds, "returncode": completed.returncode}
+            print(f"  {script}: {seconds:.2f}s")
+            if completed.returncode != 0:
+                print(completed.stderr[-2000:])
+    return results
+
+
+def compare(previous: dict, current: dict):
+    """Print the change of every timing between two result files"""
+    for section in ["functions", "stages"]:
+        for name, timing in current.get(section, {}).items():
+            before = previous.get(section, {}).get(name)
+            if not before or not before["seconds"]:
+                continue
+            change = timing["seconds"] / before["seconds"] - 1
+            print(
+                f"{name:40} {before['seconds']:9.4f}s -> {timing['seconds']:9.4f}s ({change:+.1%})"
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--skip-stages", action="store_true")
+    parser.add_argument("--skip-functions", action="store_true")
+    parser.add_argument("--compare", help="earlier result file to compare with")
+    args = parser.parse_args()
+
+    fixtures = mock_wayback.load_fixtures(util.OUTPUT_DIR, util.CACHE_DIR)
+    commit = subprocess.run(
+        ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True
+    ).stdout.strip()
+    results = {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "commit": commit,
+        "python": platform.python_version(),
+        "config": vars(args),
+    }
+
+    if not args.skip_functions:
+        print("Timing functions...")
+        results["functions"] = bench_functions(fixtures, args.repeat)
+        for name, timing in results["functions"].items():
+            print(f"  {name}: {timing['seconds']:.4f}s for {timing['items']} items")
+
+    if not args.skip_stages:
+        print("Timing stages 1-8 against the mock server...")
+        server, base_url = mock_wayback.start_mock_server(
+            fixtures, latency=args.latency, error_rate=args.error_rate
+        )
+        results["stages"] = bench_stages(base_url)
+        server.shutdown()
+
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    results_path = os.path.join(
+        RESULTS_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}-{commit or 'nogit'}.json"
+    )
+    util.atomic_write_json(results_path, results, indent=2)
+    print(f"Saved results to {results_path}")
+
+    if args.compare:
+        with open(args.compare, "r") as f:
+            compare(json.load(f), results)
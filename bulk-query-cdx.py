@@ -0,0 +1,77 @@
+"""Query the CDX API for large seed lists, one query per domain instead of one per website.
+
+    python bulk-query-cdx.py --from 2000 --to 2001 --concurrency 8
+    python bulk-query-cdx.py --collapse timestamp:10 --listing listings/seeds.cdx
+
+Seeds are grouped by registered domain (e.g. yahoo.co.jp and
+search.yahoo.co.jp), and each group is fetched with a single matchType=domain
+query whose urlkey filter and optional collapse are applied by the server,
+and paged with resume keys until the server has returned every capture.
+The queries run concurrently, and each result is written to the data/ folder
+layout of stage 1 as soon as it arrives, so stage 2 can follow as usual.
+"""
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import util, stages, journal
+
+parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+parser.add_argument("--seed-csv", default="nikkeibp-may2000.csv")
+parser.add_argument(
+    "--categories", nargs="+", default=stages.CATEGORY_OF_INTEREST, metavar="CATEGORY"
+)
+parser.add_argument(
+    "--from",
+    dest="from_time",
+    default=util.DEFAULT_FROM_TIME,
+    help="e.g. 2000 or 20000501",
+)
+parser.add_argument("--to", dest="to_time", default=util.DEFAULT_TO_TIME)
+parser.add_argument(
+    "--collapse", help="keep one capture per field prefix, e.g. timestamp:10 (hourly)"
+)
+parser.add_argument("--concurrency", type=int, default=4)
+parser.add_argument(
+    "--listing", help="also append the CDX lines to this file (see cdxj_index.py)"
+)
+args = parser.parse_args()
+
+websites = stages.read_seed_websites(args.seed_csv, args.categories)
+groups = stages.group_websites_by_domain(websites)
+print(f"Found {len(websites)} websites in {len(groups)} domain queries")
+
+# Remove the folders of a website whose query was interrupted by a crash
+journal.recover_journal()
+
+listing_file = open(args.listing, "a", encoding="utf-8") if args.listing else None
+num_entries = 0
+with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+    futures = {
+        executor.submit(
+            stages.query_domain,
+            domain,
+            domain_websites,
+            args.from_time,
+            args.to_time,
+            args.collapse,
+        ): domain
+        for domain, domain_websites in groups
+    }
+    for future in as_completed(futures):
+        try:
+            cdx_entries_by_website = future.result()
+        except Exception as e:
+            print(f"Error querying {futures[future]}: {e}")
+            continue
+        for website, cdx_entries in cdx_entries_by_website.items():
+            stages.save_website_entries(website, cdx_entries)
+            num_entries += len(cdx_entries)
+            if listing_file:
+                listing_file.writelines(
+                    util.format_wm_cdx_line(cdx_entry) + "\n"
+                    for cdx_entry in cdx_entries
+                )
+
+if listing_file:
+    listing_file.close()
+print(f"Saved {num_entries} CDX entries")
@@ -0,0 +1,313 @@
+"""Cap the size of cache/ by evicting the least recently (or least often) used digests.
+
+Set WAYBACK_CACHE_MAX_BYTES (e.g. 20GB) to turn the cache manager on. Every
+cache lookup (util.find_and_copy_cached_snapshot) and every save into the
+cache (util.save_website_snapshot, util.save_image_snapshot) updates the
+recency and frequency of its digest in a SQLite index (WAYBACK_CACHE_DB, by
+default cache-index.sqlite). Once the cache grows past its cap, a background
+thread evicts digests until it is back under 90% of the cap:
+
+- WAYBACK_CACHE_POLICY=lru (default) evicts the least recently used digests first
+- WAYBACK_CACHE_POLICY=lfu evicts the least often used digests first
+
+Digests referenced by the summary CSV (WAYBACK_CACHE_PIN_CSV, by default
+banner-ads-summary.csv) are pinned and never evicted, and neither are
+digests used in the last minute, which may still be being copied.
+
+    python cache_manager.py stats                 # size, hit ratio and evictions
+    python cache_manager.py evict --max-bytes 5GB # evict now, e.g. from cron
+"""
+
+import os, time, atexit, shutil, sqlite3, argparse, threading
+import util, metrics, scheduler, summary_store
+
+CACHE_MAX_BYTES = scheduler.parse_size(os.environ.get("WAYBACK_CACHE_MAX_BYTES"))
+CACHE_POLICY = os.environ.get("WAYBACK_CACHE_POLICY", "lru")
+CACHE_DB = os.environ.get("WAYBACK_CACHE_DB", "cache-index.sqlite")
+PIN_CSV = os.environ.get("WAYBACK_CACHE_PIN_CSV", "banner-ads-summary.csv")
+
+if CACHE_POLICY not in ("lru", "lfu"):
+    raise ValueError(f"WAYBACK_CACHE_POLICY must be lru or lfu, not {CACHE_POLICY}")
+
+# Evict down to this fraction of the cap, so that eviction does not run after every save
+LOW_WATERMARK = 0.9
+# Digests used this recently are not evicted, as a stage may still be copying them
+GRACE_SECONDS = 60
+
+ORDER_BY = {
+    "lru": "last_access",
+    "lfu": "access_count, last_access",
+}
+
+# One connection per thread, as sqlite3 connections cannot be shared between threads
+local = threading.local()
+evictor_lock = threading.Lock()
+# Evictions of the background thread and of the exit handler do not overlap
+eviction_lock = threading.Lock()
+wake_evictor = threading.Event()
+evictor_started = False
+
+
+def get_connection(db_path: str = CACHE_DB) -> sqlite3.Connection:
+    conn = getattr(local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(db_path, timeout=60)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("""CREATE TABLE IF NOT EXISTS entries (
+                digest TEXT PRIMARY KEY,
+                path TEXT NOT NULL,
+                bytes INTEGER NOT NULL,
+                last_access REAL NOT NULL,
+                access_count INTEGER NOT NULL
+            )""")
+        conn.execute("""CREATE TABLE IF NOT EXISTS stats (
+                name TEXT PRIMARY KEY,
+                value INTEGER NOT NULL
+            )""")
+        local.conn = conn
+    return conn
+
+
+def is_cache_dir(path: str) -> bool:
+    cache_root = os.path.abspath(util.CACHE_DIR) + os.sep
+    return os.path.abspath(path).startswith(cache_root)
+
+
+def dir_size(path: str) -> int:
+    num_bytes = 0
+    for root, dirs, files in os.walk(path):
+        for filename in files:
+            try:
+                num_bytes += os.path.getsize(os.path.join(root, filename))
+            except FileNotFoundError:
+                continue
+    return num_bytes
+
+
+def add_stat(conn: sqlite3.Connection, name: str, value: int = 1):
+    conn.execute(
+        "INSERT INTO stats VALUES (?, ?) ON CONFLICT (name) DO UPDATE SET value = value + ?",
+        (name, value, value),
+    )
+
+
+##################
+##### ACCESS #####
+##################
+
+
+def record_lookup(cache_dir: str, hit: bool):
+    """Count a cache lookup, make a hit the most recent use of its digest, and wake the evictor"""
+    if CACHE_MAX_BYTES is None:
+        return
+    conn = get_connection()
+    with conn:
+        add_stat(conn, "hits" if hit else "misses")
+        if hit:
+            conn.execute(
+                "UPDATE entries SET last_access = ?, access_count = access_count + 1 WHERE digest = ?",
+                (time.time(), os.path.basename(cache_dir)),
+            )
+    start_evictor()
+    wake_evictor.set()
+
+
+def record_save(save_dir: str):
+    """Index a digest saved into the cache, and wake the evictor"""
+    if CACHE_MAX_BYTES is None or not is_cache_dir(save_dir):
+        return
+    conn = get_connection()
+    with conn:
+        conn.execute(
+            """INSERT INTO entries VALUES (?, ?, ?, ?, 1)
+            ON CONFLICT (digest) DO UPDATE SET bytes = excluded.bytes, last_access = excluded.last_access""",
+            (
+                os.path.basename(save_dir),
+                os.path.abspath(save_dir),
+                dir_size(save_dir),
+                time.time(),
+            ),
+        )
+    start_evictor()
+    wake_evictor.set()
+
+
+####################
+##### EVICTION #####
+####################
+
+
+def sync_index(conn: sqlite3.Connection):
+    """Index the digests already in the cache (e.g. saved before the manager was turned on),
+    using their modification time as their last use, and forget the ones no longer there
+    """
+    on_disk = {}
+    for root, dirs, files in os.walk(util.CACHE_DIR):
+        if files and root != util.CACHE_DIR:
+            on_disk[os.path.basename(root)] = os.path.abspath(root)
+            # Payload directories have no subdirectories
+            dirs.clear()
+        # Directories being removed by an interrupted eviction
+        dirs[:] = [name for name in dirs if not name.startswith(".evicted-")]
+    indexed = {digest for (digest,) in conn.execute("SELECT digest FROM entries")}
+    with conn:
+        conn.executemany(
+            "INSERT OR IGNORE INTO entries VALUES (?, ?, ?, ?, 0)",
+            [
+                (digest, path, dir_size(path), os.path.getmtime(path))
+                for digest, path in on_disk.items()
+                if digest not in indexed
+            ],
+        )
+        conn.executemany(
+            "DELETE FROM entries WHERE digest = ?",
+            [(digest,) for digest in indexed - on_disk.keys()],
+        )
+
+
+def load_pinned(pin_csv: str = PIN_CSV) -> set[str]:
+    """The digests referenced by the summary CSV"""
+    if not os.path.exists(pin_csv):
+        return set()
+    return {
+        digest
+        for digest in summary_store.read_columns(pin_csv, ["digest"])["digest"]
+        if digest
+    }
+
+
+def remove_dir(path: str):
+    """Remove a cache directory, renaming it first so that no reader sees it half-removed"""
+    trash_path = os.path.join(
+        util.CACHE_DIR, f".evicted-{os.path.basename(path)}-{os.getpid()}"
+    )
+    os.rename(path, trash_path)
+    shutil.rmtree(trash_path, ignore_errors=True)
+
+
+def remove_trash():
+    """Finish the removals interrupted by a crash"""
+    if not os.path.isdir(util.CACHE_DIR):
+        return
+    for name in os.listdir(util.CACHE_DIR):
+        if name.startswith(".evicted-"):
+            shutil.rmtree(os.path.join(util.CACHE_DIR, name), ignore_errors=True)
+
+
+def evict(
+    max_bytes: int | None = CACHE_MAX_BYTES, policy: str = CACHE_POLICY
+) -> tuple[int, int]:
+    """Evict digests until the cache is under LOW_WATERMARK of max_bytes
+    Returns the number of evicted digests and their bytes
+    """
+    with eviction_lock:
+        return evict_unlocked(max_bytes, policy)
+
+
+def evict_unlocked(max_bytes: int | None, policy: str) -> tuple[int, int]:
+    conn = get_connection()
+    (total_bytes,) = conn.execute(
+        "SELECT COALESCE(SUM(bytes), 0) FROM entries"
+    ).fetchone()
+    if max_bytes is None or total_bytes <= max_bytes:
+        return 0, 0
+
+    pinned = load_pinned()
+    target_bytes = max_bytes * LOW_WATERMARK
+    evicted, evicted_bytes = 0, 0
+    candidates = conn.execute(
+        f"SELECT digest, path, bytes FROM entries WHERE last_access < ? ORDER BY {ORDER_BY[policy]}",
+        (time.time() - GRACE_SECONDS,),
+    ).fetchall()
+    for digest, path, num_bytes in candidates:
+        if total_bytes - evicted_bytes <= target_bytes:
+            break
+        if digest in pinned:
+            continue
+        try:
+            remove_dir(path)
+        except FileNotFoundError:
+            pass
+        with conn:
+            conn.execute("DELETE FROM entries WHERE digest = ?", (digest,))
+            add_stat(conn, "evictions")
+            add_stat(conn, "evicted_bytes", num_bytes)
+        evicted += 1
+        evicted_bytes += num_bytes
+    metrics.inc("cache_evictions_total", evicted)
+    metrics.inc("cache_evicted_bytes_total", evicted_bytes)
+    return evicted, evicted_bytes
+
+
+def start_evictor():
+    """Start the background eviction thread of this process, once"""
+    global evictor_started
+    with evictor_lock:
+        if evictor_started:
+            return
+        evictor_started = True
+
+    def evict_when_woken():
+        remove_trash()
+        sync_index(get_connection())
+        while True:
+            wake_evictor.wait()
+            wake_evictor.clear()
+            try:
+                evict()
+            except Exception as e:
+                print(f"Error evicting from the cache: {e}")
+
+    threading.Thread(target=evict_when_woken, daemon=True).start()
+    # A short run can end before the thread gets to evict
+    atexit.register(evict)
+
+
+def stats() -> dict:
+    """Returns a dict with the following keys:
+    - entries, bytes: the digests in the cache and their size
+    - max_bytes, policy: the cap and the eviction policy
+    - pinned: the digests pinned by the summary CSV
+    - hits, misses, hit_ratio: the cache lookups
+    - evictions, evicted_bytes: the evicted digests and their size
+    """
+    conn = get_connection()
+    entries, num_bytes = conn.execute(
+        "SELECT COUNT(*), COALESCE(SUM(bytes), 0) FROM entries"
+    ).fetchone()
+    counts = dict(conn.execute("SELECT name, value FROM stats").fetchall())
+    hits, misses = counts.get("hits", 0), counts.get("misses", 0)
+    return {
+        "entries": entries,
+        "bytes": num_bytes,
+        "max_bytes": CACHE_MAX_BYTES,
+        "policy": CACHE_POLICY,
+        "pinned": len(load_pinned()),
+        "hits": hits,
+        "misses": misses,
+        "hit_ratio": hits / (hits + misses) if hits + misses else None,
+        "evictions": counts.get("evictions", 0),
+        "evicted_bytes": counts.get("evicted_bytes", 0),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("stats", help="print the cache statistics")
+    evict_parser = subparsers.add_parser("evict", help="evict down to the cap now")
+    evict_parser.add_argument("--max-bytes", type=scheduler.parse_size)
+    evict_parser.add_argument("--policy", choices=ORDER_BY, default=CACHE_POLICY)
+    args = parser.parse_args()
+
+    conn = get_connection()
+    remove_trash()
+    sync_index(conn)
+    if args.command == "evict":
+        max_bytes = args.max_bytes or CACHE_MAX_BYTES
+        if max_bytes is None:
+            raise SystemExit("Set --max-bytes or WAYBACK_CACHE_MAX_BYTES")
+        evicted, evicted_bytes = evict(max_bytes, args.policy)
+        print(f"Evicted {evicted} digests ({scheduler.format_size(evicted_bytes)})")
+    for name, value in stats().items():
+        print(f"{name}: {value}")
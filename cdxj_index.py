@@ -0,0 +1,236 @@
+"""Answer CDX queries from a local sorted CDXJ index instead of the CDX API.
+
+The index holds one line per capture, sorted by urlkey and timestamp:
+
+    jp,co,infoseek)/ 20000510114724 {"original": ..., "mimetype": ..., "statuscode": ..., "digest": ..., "length": ...}
+
+Build it from CDX API listings (e.g. bulk downloads for whole domains) with
+
+    python cdxj_index.py build listings/*.cdx --output cdx-index.cdxj
+
+The file is opened with mmap and searched with a binary search over its
+lines, so multi-GB indexes are never loaded into memory and a lookup only
+touches a few pages. While the index (WAYBACK_CDX_INDEX, by default
+cdx-index.cdxj) exists, util.query_wm_cdx_entries and
+util.query_wm_cdx_closest_entry answer from it, and only go to the CDX API
+for the URLs it does not hold.
+"""
+
+import os, json, mmap, heapq, argparse, tempfile, threading
+from datetime import datetime
+import util
+
+CDX_INDEX = os.environ.get("WAYBACK_CDX_INDEX", "cdx-index.cdxj")
+
+# Lines sorted in memory at once when building an index
+SORT_BATCH_LINES = 1_000_000
+
+JSON_FIELDS = ["original", "mimetype", "statuscode", "digest", "length"]
+
+lock = threading.Lock()
+# {path: mmap} of the opened indexes
+opened_indexes = {}
+
+
+##################
+##### LOOKUP #####
+##################
+
+
+def open_index(index_path: str = CDX_INDEX) -> mmap.mmap | None:
+    """Map an index into memory (once per process), or None if it does not exist or is empty"""
+    index = opened_indexes.get(index_path)
+    if index is None:
+        with lock:
+            if index_path not in opened_indexes:
+                if not os.path.exists(index_path) or not os.path.getsize(index_path):
+                    return None
+                with open(index_path, "rb") as f:
+                    opened_indexes[index_path] = mmap.mmap(
+                        f.fileno(), 0, access=mmap.ACCESS_READ
+                    )
+            index = opened_indexes[index_path]
+    return index
+
+
+def lower_bound(index: mmap.mmap, key: bytes) -> int:
+    """Offset of the first line that sorts at or after key"""
+    low, high = 0, len(index)
+    # low is always the start of a line, high the start of a line or the end of the file
+    while low < high:
+        middle = (low + high) // 2
+        line_start = index.rfind(b"\n", 0, middle) + 1
+        line_end = index.find(b"\n", line_start)
+        if line_end == -1:
+            line_end = len(index)
+        if index[line_start:line_end] < key:
+            low = line_end + 1
+        else:
+            high = line_start
+    return min(low, len(index))
+
+
+def read_line(index: mmap.mmap, offset: int) -> tuple[bytes, int]:
+    """The line starting at offset, and the offset of the next line"""
+    line_end = index.find(b"\n", offset)
+    if line_end == -1:
+        line_end = len(index)
+    return index[offset:line_end], line_end + 1
+
+
+def parse_line(line: bytes) -> dict:
+    """Convert an index line into a CDX entry, as returned by util.parse_wm_cdx_api_response_str"""
+    urlkey, timestamp, block = line.decode("utf-8").split(" ", 2)
+    return {"urlkey": urlkey, "timestamp": timestamp, **json.loads(block)}
+
+
+def query_entries(
+    urlkey: str,
+    from_time: str = "",
+    to_time: str = "99999999999999",
+    index_path: str = CDX_INDEX,
+) -> list[dict]:
+    """All the captures of a urlkey between two (inclusive) timestamps, oldest first"""
+    index = open_index(index_path)
+    if index is None:
+        return []
+    prefix = f"{urlkey} ".encode("utf-8")
+    to_time = to_time.encode("ascii")
+
+    entries = []
+    offset = lower_bound(index, prefix + from_time.encode("ascii"))
+    while offset < len(index):
+        line, offset = read_line(index, offset)
+        if not line.startswith(prefix) or line[len(prefix) :][:14] > to_time:
+            break
+        entries.append(parse_line(line))
+    return entries
+
+
+def seconds_between(timestamp_a: str, timestamp_b: str) -> float:
+    parse = lambda timestamp: datetime.strptime(
+        timestamp.ljust(14, "0")[:14], "%Y%m%d%H%M%S"
+    )
+    return abs((parse(timestamp_a) - parse(timestamp_b)).total_seconds())
+
+
+def query_closest_entry(
+    urlkey: str, timestamp: str, index_path: str = CDX_INDEX
+) -> dict | None:
+    """The capture of a urlkey closest in time to a timestamp, or None if the index has none"""
+    index = open_index(index_path)
+    if index is None:
+        return None
+    prefix = f"{urlkey} ".encode("utf-8")
+
+    # The captures right before and right after the timestamp are the only candidates
+    offset = lower_bound(index, prefix + timestamp.encode("ascii"))
+    candidates = []
+    if offset > 0:
+        previous_start = index.rfind(b"\n", 0, offset - 1) + 1
+        candidates.append(read_line(index, previous_start)[0])
+    if offset < len(index):
+        candidates.append(read_line(index, offset)[0])
+
+    entries = [parse_line(line) for line in candidates if line.startswith(prefix)]
+    # Ties go to the earlier capture
+    return min(
+        entries,
+        key=lambda entry: seconds_between(entry["timestamp"], timestamp),
+        default=None,
+    )
+
+
+####################
+##### BUILDING #####
+####################
+
+
+def to_cdxj_line(line: str) -> str | None:
+    """Convert a CDX API line (or an existing CDXJ line) into an index line"""
+    line = line.strip()
+    if not line:
+        return None
+    if line.endswith("}"):
+        return line
+    entry = util.parse_wm_cdx_api_response_str(line)[0]
+    block = json.dumps({field: entry[field] for field in JSON_FIELDS})
+    return f"{entry['urlkey']} {entry['timestamp']} {block}"
+
+
+def write_sorted_run(lines: list[str], runs_dir: str) -> str:
+    lines.sort()
+    run_file = tempfile.NamedTemporaryFile(
+        "w", dir=runs_dir, suffix=".run", delete=False, encoding="utf-8"
+    )
+    with run_file:
+        run_file.writelines(line + "\n" for line in lines)
+    return run_file.name
+
+
+def build_index(input_paths: list[str], index_path: str = CDX_INDEX) -> int:
+    """Sort CDX listings into an index, without holding more than SORT_BATCH_LINES lines in memory
+    Returns the number of lines in the index
+    """
+    index_dir = os.path.dirname(os.path.abspath(index_path))
+    with tempfile.TemporaryDirectory(dir=index_dir) as runs_dir:
+        # Sort batches of lines into run files, then merge the runs
+        run_paths = []
+        batch = []
+        for input_path in input_paths:
+            with open(input_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    cdxj_line = to_cdxj_line(line)
+                    if cdxj_line:
+                        batch.append(cdxj_line)
+                    if len(batch) >= SORT_BATCH_LINES:
+                        run_paths.append(write_sorted_run(batch, runs_dir))
+                        batch = []
+        run_paths.append(write_sorted_run(batch, runs_dir))
+
+        run_files = [open(path, "r", encoding="utf-8") for path in run_paths]
+        tmp_path = f"{index_path}.tmp-{os.getpid()}"
+        count = 0
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                previous = None
+                for line in heapq.merge(*run_files):
+                    # The same capture may be listed in several inputs
+                    if line != previous:
+                        f.write(line)
+                        count += 1
+                    previous = line
+            os.replace(tmp_path, index_path)
+        finally:
+            for run_file in run_files:
+                run_file.close()
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+    return count
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build_parser = subparsers.add_parser("build", help="build an index")
+    build_parser.add_argument("inputs", nargs="+", help="CDX or CDXJ files")
+    build_parser.add_argument("--output", default=CDX_INDEX)
+    lookup_parser = subparsers.add_parser("lookup", help="look up a URL")
+    lookup_parser.add_argument("url")
+    lookup_parser.add_argument(
+        "--closest", help="timestamp to find the closest capture to"
+    )
+    lookup_parser.add_argument("--index", default=CDX_INDEX)
+    args = parser.parse_args()
+
+    if args.command == "build":
+        count = build_index(args.inputs, args.output)
+        print(f"Indexed {count} captures into {args.output}")
+    elif args.closest:
+        entry = query_closest_entry(
+            util.surt_urlkey(args.url), args.closest, args.index
+        )
+        print(json.dumps(entry))
+    else:
+        for entry in query_entries(util.surt_urlkey(args.url), index_path=args.index):
+            print(json.dumps(entry))
@@ -0,0 +1,65 @@
+"""Split a crawl across worker processes or hosts sharing a filesystem.
+
+    python crawl-queue.py seed                # enqueue the websites and the snapshots already in data/
+    python crawl-queue.py work --shard 0/4    # drain one shard (run one worker per shard, on any host)
+    python crawl-queue.py status
+
+Workers run stages 1-6 unit by unit; run 7-summarize-banner-ads.py and
+8-generate-gallery.py once the queue is drained.
+"""
+
+import os, argparse, json
+import util, stages, workqueue
+
+
+def parse_shard(value: str) -> tuple[int, int]:
+    index, count = (int(part) for part in value.split("/"))
+    if not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f"invalid shard {value}")
+    # Units are spread over NUM_SHARDS shards, so more workers would get no work
+    if count > workqueue.NUM_SHARDS:
+        raise argparse.ArgumentTypeError(
+            f"at most {workqueue.NUM_SHARDS} shards, not {count}"
+        )
+    return index, count
+
+
+parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+parser.add_argument("--queue", default=workqueue.QUEUE_PATH, help="queue database")
+subparsers = parser.add_subparsers(dest="command", required=True)
+
+seed_parser = subparsers.add_parser("seed", help="enqueue websites and saved snapshots")
+seed_parser.add_argument("--seed-csv", default="nikkeibp-may2000.csv")
+
+work_parser = subparsers.add_parser("work", help="drain the queue")
+work_parser.add_argument("--shard", type=parse_shard, help="index/count, e.g. 0/4")
+work_parser.add_argument("--worker-id", help="defaults to hostname:pid")
+work_parser.add_argument("--lease", type=int, default=workqueue.LEASE_SECONDS)
+work_parser.add_argument(
+    "--wait", action="store_true", help="keep waiting for new tasks once drained"
+)
+
+subparsers.add_parser("status", help="count tasks per kind and status")
+
+args = parser.parse_args()
+conn = workqueue.open_queue(args.queue)
+
+if args.command == "seed":
+    os.makedirs(util.OUTPUT_DIR, exist_ok=True)
+    tasks = [
+        workqueue.website_task(website)
+        for website in stages.read_seed_websites(args.seed_csv)
+    ]
+    # Websites already queried in an earlier run are skipped by stage 1,
+    # so their snapshots are enqueued directly from the data/ tree
+    tasks += [
+        workqueue.snapshot_task(entry)
+        for entry in util.retrieve_saved_website_entries()
+    ]
+    print(f"Added {workqueue.enqueue_tasks(conn, tasks)} tasks")
+
+elif args.command == "work":
+    workqueue.work(args.queue, args.worker_id, args.shard, args.lease, not args.wait)
+
+elif args.command == "status":
+    print(json.dumps(workqueue.queue_status(conn), indent=2))
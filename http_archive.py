@@ -0,0 +1,102 @@
+"""Record and replay the HTTP exchanges of util.http_get.
+
+With WAYBACK_HTTP_MODE=record every response from the Wayback Machine is
+also stored in a local SQLite archive (WAYBACK_HTTP_ARCHIVE, by default
+http-archive.sqlite). With WAYBACK_HTTP_MODE=replay every request is
+answered from that archive without touching the network, so reruns (e.g.
+after a change to a parser or to the summary) are deterministic and fast.
+A request that was never recorded raises ReplayMissError instead of going
+to the network.
+"""
+
+import os, json, time, sqlite3, threading
+from typing import TYPE_CHECKING
+
+# requests is imported when a recorded response is replayed
+if TYPE_CHECKING:
+    import requests
+
+HTTP_MODE = os.environ.get("WAYBACK_HTTP_MODE", "live")
+HTTP_ARCHIVE_PATH = os.environ.get("WAYBACK_HTTP_ARCHIVE", "http-archive.sqlite")
+
+if HTTP_MODE not in ("live", "record", "replay"):
+    raise ValueError(
+        f"WAYBACK_HTTP_MODE must be live, record or replay, not {HTTP_MODE}"
+    )
+
+
+class ReplayMissError(Exception):
+    """A request in replay mode that is not in the archive"""
+
+
+# One connection per thread, as sqlite3 connections cannot be shared between threads
+local = threading.local()
+
+
+def get_connection(archive_path: str = HTTP_ARCHIVE_PATH) -> sqlite3.Connection:
+    conn = getattr(local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(archive_path, timeout=60)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("""CREATE TABLE IF NOT EXISTS exchanges (
+                url TEXT NOT NULL,
+                request_headers TEXT NOT NULL,
+                status INTEGER NOT NULL,
+                response_headers TEXT NOT NULL,
+                body BLOB NOT NULL,
+                recorded_at REAL NOT NULL,
+                PRIMARY KEY (url, request_headers)
+            )""")
+        local.conn = conn
+    return conn
+
+
+def request_key(headers: dict | None) -> str:
+    return json.dumps(headers or {}, sort_keys=True)
+
+
+def record_exchange(url: str, headers: dict | None, response: "requests.Response"):
+    """Store a response, replacing any earlier one for the same request
+    Server errors are not stored, so that a later successful retry is what gets replayed
+    """
+    if response.status_code >= 500:
+        return
+    conn = get_connection()
+    with conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO exchanges VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                url,
+                request_key(headers),
+                response.status_code,
+                json.dumps(dict(response.headers)),
+                response.content,
+                time.time(),
+            ),
+        )
+
+
+def replay_exchange(url: str, headers: dict | None) -> "requests.Response":
+    """Build the recorded response of a request"""
+    row = (
+        get_connection()
+        .execute(
+            """SELECT status, response_headers, body FROM exchanges
+            WHERE url = ? AND request_headers = ?""",
+            (url, request_key(headers)),
+        )
+        .fetchone()
+    )
+    if row is None:
+        raise ReplayMissError(f"Not in the HTTP archive: {url}")
+
+    import requests
+    from requests.structures import CaseInsensitiveDict
+
+    response = requests.Response()
+    response.url = url
+    response.status_code = row[0]
+    response.headers = CaseInsensitiveDict(json.loads(row[1]))
+    response._content = row[2]
+    response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+    return response
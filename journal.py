@@ -0,0 +1,194 @@
+"""Write-ahead journal of the units of work that write several files.
+
+Before a unit writes its outputs, a "begin" record listing the output paths
+is appended to the journal; once every output is in place, an "end" record
+follows. After a crash, recover_journal() removes the partial outputs of the
+units that began but never ended, so that a restart redoes exactly those
+units, and remembers the committed units so they can be skipped without
+looking at the data/ tree again.
+
+Single files are always written with util.atomic_write, so only units with
+several outputs (e.g. a snapshot: raw HTML, UTF-8 HTML and encoding.txt,
+both in data/ and in cache/) need the journal.
+"""
+
+import os, json, fcntl, socket, shutil, contextlib
+import util
+
+# Kept inside data/, so that deleting the data/ tree also forgets the committed units
+JOURNAL_PATH = os.path.join(util.OUTPUT_DIR, ".journal.jsonl")
+
+HOSTNAME = socket.gethostname()
+
+# (stage, key) of the committed units, loaded by recover_journal()
+committed_units = set()
+
+
+def open_locked(journal_path: str, lock: int) -> int:
+    """Open the journal for appending under a shared or exclusive lock
+    The journal may have been replaced by a compaction while waiting for the lock,
+    in which case the new file is opened instead
+    """
+    while True:
+        fd = os.open(journal_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        fcntl.flock(fd, lock)
+        try:
+            if os.fstat(fd).st_ino == os.stat(journal_path).st_ino:
+                return fd
+        except FileNotFoundError:
+            pass
+        os.close(fd)
+
+
+def append_record(record: dict, journal_path: str = JOURNAL_PATH):
+    """Append one record to the journal
+    Records are short single lines written with O_APPEND, so concurrent writers do not
+    interleave. Writers share a lock that compaction takes exclusively
+    """
+    line = (json.dumps(record) + "\n").encode("utf-8")
+    os.makedirs(os.path.dirname(journal_path) or ".", exist_ok=True)
+    fd = open_locked(journal_path, fcntl.LOCK_SH)
+    try:
+        os.write(fd, line)
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+@contextlib.contextmanager
+def journaled_unit(
+    stage: str, key: str, paths: list[str], journal_path: str = JOURNAL_PATH
+):
+    """Journal a unit of work that writes the given files or directories
+    If the unit raises, its partial outputs are removed right away
+    """
+    committed_units.discard((stage, key))
+    append_record(
+        {
+            "op": "begin",
+            "stage": stage,
+            "key": key,
+            "paths": paths,
+            "host": HOSTNAME,
+            "pid": os.getpid(),
+        },
+        journal_path,
+    )
+    try:
+        yield
+    except BaseException:
+        remove_partial_outputs(paths)
+        append_record({"op": "abort", "stage": stage, "key": key}, journal_path)
+        raise
+    append_record({"op": "end", "stage": stage, "key": key}, journal_path)
+    committed_units.add((stage, key))
+
+
+def is_committed(stage: str, key: str) -> bool:
+    """Whether a unit was completed according to the journal"""
+    return (stage, key) in committed_units
+
+
+def remove_partial_outputs(paths: list[str]):
+    """Remove the outputs of an interrupted unit and the leftovers of interrupted atomic writes"""
+    for path in paths:
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+
+        parent_dir = os.path.dirname(path)
+        if os.path.isdir(parent_dir):
+            for filename in os.listdir(parent_dir):
+                if util.is_temporary_file(filename):
+                    os.remove(os.path.join(parent_dir, filename))
+
+
+def is_process_alive(record: dict) -> bool:
+    """Whether the process that began a unit may still be running"""
+    if record.get("host") != HOSTNAME:
+        # Processes on other hosts cannot be checked
+        return True
+    if record["pid"] == os.getpid():
+        # A previous process with the same (recycled) pid
+        return False
+    try:
+        os.kill(record["pid"], 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def recover_journal(
+    journal_path: str = JOURNAL_PATH, force: bool = False
+) -> list[dict]:
+    """Clean up the units that were interrupted by a crash and load the committed units
+    Units begun by a process that is still running (or by another host, unless force is set) are left alone
+    Returns the begin records of the units that were cleaned up
+    """
+    if not os.path.exists(journal_path):
+        return []
+
+    in_flight = read_journal(journal_path)
+
+    recovered = []
+    still_running = []
+    for unit, record in in_flight.items():
+        if not force and is_process_alive(record):
+            still_running.append(record)
+            continue
+        print(f"Recovering interrupted {record['stage']} unit {record['key']}")
+        remove_partial_outputs(record["paths"])
+        recovered.append(record)
+
+    # Compact the journal when no other unit is in flight
+    if not still_running:
+        compact_journal(journal_path, recovered)
+    return recovered
+
+
+def read_journal(journal_path: str) -> dict:
+    """Load the committed units of the journal into committed_units
+    Returns the begin records of the units that have not ended, by (stage, key)
+    """
+    in_flight = {}
+    with open(journal_path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # Last line of a journal that was cut off by the crash
+                continue
+            unit = (record["stage"], record["key"])
+            if record["op"] == "begin":
+                in_flight[unit] = record
+                committed_units.discard(unit)
+            else:
+                in_flight.pop(unit, None)
+                if record["op"] == "end":
+                    committed_units.add(unit)
+    return in_flight
+
+
+def compact_journal(
+    journal_path: str = JOURNAL_PATH, recovered: list[dict] | None = None
+):
+    """Rewrite the journal as one end record per committed unit
+    The journal is read again under an exclusive lock, so no append can be lost to
+    the rename, and left as it is if a unit other than the recovered ones began
+    since recover_journal read it
+    """
+    fd = open_locked(journal_path, fcntl.LOCK_EX)
+    try:
+        in_flight = read_journal(journal_path)
+        if any(record not in (recovered or []) for record in in_flight.values()):
+            return
+        lines = [
+            json.dumps({"op": "end", "stage": stage, "key": key})
+            for stage, key in sorted(committed_units)
+        ]
+        util.atomic_write(journal_path, "".join(line + "\n" for line in lines))
+    finally:
+        os.close(fd)
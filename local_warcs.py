@@ -0,0 +1,350 @@
+"""Serve snapshots from our own WARC collections instead of the Wayback Machine.
+
+Build an index of local WARC files (.warc.gz, one gzip member per record, or
+plain .warc) once:
+
+    python local_warcs.py index /path/to/crawls ...
+
+This writes a sorted CDXJ file (WAYBACK_LOCAL_WARC_INDEX, by default
+local-warcs.cdxj) with one line per response or resource record:
+
+    jp,co,infoseek)/ 20000510114724 {"url": ..., "digest": ..., "mime": ..., "status": ..., "filename": ..., "offset": ..., "length": ...}
+
+While that file exists, util.download_website_snapshot and
+util.download_image_snapshot resolve each CDX entry against it first, by
+digest and then by urlkey and timestamp, and stream the payload straight out
+of the WARC record instead of requesting it from the Wayback Machine.
+"""
+
+import os, io, re, gzip, json, zlib, base64, hashlib, argparse, threading
+from typing import TYPE_CHECKING
+
+# requests is imported by the functions that read local WARC files, which most runs never do
+if TYPE_CHECKING:
+    import requests
+    from requests.structures import CaseInsensitiveDict
+import metrics, util
+
+LOCAL_WARC_INDEX = os.environ.get("WAYBACK_LOCAL_WARC_INDEX", "local-warcs.cdxj")
+
+CHUNK_SIZE = 1024 * 1024
+
+lock = threading.Lock()
+# Loaded from LOCAL_WARC_INDEX on first use: {digest: record} and {(urlkey, timestamp): record}
+index_by_digest = None
+index_by_capture = None
+
+
+###################
+##### READING #####
+###################
+
+
+def read_header_block(stream) -> tuple[str, "CaseInsensitiveDict", int]:
+    """Read a status line and the header lines up to the blank line that ends them
+    Returns the status line, the headers and the number of bytes read
+    """
+    from requests.structures import CaseInsensitiveDict
+
+    status_line = stream.readline()
+    num_bytes = len(status_line)
+    headers = CaseInsensitiveDict()
+    while True:
+        line = stream.readline()
+        num_bytes += len(line)
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("utf-8", errors="replace").partition(":")
+        headers[name.strip()] = value.strip()
+    return status_line.decode("utf-8", errors="replace").strip(), headers, num_bytes
+
+
+def iter_exactly(stream, length: int):
+    """Yield the next length bytes of a stream in chunks"""
+    while length > 0:
+        chunk = stream.read(min(CHUNK_SIZE, length))
+        if not chunk:
+            raise ValueError("WARC record is shorter than its Content-Length")
+        length -= len(chunk)
+        yield chunk
+
+
+def iter_dechunked(stream):
+    """Yield the body of an HTTP message sent with Transfer-Encoding: chunked"""
+    while True:
+        size_line = stream.readline()
+        if not size_line:
+            return
+        size = int(size_line.split(b";")[0].strip() or b"0", 16)
+        if size == 0:
+            return
+        yield from iter_exactly(stream, size)
+        # CRLF after each chunk
+        stream.readline()
+
+
+def iter_decoded(chunks, content_encoding: str):
+    """Undo a gzip or deflate Content-Encoding, as requests does for live responses"""
+    if content_encoding not in ("gzip", "x-gzip", "deflate"):
+        yield from chunks
+        return
+    # 47 accepts both gzip and zlib headers
+    decompressor = zlib.decompressobj(47)
+    for chunk in chunks:
+        yield decompressor.decompress(chunk)
+    yield decompressor.flush()
+
+
+def open_record(stream) -> dict:
+    """Parse the headers of the WARC record at the current position of a stream
+    Returns a dict with the following keys:
+    - warc_headers: the WARC headers of the record
+    - status: the HTTP status of a response record (200 for a resource record)
+    - http_headers: the HTTP headers of a response record (only Content-Type for a resource record)
+    - chunks: an iterator over the payload, with transfer and content encodings undone
+    """
+    from requests.structures import CaseInsensitiveDict
+
+    version, warc_headers, _ = read_header_block(stream)
+    if not version.startswith("WARC/"):
+        raise ValueError(f"Not a WARC record: {version[:40]!r}")
+    content_length = int(warc_headers.get("Content-Length", 0))
+
+    if warc_headers.get("WARC-Type") != "response":
+        return {
+            "warc_headers": warc_headers,
+            "status": 200,
+            "http_headers": CaseInsensitiveDict(
+                {"Content-Type": warc_headers.get("Content-Type", "")}
+            ),
+            "chunks": iter_exactly(stream, content_length),
+        }
+
+    status_line, http_headers, header_length = read_header_block(stream)
+    status = int(status_line.split(" ")[1]) if " " in status_line else 0
+    if "chunked" in http_headers.get("Transfer-Encoding", "").lower():
+        chunks = iter_dechunked(stream)
+    else:
+        chunks = iter_exactly(stream, content_length - header_length)
+    return {
+        "warc_headers": warc_headers,
+        "status": status,
+        "http_headers": http_headers,
+        "chunks": iter_decoded(
+            chunks, http_headers.get("Content-Encoding", "").lower()
+        ),
+    }
+
+
+def iter_payload_chunks(record: dict):
+    """Stream the payload of an indexed record out of its WARC file"""
+    with open(record["filename"], "rb") as f:
+        f.seek(record["offset"])
+        stream = gzip.GzipFile(fileobj=f) if record["filename"].endswith(".gz") else f
+        # Only the bytes of this record are read, so the stream never runs into the next one
+        yield from open_record(stream)["chunks"]
+
+
+def read_payload(record: dict) -> bytes:
+    return b"".join(iter_payload_chunks(record))
+
+
+####################
+##### INDEXING #####
+####################
+
+
+def iter_gzip_members(path: str):
+    """Yield the offset, compressed length and content of every gzip member of a file"""
+    with open(path, "rb") as f:
+        offset = 0
+        data = f.read(CHUNK_SIZE)
+        while data:
+            start = offset
+            decompressor = zlib.decompressobj(31)
+            content = []
+            while True:
+                content.append(decompressor.decompress(data))
+                if decompressor.eof:
+                    offset += len(data) - len(decompressor.unused_data)
+                    data = decompressor.unused_data
+                    break
+                offset += len(data)
+                data = f.read(CHUNK_SIZE)
+                if not data:
+                    raise ValueError(
+                        f"Truncated gzip member at offset {start} in {path}"
+                    )
+            if not data:
+                data = f.read(CHUNK_SIZE)
+            yield start, offset - start, b"".join(content)
+
+
+def iter_plain_records(path: str):
+    """Yield the offset, length and content of every record of an uncompressed WARC file"""
+    with open(path, "rb") as f:
+        while True:
+            start = f.tell()
+            version, headers, _ = read_header_block(f)
+            if not version:
+                return
+            f.seek(int(headers.get("Content-Length", 0)), os.SEEK_CUR)
+            # Records end with two CRLFs
+            f.readline()
+            f.readline()
+            end = f.tell()
+            f.seek(start)
+            yield start, end - start, f.read(end - start)
+
+
+def warc_timestamp(warc_date: str) -> str:
+    """Convert a WARC-Date (e.g. 2000-05-10T11:47:24Z) to a 14-digit CDX timestamp"""
+    return re.sub(r"\D", "", warc_date)[:14].ljust(14, "0")
+
+
+def payload_digest(warc_headers: "CaseInsensitiveDict", chunks) -> str:
+    """The base32 SHA-1 digest of a payload, as used in the digest field of the CDX API"""
+    digest = warc_headers.get("WARC-Payload-Digest", "")
+    if digest.lower().startswith("sha1:"):
+        # Drain the payload anyway, so that a truncated record is still detected
+        for _ in chunks:
+            pass
+        return digest[5:]
+    sha1 = hashlib.sha1()
+    for chunk in chunks:
+        sha1.update(chunk)
+    return base64.b32encode(sha1.digest()).decode("ascii")
+
+
+def index_warc_file(path: str) -> list[str]:
+    """Index the response and resource records of a WARC file
+    Returns a list of CDXJ lines
+    """
+    path = os.path.abspath(path)
+    if path.endswith(".gz"):
+        records = iter_gzip_members(path)
+    else:
+        records = iter_plain_records(path)
+
+    lines = []
+    for offset, length, content in records:
+        record = open_record(io.BytesIO(content))
+        warc_headers = record["warc_headers"]
+        if warc_headers.get("WARC-Type") not in ("response", "resource"):
+            continue
+        url = warc_headers.get("WARC-Target-URI", "").strip("<>")
+        entry = {
+            "url": url,
+            "digest": payload_digest(warc_headers, record["chunks"]),
+            "mime": record["http_headers"]
+            .get("Content-Type", "")
+            .split(";")[0]
+            .strip(),
+            "status": record["status"],
+            "filename": path,
+            "offset": offset,
+            "length": length,
+        }
+        timestamp = warc_timestamp(warc_headers.get("WARC-Date", ""))
+        lines.append(f"{util.surt_urlkey(url)} {timestamp} {json.dumps(entry)}\n")
+    return lines
+
+
+def find_warc_files(paths: list[str]) -> list[str]:
+    """Expand directories into the WARC files they contain"""
+    warc_files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                warc_files += [
+                    os.path.join(root, filename)
+                    for filename in sorted(files)
+                    if filename.endswith((".warc", ".warc.gz"))
+                ]
+        else:
+            warc_files.append(path)
+    return warc_files
+
+
+def build_index(paths: list[str], index_path: str = LOCAL_WARC_INDEX) -> int:
+    """Index WARC files and directories into a sorted CDXJ file
+    Returns the number of indexed records
+    """
+    lines = []
+    for warc_file in find_warc_files(paths):
+        print(f"Indexing {warc_file}")
+        lines += index_warc_file(warc_file)
+    # Sorted by urlkey and timestamp, like the CDX API
+    lines.sort()
+    util.atomic_write(index_path, "".join(lines))
+    return len(lines)
+
+
+###################
+##### LOOKUPS #####
+###################
+
+
+def load_index(index_path: str = LOCAL_WARC_INDEX):
+    """Load the index of local WARC files, if there is one"""
+    global index_by_digest, index_by_capture
+    by_digest, by_capture = {}, {}
+    if os.path.exists(index_path):
+        with open(index_path, "r", encoding="utf-8") as f:
+            for line in f:
+                urlkey, timestamp, block = line.rstrip("\n").split(" ", 2)
+                record = json.loads(block)
+                # Only successful captures can stand in for a replayed snapshot
+                if record["status"] != 200:
+                    continue
+                by_digest.setdefault(record["digest"], record)
+                by_capture.setdefault((urlkey, timestamp), record)
+    index_by_digest, index_by_capture = by_digest, by_capture
+
+
+def find_record(cdx_entry: dict) -> dict | None:
+    """Find a local WARC record for a CDX entry, by digest and then by urlkey and timestamp"""
+    if index_by_digest is None:
+        with lock:
+            if index_by_digest is None:
+                load_index()
+    record = index_by_digest.get(cdx_entry["digest"])
+    if record is None:
+        record = index_by_capture.get((cdx_entry["urlkey"], cdx_entry["timestamp"]))
+    return record
+
+
+def find_response(cdx_entry: dict) -> "requests.Response | None":
+    """Build the response for a CDX entry from the local WARC files, or None if they do not hold it"""
+    if not os.path.exists(LOCAL_WARC_INDEX):
+        return None
+    record = find_record(cdx_entry)
+    metrics.inc(
+        "local_warc_lookups_total", result="hit" if record is not None else "miss"
+    )
+    if record is None:
+        return None
+
+    import requests
+    from requests.structures import CaseInsensitiveDict
+
+    response = requests.Response()
+    response.url = record["url"]
+    response.status_code = record["status"]
+    response.headers = CaseInsensitiveDict({"Content-Type": record["mime"]})
+    response._content = read_payload(record)
+    response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+    return response
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    index_parser = subparsers.add_parser("index", help="index WARC files")
+    index_parser.add_argument("paths", nargs="+", help="WARC files or directories")
+    index_parser.add_argument("--output", default=LOCAL_WARC_INDEX)
+    args = parser.parse_args()
+
+    if args.command == "index":
+        count = build_index(args.paths, args.output)
+        print(f"Indexed {count} records into {args.output}")
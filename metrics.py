@@ -0,0 +1,239 @@
+"""Counters and latency histograms for the crawl, exported while it runs.
+
+util records every HTTP request (per endpoint: "cdx", "id_" or "im_"),
+every retry, every cache lookup and the time spent in the parse helpers;
+stages.py records the items processed per stage. The timed helpers and stage
+items are also tracing spans (see tracing.py). Set the environment
+variables below to export the metrics periodically:
+
+- WAYBACK_METRICS_JSONL: append one JSON snapshot per interval to this file
+- WAYBACK_METRICS_PROM: rewrite this Prometheus textfile every interval
+  (for the node_exporter textfile collector)
+- WAYBACK_METRICS_INTERVAL: export interval in seconds (default 10)
+"""
+
+import os, json, time, atexit, threading, functools, contextlib
+import tracing
+
+METRICS_JSONL = os.environ.get("WAYBACK_METRICS_JSONL")
+METRICS_PROM = os.environ.get("WAYBACK_METRICS_PROM")
+METRICS_INTERVAL = float(os.environ.get("WAYBACK_METRICS_INTERVAL", "10"))
+
+# Upper bounds of the histogram buckets, in seconds
+LATENCY_BUCKETS = [0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+
+START_TIME = time.time()
+
+lock = threading.Lock()
+# {(name, ((label, value), ...)): value}
+counters = {}
+# {(name, ((label, value), ...)): {"buckets": [...], "sum": ..., "count": ...}}
+histograms = {}
+
+
+def labels_key(labels: dict) -> tuple:
+    return tuple(sorted((label, str(value)) for label, value in labels.items()))
+
+
+def inc(name: str, value: float = 1, **labels):
+    """Increment a counter"""
+    key = (name, labels_key(labels))
+    with lock:
+        counters[key] = counters.get(key, 0) + value
+
+
+def observe(name: str, seconds: float, **labels):
+    """Record a duration in a histogram"""
+    key = (name, labels_key(labels))
+    with lock:
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = {"buckets": [0] * len(LATENCY_BUCKETS), "sum": 0, "count": 0}
+            histograms[key] = histogram
+        for i, upper_bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= upper_bound:
+                histogram["buckets"][i] += 1
+        histogram["sum"] += seconds
+        histogram["count"] += 1
+
+
+@contextlib.contextmanager
+def timer(name: str, **labels):
+    """Record the duration of a block in a histogram"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+def timed(name: str):
+    """Decorator recording the duration of each call, labelled with the function name"""
+
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with timer(name, function=fn.__name__), tracing.span(fn.__name__):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def stage_item(stage: str):
+    """Decorator counting the items processed by a stage function and their duration
+    Each item is also a tracing span, labelled with the website, timestamp and digest
+    of the first argument (see tracing.item_keys)
+    """
+
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            item = args[0] if args else None
+            try:
+                with timer("stage_item_duration_seconds", stage=stage), tracing.span(
+                    stage, "stage_item", **tracing.item_keys(item)
+                ):
+                    return fn(*args, **kwargs)
+            finally:
+                inc("stage_items_total", stage=stage)
+
+        return wrapper
+
+    return decorator
+
+
+def record_request(endpoint: str, seconds: float, num_bytes: int, status: int | str):
+    """Record one HTTP request to the Wayback Machine"""
+    inc("http_requests_total", endpoint=endpoint, status=status)
+    inc("http_response_bytes_total", num_bytes, endpoint=endpoint)
+    observe("http_request_duration_seconds", seconds, endpoint=endpoint)
+
+
+def record_retry(retry_state):
+    """tenacity before_sleep hook counting the retries per function"""
+    inc("retries_total", function=retry_state.fn.__name__)
+
+
+def record_cache_lookup(hit: bool):
+    inc("cache_lookups_total", result="hit" if hit else "miss")
+
+
+##################
+##### EXPORT #####
+##################
+
+
+def total(name: str, **labels) -> float:
+    """Sum a counter over all the label values not given"""
+    wanted = set(labels_key(labels))
+    with lock:
+        return sum(
+            value
+            for (counter_name, key), value in counters.items()
+            if counter_name == name and wanted <= set(key)
+        )
+
+
+def snapshot() -> dict:
+    """All the metrics as a JSON-serializable dict, with overall rates"""
+    uptime = time.time() - START_TIME
+    with lock:
+        counter_list = [
+            {"name": name, "labels": dict(key), "value": value}
+            for (name, key), value in sorted(counters.items())
+        ]
+        histogram_list = [
+            {
+                "name": name,
+                "labels": dict(key),
+                "buckets": dict(zip(map(str, LATENCY_BUCKETS), histogram["buckets"])),
+                "sum": histogram["sum"],
+                "count": histogram["count"],
+            }
+            for (name, key), histogram in sorted(histograms.items())
+        ]
+
+    cache_hits = total("cache_lookups_total", result="hit")
+    cache_lookups = total("cache_lookups_total")
+    stage_items_per_second = {
+        counter["labels"]["stage"]: counter["value"] / uptime
+        for counter in counter_list
+        if counter["name"] == "stage_items_total"
+    }
+    return {
+        "time": time.time(),
+        "uptime_seconds": uptime,
+        "requests_per_second": total("http_requests_total") / uptime,
+        "bytes_per_second": total("http_response_bytes_total") / uptime,
+        "cache_hit_ratio": cache_hits / cache_lookups if cache_lookups else None,
+        "stage_items_per_second": stage_items_per_second,
+        "counters": counter_list,
+        "histograms": histogram_list,
+    }
+
+
+def prometheus_labels(labels: dict, extra: dict | None = None) -> str:
+    labels = {**labels, **(extra or {})}
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels.items()) + "}"
+
+
+def to_prometheus_text(metrics: dict) -> str:
+    """Format a snapshot() in the Prometheus text exposition format"""
+    lines = []
+    typed = set()
+    for counter in metrics["counters"]:
+        name = f"wayback_{counter['name']}"
+        if name not in typed:
+            lines.append(f"# TYPE {name} counter")
+            typed.add(name)
+        lines.append(f"{name}{prometheus_labels(counter['labels'])} {counter['value']}")
+    for histogram in metrics["histograms"]:
+        name = f"wayback_{histogram['name']}"
+        if name not in typed:
+            lines.append(f"# TYPE {name} histogram")
+            typed.add(name)
+        for upper_bound, count in histogram["buckets"].items():
+            labels = prometheus_labels(histogram["labels"], {"le": upper_bound})
+            lines.append(f"{name}_bucket{labels} {count}")
+        labels = prometheus_labels(histogram["labels"], {"le": "+Inf"})
+        lines.append(f"{name}_bucket{labels} {histogram['count']}")
+        labels = prometheus_labels(histogram["labels"])
+        lines.append(f"{name}_sum{labels} {histogram['sum']}")
+        lines.append(f"{name}_count{labels} {histogram['count']}")
+    return "\n".join(lines) + "\n"
+
+
+def export(
+    jsonl_path: str | None = METRICS_JSONL, prom_path: str | None = METRICS_PROM
+):
+    """Append a JSON line and/or rewrite the Prometheus textfile"""
+    metrics = snapshot()
+    if jsonl_path:
+        with open(jsonl_path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(metrics) + "\n")
+    if prom_path:
+        # Rename into place so the collector never reads a partial file
+        tmp_path = f"{prom_path}.tmp-{os.getpid()}"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(to_prometheus_text(metrics))
+        os.replace(tmp_path, prom_path)
+
+
+def start_exporter(interval: float = METRICS_INTERVAL):
+    """Export the metrics every interval seconds in a background thread, and once more at exit"""
+
+    def export_periodically():
+        while True:
+            time.sleep(interval)
+            export()
+
+    threading.Thread(target=export_periodically, daemon=True).start()
+    atexit.register(export)
+
+
+if METRICS_JSONL or METRICS_PROM:
+    start_exporter()
@@ -0,0 +1,134 @@
+"""Move a tree saved with the old flat layout to the fan-out, collision-free layout.
+
+    python migrate-layout.py            # migrate cache/ and data/
+    python migrate-layout.py --dry-run  # only count what would move
+
+cache/<digest> directories move to cache/AB/CD/<digest> (see
+util.cache_snapshot_dir), and the frames/ and banners/ directories named with
+util.url_to_filename are renamed with util.url_to_dirname and get a url.txt.
+frame_tree.json files are rewritten to the new names.
+
+The migration can run while a crawl is writing to the same tree: every move is
+a single rename, the stages find a directory under either name, and a
+directory that already exists under its new name is left in place and
+reported instead of being merged. Directories whose old name is shared by
+several URLs (the collisions the new layout fixes) cannot be attributed to one
+of them and are left in place too; rerunning the stages downloads them again
+under their new names.
+"""
+
+import os, re, json, argparse
+import util
+
+DIGEST_PATTERN = re.compile(r"^[A-Z2-7]{32}$")
+
+# Subdirectories named after URLs, and the file listing the tags they come from
+URL_SUBDIRS = {"frames": "frame_tags.json", "banners": "image_tags.json"}
+
+
+def move(old_path: str, new_path: str, dry_run: bool) -> bool:
+    """Rename a directory, unless its new name is already taken"""
+    if os.path.exists(new_path):
+        print(f"  Skipping {old_path}: {new_path} already exists")
+        return False
+    if not dry_run:
+        os.makedirs(os.path.dirname(new_path), exist_ok=True)
+        os.rename(old_path, new_path)
+    return True
+
+
+def migrate_cache(dry_run: bool) -> int:
+    """Move flat cache/<digest> directories into the fan-out layout"""
+    if not os.path.isdir(util.CACHE_DIR):
+        return 0
+    moved = 0
+    for name in os.listdir(util.CACHE_DIR):
+        old_path = os.path.join(util.CACHE_DIR, name)
+        if not DIGEST_PATTERN.match(name) or not os.path.isdir(old_path):
+            continue
+        new_path = os.path.join(util.CACHE_DIR, name[:2], name[2:4], name)
+        moved += move(old_path, new_path, dry_run)
+    return moved
+
+
+def read_tag_srcs(tags_path: str) -> list[str]:
+    if not os.path.exists(tags_path):
+        return []
+    with open(tags_path, "r") as f:
+        return [tag["src"] for tag in json.load(f) if tag.get("src")]
+
+
+def migrate_url_dirs(document_dir: str, dry_run: bool) -> dict:
+    """Rename the frame and banner directories of a document, then those of its frames
+    Returns {old path: new path} of the renamed directories
+    """
+    renames = {}
+    for subdir, tags_filename in URL_SUBDIRS.items():
+        parent_dir = os.path.join(document_dir, subdir)
+        if not os.path.isdir(parent_dir):
+            continue
+        # The old names of the URLs in the tags of the document
+        srcs_by_name = {}
+        for src in read_tag_srcs(os.path.join(document_dir, tags_filename)):
+            srcs_by_name.setdefault(util.url_to_filename(src), set()).add(src)
+
+        for name in os.listdir(parent_dir):
+            srcs = srcs_by_name.get(name, set())
+            if len(srcs) != 1:
+                if len(srcs) > 1:
+                    print(
+                        f"  Skipping {os.path.join(parent_dir, name)}: shared by {len(srcs)} URLs"
+                    )
+                continue
+            src = srcs.pop()
+            old_path = os.path.join(parent_dir, name)
+            new_path = os.path.join(parent_dir, util.url_to_dirname(src))
+            if move(old_path, new_path, dry_run):
+                renames[old_path] = new_path
+                if not dry_run:
+                    util.save_url_sidecar(new_path, src)
+
+    # Frames hold frames and banners of their own
+    frames_dir = os.path.join(document_dir, "frames")
+    if os.path.isdir(frames_dir):
+        for name in os.listdir(frames_dir):
+            renames.update(migrate_url_dirs(os.path.join(frames_dir, name), dry_run))
+    return renames
+
+
+def rewrite_frame_tree(snapshot_dir: str, renames: dict):
+    """Point the frame_dir of every node of frame_tree.json to the renamed directories"""
+    frame_tree_path = os.path.join(snapshot_dir, "frame_tree.json")
+    if not renames or not os.path.exists(frame_tree_path):
+        return
+    with open(frame_tree_path, "r") as f:
+        root = json.load(f)
+    nodes = list(root["children"])
+    while nodes:
+        node = nodes.pop()
+        nodes += node["children"]
+        if "frame_dir" not in node:
+            continue
+        # Parents were renamed before their children, so rename one level at a time
+        path = snapshot_dir
+        for part in node["frame_dir"].split(os.sep):
+            path = renames.get(os.path.join(path, part), os.path.join(path, part))
+        node["frame_dir"] = os.path.relpath(path, snapshot_dir)
+    util.atomic_write_json(frame_tree_path, root, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args()
+
+    moved = migrate_cache(args.dry_run)
+    print(f"Moved {moved} cache directories")
+
+    renamed = 0
+    for entry in util.retrieve_saved_website_entries():
+        renames = migrate_url_dirs(entry["snapshot_dir"], args.dry_run)
+        if not args.dry_run:
+            rewrite_frame_tree(entry["snapshot_dir"], renames)
+        renamed += len(renames)
+    print(f"Renamed {renamed} frame and banner directories")
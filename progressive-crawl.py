@@ -0,0 +1,89 @@
+"""Run the whole pipeline on a coarse sample of the snapshots first, then backfill.
+
+    python progressive-crawl.py
+    WAYBACK_SAMPLING_PASSES=day,hour python progressive-crawl.py
+
+Stage 1 must have run. The snapshots are split into progressively denser
+passes (by default one per website per day, then one per hour, then all the
+others, see scheduler.py). Each pass runs stages 2-6 on its new snapshots,
+then rewrites banner-ads-summary.csv (stage 7) and gallery.html (stage 8), so
+both are usable after the first pass and complete after the last one. Work
+done by an earlier (or interrupted) run is skipped, as in the numbered scripts.
+"""
+
+import os, sys, subprocess
+import util, stages, journal, scheduler
+
+
+def run_pass(website_entries: list[dict]):
+    """Run stages 2-6 on the given website entries"""
+    plans = stages.plan_snapshot_downloads(website_entries)
+    schedule = scheduler.plan_downloads(
+        [plan for plan in plans if stages.pending_snapshot_entries(plan)],
+        stages.snapshot_plan_bytes,
+    )
+    print(f"  Stage 2: {scheduler.describe_plan(schedule)}")
+    for plan in schedule["scheduled"]:
+        if scheduler.budget_spent():
+            print("    Byte budget spent, the other digests are left for the next run")
+            break
+        try:
+            stages.download_snapshot_group(plan)
+        except Exception as e:
+            print(
+                f"    Error downloading {plan['entries'][0]['cdx_entry']['timestamp']}: {e}"
+            )
+
+    print("  Stages 3 and 4: frames")
+    for entry in website_entries:
+        stages.detect_frame_tags(entry)
+        stages.resolve_frame_tree(entry)
+
+    print("  Stage 5: image tags")
+    for entry in util.retrieve_saved_website_and_frame_entries(website_entries):
+        stages.detect_image_tags(entry)
+
+    image_tags = util.retrieve_saved_image_tags_with_parent_info(website_entries)
+    print(f"  Stage 6: {len(image_tags)} image tags")
+    for image_tag_with_parent_info in image_tags:
+        try:
+            stages.download_banner(image_tag_with_parent_info)
+        except Exception as e:
+            image_tag_src = image_tag_with_parent_info["image_tag"].get("src")
+            cdx_entry = image_tag_with_parent_info["cdx_entry"]
+            print(
+                f"    Error downloading {image_tag_src} at {cdx_entry['timestamp']}: {e}"
+            )
+
+
+def publish():
+    """Rewrite the summary CSV and the gallery from everything downloaded so far"""
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    env = {**os.environ, "WAYBACK_GALLERY_CSV": "banner-ads-summary.csv"}
+    for script in ["7-summarize-banner-ads.py", "8-generate-gallery.py"]:
+        subprocess.run(
+            [sys.executable, os.path.join(script_dir, script)], env=env, check=True
+        )
+
+
+# Remove half-written snapshots left behind by a crash, so they are downloaded again
+journal.recover_journal()
+
+all_website_entries = util.retrieve_saved_website_entries()
+passes = scheduler.sampling_passes(all_website_entries)
+print(
+    f"Found {len(all_website_entries)} snapshots in {len(passes)} passes: "
+    + ", ".join(f"{len(p['entries'])} ({p['granularity']})" for p in passes)
+)
+
+done = 0
+for number, sampling_pass in enumerate(passes, start=1):
+    done += len(sampling_pass["entries"])
+    print(
+        f"Pass {number}/{len(passes)}: one snapshot per website per {sampling_pass['granularity']}"
+        if sampling_pass["granularity"] != "all"
+        else f"Pass {number}/{len(passes)}: all remaining snapshots"
+    )
+    run_pass(sampling_pass["entries"])
+    publish()
+    print(f"Pass {number} done: {done} of {len(all_website_entries)} snapshots")
@@ -0,0 +1,234 @@
+"""Plan downloads by size against a byte budget and a transfer rate.
+
+Every CDX entry has a length field (the size of the compressed capture in
+the Wayback Machine, a rough estimate of the payload size). Stage 2 uses it
+to fetch many small items first, for fast coverage, and stages 2, 4 and 6 use
+it to defer items above a size cap. The byte budget and the rate are charged
+with the bytes actually received (see charge), across the downloads of
+stages 2, 4 and 6 in this process, and the stages stop downloading once the
+budget is spent, so that a long crawl can be run in slices: each rerun skips
+what is already saved.
+
+- WAYBACK_BYTE_BUDGET: bytes to download in this run, e.g. 500MB (default unlimited)
+- WAYBACK_MAX_ITEM_BYTES: defer items larger than this, e.g. 2MB (default unlimited)
+- WAYBACK_RATE: average download rate to keep to, e.g. 200KB per second (default unlimited)
+
+For a first look at a new study, sampling_passes splits the snapshots into
+progressively denser passes (by default one snapshot per website per day,
+then per hour, then all of them; see WAYBACK_SAMPLING_PASSES), which
+progressive-crawl.py runs through every stage one pass at a time.
+"""
+
+import os, re, time, threading
+
+SIZE_UNITS = {"": 1, "B": 1, "KB": 1024, "MB": 1024**2, "GB": 1024**3, "TB": 1024**4}
+
+
+def parse_size(value: str | None) -> int | None:
+    """Parse a size such as 1500, 200KB or 1.5GB into bytes (None stays None)"""
+    if not value:
+        return None
+    match = re.fullmatch(r"\s*([\d.]+)\s*([KMGT]?B?)\s*", value.upper())
+    if not match:
+        raise ValueError(f"Invalid size: {value}")
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2)])
+
+
+def format_size(num_bytes: float) -> str:
+    for unit in ["B", "KB", "MB", "GB"]:
+        if abs(num_bytes) < 1024:
+            return f"{num_bytes:.1f} {unit}"
+        num_bytes /= 1024
+    return f"{num_bytes:.1f} TB"
+
+
+def format_duration(seconds: float) -> str:
+    seconds = int(seconds)
+    hours, rest = divmod(seconds, 3600)
+    minutes, seconds = divmod(rest, 60)
+    return (
+        f"{hours}h{minutes:02d}m{seconds:02d}s"
+        if hours
+        else f"{minutes}m{seconds:02d}s"
+    )
+
+
+BYTE_BUDGET = parse_size(os.environ.get("WAYBACK_BYTE_BUDGET"))
+MAX_ITEM_BYTES = parse_size(os.environ.get("WAYBACK_MAX_ITEM_BYTES"))
+RATE = parse_size(os.environ.get("WAYBACK_RATE"))
+
+# Length of the timestamp prefix that snapshots are grouped by in each sampling granularity
+SAMPLING_GRANULARITIES = {"year": 4, "month": 6, "day": 8, "hour": 10, "all": 14}
+SAMPLING_PASSES = os.environ.get("WAYBACK_SAMPLING_PASSES", "day,hour,all").split(",")
+for granularity in SAMPLING_PASSES:
+    if granularity not in SAMPLING_GRANULARITIES:
+        raise ValueError(
+            f"WAYBACK_SAMPLING_PASSES must list {', '.join(SAMPLING_GRANULARITIES)}, not {granularity}"
+        )
+
+
+def cdx_length(cdx_entry: dict) -> int:
+    """The length field of a CDX entry, 0 if unknown ("-")"""
+    return int(cdx_entry["length"]) if cdx_entry["length"].isdigit() else 0
+
+
+def plan_downloads(
+    items: list,
+    item_bytes,
+    max_item_bytes: int | None = MAX_ITEM_BYTES,
+) -> dict:
+    """Order items smallest first and set aside those above a size cap
+    item_bytes is a function returning the estimated size of an item. The byte budget
+    is not applied here, but to the bytes actually received (see budget_spent)
+    Returns a dict with the following keys:
+    - scheduled: the items to download in this run, smallest first
+    - deferred: the items above max_item_bytes
+    - scheduled_bytes: the estimated size of the scheduled items
+    """
+    scheduled, deferred = [], []
+    scheduled_bytes = 0
+    for item in sorted(items, key=item_bytes):
+        size = item_bytes(item)
+        if max_item_bytes is not None and size > max_item_bytes:
+            deferred.append(item)
+        else:
+            scheduled.append(item)
+            scheduled_bytes += size
+    return {
+        "scheduled": scheduled,
+        "deferred": deferred,
+        "scheduled_bytes": scheduled_bytes,
+    }
+
+
+def describe_plan(
+    plan: dict, budget: int | None = BYTE_BUDGET, rate: int | None = RATE
+) -> str:
+    """One line summary of a plan, with the projected time at the given rate"""
+    summary = (
+        f"Scheduled {len(plan['scheduled'])} downloads"
+        f" ({format_size(plan['scheduled_bytes'])} by CDX length)"
+        f", deferred {len(plan['deferred'])} above the size cap"
+    )
+    if budget is not None:
+        summary += f", byte budget {format_size(budget)}"
+    if rate:
+        projected_bytes = plan["scheduled_bytes"]
+        if budget is not None:
+            projected_bytes = min(projected_bytes, budget)
+        summary += f", projected {format_duration(projected_bytes / rate)}"
+    return summary
+
+
+def rate_limiter(rate: int | None = RATE):
+    """Return a function to call with the bytes of each download, which sleeps as
+    needed to keep the average rate at or below rate bytes per second
+    """
+    lock = threading.Lock()
+    state = {"start": time.monotonic(), "bytes": 0}
+
+    def throttle(num_bytes: int):
+        if not rate:
+            return
+        with lock:
+            state["bytes"] += num_bytes
+            ahead = state["bytes"] / rate - (time.monotonic() - state["start"])
+        if ahead > 0:
+            time.sleep(ahead)
+
+    return throttle
+
+
+# Keeps the downloads of stages 2, 4 and 6 in this process to WAYBACK_RATE
+throttle = rate_limiter()
+
+# Bytes received by the downloads of this process, which WAYBACK_BYTE_BUDGET caps
+received = {"bytes": 0}
+received_lock = threading.Lock()
+
+
+def charge(num_bytes: int):
+    """Count the bytes actually received by a download against the byte budget, and
+    sleep as needed to keep to the rate
+    """
+    with received_lock:
+        received["bytes"] += num_bytes
+    throttle(num_bytes)
+
+
+def budget_spent(budget: int | None = BYTE_BUDGET) -> bool:
+    """Whether the downloads of this process have received the whole byte budget"""
+    return budget is not None and received["bytes"] >= budget
+
+
+def deferral_reason(
+    cdx_entry: dict, max_item_bytes: int | None = MAX_ITEM_BYTES
+) -> str | None:
+    """Why the download of a capture is left to a later run (above the size cap, or the
+    byte budget is spent), or None to download it now
+    """
+    if max_item_bytes is not None and cdx_length(cdx_entry) > max_item_bytes:
+        return "above WAYBACK_MAX_ITEM_BYTES"
+    if budget_spent():
+        return "WAYBACK_BYTE_BUDGET spent"
+    return None
+
+
+def progress_tracker(total_bytes: int, report_every: int = 50):
+    """Return a function to call with the bytes of each finished item, which prints
+    the progress and the projected time to complete every report_every items
+    """
+    state = {"start": time.monotonic(), "items": 0, "bytes": 0}
+
+    def track(num_bytes: int):
+        state["items"] += 1
+        state["bytes"] += num_bytes
+        if state["items"] % report_every:
+            return
+        elapsed = time.monotonic() - state["start"]
+        remaining = max(total_bytes - state["bytes"], 0)
+        eta = remaining / (state["bytes"] / elapsed) if state["bytes"] else 0
+        print(
+            f"  {state['items']} items, {format_size(state['bytes'])} of "
+            f"{format_size(total_bytes)}, about {format_duration(eta)} left"
+        )
+
+    return track
+
+
+####################
+##### SAMPLING #####
+####################
+
+
+def sample_entries(entries: list[dict], granularity: str) -> list[dict]:
+    """Keep the first website entry of each website per period (e.g. one snapshot per day)"""
+    prefix_length = SAMPLING_GRANULARITIES[granularity]
+    samples = {}
+    for entry in sorted(entries, key=lambda entry: entry["cdx_entry"]["timestamp"]):
+        period = entry["cdx_entry"]["timestamp"][:prefix_length]
+        samples.setdefault((entry["website"], period), entry)
+    return list(samples.values())
+
+
+def sampling_passes(
+    entries: list[dict], granularities: list[str] = SAMPLING_PASSES
+) -> list[dict]:
+    """Split website entries into progressively denser passes, each holding only the new entries
+    The last pass always completes the sample with every remaining entry
+    Returns a list of dicts with the following keys:
+    - granularity: the sampling granularity of the pass
+    - entries: the website entries added by the pass
+    """
+    passes = []
+    seen = set()
+    for granularity in granularities + ["all"]:
+        new_entries = [
+            entry
+            for entry in sample_entries(entries, granularity)
+            if entry["snapshot_dir"] not in seen
+        ]
+        seen.update(entry["snapshot_dir"] for entry in new_entries)
+        if new_entries:
+            passes.append({"granularity": granularity, "entries": new_entries})
+    return passes
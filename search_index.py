@@ -0,0 +1,196 @@
+"""Full-text search over the alt text, image URLs and landing pages of the banner summary.
+
+Stage 7 keeps a SQLite FTS5 index (WAYBACK_SEARCH_DB, by default
+search-index.sqlite) in step with banner-ads-summary.csv: the rows of each
+snapshot are indexed as they are summarized, only rows not indexed yet are
+added, and rows no longer in the summary are removed once it is complete.
+Set WAYBACK_SEARCH_INDEX=off to skip it.
+
+The index uses the trigram tokenizer, which needs no word segmentation and so
+works for Japanese as well as for URLs. Terms of three characters or more are
+looked up in the index; shorter terms (many Japanese words are two characters)
+are matched as substrings of the rows the longer terms found, or of every row.
+
+    python search_index.py query ソニー           # rows mentioning ソニー
+    python search_index.py query "cashnavi 当たる"  # rows matching every term
+    python search_index.py rebuild                # reindex an existing summary
+"""
+
+import os, time, sqlite3, argparse
+import summary_store
+
+SEARCH_DB = os.environ.get("WAYBACK_SEARCH_DB", "search-index.sqlite")
+SEARCH_INDEX = os.environ.get("WAYBACK_SEARCH_INDEX", "on")
+
+if SEARCH_INDEX not in ("on", "off"):
+    raise ValueError(f"WAYBACK_SEARCH_INDEX must be on or off, not {SEARCH_INDEX}")
+
+# Summary columns that are searched, then the ones only returned with the matches
+SEARCHED_COLUMNS = ["image_tag_alt_text", "original", "image_tag_full_parent_href"]
+STORED_COLUMNS = ["website", "website_timestamp", "timestamp", "digest"]
+INDEX_COLUMNS = SEARCHED_COLUMNS + STORED_COLUMNS
+
+# The trigram tokenizer cannot look up shorter terms
+MIN_INDEXED_TERM = 3
+
+
+def get_connection(db_path: str = SEARCH_DB) -> sqlite3.Connection:
+    conn = sqlite3.connect(db_path, timeout=60)
+    conn.execute("PRAGMA journal_mode=WAL")
+    # SQLite's lower() only folds ASCII letters, the trigram tokenizer folds them all
+    conn.create_function(
+        "unicode_lower", 1, lambda text: text and text.lower(), deterministic=True
+    )
+    stored = ", ".join(f"{name} UNINDEXED" for name in STORED_COLUMNS)
+    conn.execute(f"""CREATE VIRTUAL TABLE IF NOT EXISTS banners USING fts5(
+            {", ".join(SEARCHED_COLUMNS)}, {stored}, tokenize='trigram'
+        )""")
+    # The FTS5 rowid of every indexed summary row, by the values of the row
+    conn.execute("""CREATE TABLE IF NOT EXISTS indexed_rows (
+            key TEXT PRIMARY KEY,
+            banner_rowid INTEGER NOT NULL
+        )""")
+    return conn
+
+
+def row_key(row: tuple) -> str:
+    return "\x1f".join(row)
+
+
+####################
+##### INDEXING #####
+####################
+
+
+def index_batches(batches, db_path: str = SEARCH_DB):
+    """Index the rows of each batch of summary columns as it passes through to the
+    summary writer, then remove the rows that were not seen. The index changes in one
+    transaction, once every batch has been seen
+    """
+    if SEARCH_INDEX == "off":
+        yield from batches
+        return
+
+    conn = get_connection(db_path)
+    try:
+        conn.execute("BEGIN")
+        conn.execute("CREATE TEMP TABLE seen_rows (key TEXT PRIMARY KEY)")
+        for batch in batches:
+            index_batch(conn, batch)
+            yield batch
+        conn.execute(
+            "DELETE FROM banners WHERE rowid IN (SELECT banner_rowid FROM indexed_rows"
+            " WHERE key NOT IN (SELECT key FROM seen_rows))"
+        )
+        conn.execute(
+            "DELETE FROM indexed_rows WHERE key NOT IN (SELECT key FROM seen_rows)"
+        )
+        conn.commit()
+    finally:
+        conn.rollback()
+        conn.close()
+
+
+def index_batch(conn: sqlite3.Connection, batch: dict):
+    rows = zip(
+        *[
+            [summary_store.csv_text(value) for value in batch[name]]
+            for name in INDEX_COLUMNS
+        ]
+    )
+    for row in rows:
+        key = row_key(row)
+        conn.execute("INSERT OR IGNORE INTO seen_rows VALUES (?)", (key,))
+        if conn.execute("SELECT 1 FROM indexed_rows WHERE key = ?", (key,)).fetchone():
+            continue
+        cursor = conn.execute(
+            f"INSERT INTO banners ({', '.join(INDEX_COLUMNS)}) VALUES ({', '.join('?' * len(row))})",
+            row,
+        )
+        conn.execute("INSERT INTO indexed_rows VALUES (?, ?)", (key, cursor.lastrowid))
+
+
+def rebuild(
+    summary_path: str = summary_store.SUMMARY_CSV, db_path: str = SEARCH_DB
+) -> int:
+    """Index an existing summary (CSV or Parquet), e.g. one written before the index existed
+    Returns the number of indexed rows
+    """
+    columns = summary_store.read_columns(summary_path, INDEX_COLUMNS)
+    for batch in index_batches([columns], db_path):
+        pass
+    return len(columns["digest"])
+
+
+##################
+##### SEARCH #####
+##################
+
+
+def quote_term(term: str) -> str:
+    """An FTS5 string matching the term literally"""
+    return '"' + term.replace('"', '""') + '"'
+
+
+def search(query: str, limit: int = 50, db_path: str = SEARCH_DB) -> list[dict]:
+    """The rows matching every whitespace-separated term of the query, best matches first
+    Returns a list of dicts with the keys of INDEX_COLUMNS
+    """
+    terms = query.split()
+    if not terms:
+        return []
+    indexed_terms = [term for term in terms if len(term) >= MIN_INDEXED_TERM]
+    short_terms = [term for term in terms if len(term) < MIN_INDEXED_TERM]
+
+    conditions, params = [], []
+    if indexed_terms:
+        conditions.append("banners MATCH ?")
+        params.append(" AND ".join(quote_term(term) for term in indexed_terms))
+    # Case-insensitive, like the trigram tokenizer
+    for term in short_terms:
+        conditions.append(
+            "("
+            + " OR ".join(
+                f"instr(unicode_lower({name}), ?) > 0" for name in SEARCHED_COLUMNS
+            )
+            + ")"
+        )
+        params += [term.lower()] * len(SEARCHED_COLUMNS)
+    order_by = "ORDER BY rank" if indexed_terms else "ORDER BY rowid"
+
+    conn = get_connection(db_path)
+    try:
+        rows = conn.execute(
+            f"SELECT {', '.join(INDEX_COLUMNS)} FROM banners"
+            f" WHERE {' AND '.join(conditions)} {order_by} LIMIT ?",
+            params + [limit],
+        ).fetchall()
+    finally:
+        conn.close()
+    return [dict(zip(INDEX_COLUMNS, row)) for row in rows]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    query_parser = subparsers.add_parser("query", help="search the index")
+    query_parser.add_argument("query")
+    query_parser.add_argument("--limit", type=int, default=50)
+    rebuild_parser = subparsers.add_parser("rebuild", help="index an existing summary")
+    rebuild_parser.add_argument("--summary", default=summary_store.SUMMARY_CSV)
+    args = parser.parse_args()
+
+    if args.command == "rebuild":
+        print(f"Indexed {rebuild(args.summary)} rows of {args.summary}")
+    else:
+        start = time.perf_counter()
+        matches = search(args.query, args.limit)
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        for match in matches:
+            print(
+                f"{match['website']} {match['website_timestamp']} {match['digest']}\n"
+                f"  alt: {match['image_tag_alt_text']}\n"
+                f"  image: {match['original']}\n"
+                f"  link: {match['image_tag_full_parent_href']}"
+            )
+        print(f"{len(matches)} matches in {elapsed_ms:.1f} ms")
@@ -0,0 +1,802 @@
+"""One function per unit of work of the numbered scripts (stages 1-6).
+
+The numbered scripts loop over these functions; the work queue in
+workqueue.py calls the same functions so that a crawl can be split across
+several worker processes or hosts.
+"""
+
+import os, json, csv
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+import util, journal, metrics, tracing, scheduler, ad_scanner
+
+CATEGORY_OF_INTEREST = ["portal", "content"]
+
+# How deep stage 4 follows frames and iframes nested in frames, and how many it fetches at once
+FRAME_MAX_DEPTH = int(os.environ.get("WAYBACK_FRAME_DEPTH", "3"))
+FRAME_CONCURRENCY = int(os.environ.get("WAYBACK_FRAME_CONCURRENCY", "4"))
+
+# Stage 6 probe mode: "off" trusts the width and height attributes of the image tags,
+# "on" checks the real dimensions of banner-sized images with a Range request before
+# downloading them, "missing" also probes the images whose tags have no width or height
+BANNER_PROBE = os.environ.get("WAYBACK_BANNER_PROBE", "off")
+if BANNER_PROBE not in ("off", "on", "missing"):
+    raise ValueError(
+        f"WAYBACK_BANNER_PROBE must be off, on or missing, not {BANNER_PROBE}"
+    )
+
+
+###################
+##### STAGE 1 #####
+###################
+
+
+def read_seed_websites(
+    seed_csv: str = "nikkeibp-may2000.csv",
+    categories: list[str] = CATEGORY_OF_INTEREST,
+) -> list[str]:
+    """Read the Japanese websites of the given categories from a seed list CSV"""
+    websites = []
+    with open(seed_csv, "r") as file:
+        reader = csv.DictReader(file)
+        for row in reader:
+            if row.get("is_japanese") == "true" and row.get("category") in categories:
+                websites.append(row["website"])
+    return websites
+
+
+@metrics.stage_item("website")
+def query_website(
+    website: str,
+    from_time: str = util.DEFAULT_FROM_TIME,
+    to_time: str = util.DEFAULT_TO_TIME,
+) -> list[dict]:
+    """Query the CDX API for a website and create one folder per snapshot
+    Returns the created website entries (same keys as util.retrieve_saved_website_entries)
+    """
+    util.log(f"Querying CDX for {website}")
+
+    website_dir = os.path.join(util.OUTPUT_DIR, website)
+    if os.path.exists(website_dir):
+        util.log("  Skipping - folder already exists")
+        return []
+
+    cdx_entries = util.query_wm_cdx_entries(website, from_time, to_time)
+
+    util.log(f"  Found {len(cdx_entries)} CDX entries")
+
+    return save_website_entries(website, cdx_entries)
+
+
+def save_website_entries(website: str, cdx_entries: list[dict]) -> list[dict]:
+    """Create one folder per snapshot of a website, holding its CDX entry
+    Returns the created website entries (same keys as util.retrieve_saved_website_entries)
+    """
+    website_dir = os.path.join(util.OUTPUT_DIR, website)
+
+    # Create folder structure for all entries of this website
+    website_entries = []
+    with journal.journaled_unit("website", website, [website_dir]):
+        os.makedirs(website_dir, exist_ok=True)
+        for cdx_entry in cdx_entries:
+            website_timestamp_dir = os.path.join(website_dir, cdx_entry["timestamp"])
+            os.makedirs(website_timestamp_dir, exist_ok=True)
+
+            cdx_entry_path = os.path.join(website_timestamp_dir, "cdx_entry.json")
+            util.atomic_write_json(cdx_entry_path, cdx_entry, indent=2)
+
+            website_entries.append(
+                {
+                    "website": website,
+                    "snapshot_dir": website_timestamp_dir,
+                    "cdx_entry": cdx_entry,
+                }
+            )
+
+    if website_entries:
+        util.log(f"  Created {len(website_entries)} snapshot entry folders")
+    return website_entries
+
+
+# Seeds per domain query, so that the urlkey filter keeps the query URL short
+MAX_SEEDS_PER_QUERY = 50
+
+
+def group_websites_by_domain(websites: list[str]) -> list[tuple[str, list[str]]]:
+    """Group websites by registered domain, in batches of at most MAX_SEEDS_PER_QUERY
+    Returns a list of (domain, websites) pairs, one per domain query
+    """
+    websites_by_domain = {}
+    for website in websites:
+        websites_by_domain.setdefault(util.registered_domain(website), []).append(
+            website
+        )
+    groups = []
+    for domain, domain_websites in websites_by_domain.items():
+        for i in range(0, len(domain_websites), MAX_SEEDS_PER_QUERY):
+            groups.append((domain, domain_websites[i : i + MAX_SEEDS_PER_QUERY]))
+    return groups
+
+
+@metrics.stage_item("domain")
+def query_domain(
+    domain: str,
+    websites: list[str],
+    from_time: str = util.DEFAULT_FROM_TIME,
+    to_time: str = util.DEFAULT_TO_TIME,
+    collapse: str | None = None,
+) -> dict:
+    """Query the CDX API once for the websites of a domain that have no folder yet
+    Returns a dict of {website: CDX entries}
+    """
+    websites = [
+        website
+        for website in websites
+        if not os.path.exists(os.path.join(util.OUTPUT_DIR, website))
+    ]
+    if not websites:
+        return {}
+
+    urlkey_websites = {}
+    for website in websites:
+        urlkey_websites.setdefault(util.surt_urlkey(website), []).append(website)
+
+    util.log(f"Querying CDX for {domain} ({len(websites)} websites)")
+    cdx_entries = util.query_wm_cdx_domain_entries(
+        domain, list(urlkey_websites), from_time, to_time, collapse
+    )
+    util.log(f"  Found {len(cdx_entries)} CDX entries")
+
+    cdx_entries_by_website = {website: [] for website in websites}
+    for cdx_entry in cdx_entries:
+        for website in urlkey_websites.get(cdx_entry["urlkey"], []):
+            cdx_entries_by_website[website].append(cdx_entry)
+    return cdx_entries_by_website
+
+
+###################
+##### STAGE 2 #####
+###################
+
+
+@metrics.stage_item("snapshot")
+def download_snapshot(entry: dict):
+    """Download a website snapshot, or copy it from the cache (stage 2)"""
+    snapshot_dir = entry["snapshot_dir"]
+    cdx_entry = entry["cdx_entry"]
+
+    # Check if snapshot has already been downloaded
+    if journal.is_committed("snapshot", snapshot_dir) or util.has_website_snapshot(
+        snapshot_dir, cdx_entry["digest"]
+    ):
+        util.log(f"  Skipping {cdx_entry['timestamp']} - already downloaded")
+        return
+
+    fetch_website_snapshot("snapshot", snapshot_dir, cdx_entry)
+
+
+class CacheMiss(Exception):
+    """Aborts the journaled copy of a snapshot that is not (or no longer) in the cache,
+    so that its partial copies are removed and the unit is not committed
+    """
+
+
+def fetch_website_snapshot(
+    stage: str,
+    snapshot_dir: str,
+    cdx_entry: dict,
+    fallback_cdx_entries: list[dict] | None = None,
+) -> int:
+    """Copy a website snapshot from the cache, or download it and add it to the cache
+    Both are journaled, so that a crash never leaves a half-written snapshot behind
+    If the download fails, the fallback captures (with the same digest) are tried in turn
+    Returns the number of bytes downloaded (0 if the snapshot came from the cache)
+    """
+    fallback_cdx_entries = fallback_cdx_entries or []
+    snapshot_paths = util.website_snapshot_paths(snapshot_dir, cdx_entry["digest"])
+
+    # Check if snapshot has already been cached
+    cache_snapshot_dir = util.cache_snapshot_dir(cdx_entry["digest"])
+    found_in_cache = False
+    if os.path.isdir(cache_snapshot_dir):
+        try:
+            with journal.journaled_unit(stage, snapshot_dir, snapshot_paths):
+                if not util.find_and_copy_cached_snapshot(
+                    cache_snapshot_dir, snapshot_dir
+                ):
+                    raise CacheMiss()
+            found_in_cache = True
+        except CacheMiss:
+            pass
+    if found_in_cache:
+        util.log(f"  Loaded from cache {cdx_entry['timestamp']}, skipping")
+        return 0
+
+    for i, candidate in enumerate([cdx_entry] + fallback_cdx_entries):
+        util.log(f"  Downloading snapshot from {candidate['timestamp']}")
+        try:
+            snapshot = util.download_website_snapshot(candidate)
+            break
+        except Exception as e:
+            if i == len(fallback_cdx_entries):
+                raise
+            util.log(f"    Error downloading {candidate['timestamp']}: {e}")
+
+    cache_paths = util.website_snapshot_paths(cache_snapshot_dir, cdx_entry["digest"])
+    with journal.journaled_unit(stage, snapshot_dir, snapshot_paths + cache_paths):
+        util.save_website_snapshot(snapshot, snapshot_dir)
+        util.save_website_snapshot(snapshot, cache_snapshot_dir)
+    util.log(f"    Saved snapshot to {snapshot_dir}")
+    return len(snapshot["file"])
+
+
+def capture_reliability(cdx_entry: dict) -> tuple:
+    """Sort key putting the captures most likely to replay correctly first"""
+    return (
+        cdx_entry["statuscode"] != "200",
+        cdx_entry["mimetype"] == "warc/revisit",
+        cdx_entry["timestamp"],
+    )
+
+
+def plan_snapshot_downloads(entries: list[dict]) -> list[dict]:
+    """Group the snapshot entries of stage 2 by digest, so that each payload is fetched once
+    Returns a list of dicts (most shared digests first) with the following keys:
+    - digest: the digest shared by the entries
+    - entries: the website entries with this digest, most reliable capture first
+    """
+    entries_by_digest = {}
+    for entry in entries:
+        entries_by_digest.setdefault(entry["cdx_entry"]["digest"], []).append(entry)
+    plans = [
+        {
+            "digest": digest,
+            "entries": sorted(
+                digest_entries,
+                key=lambda entry: capture_reliability(entry["cdx_entry"]),
+            ),
+        }
+        for digest, digest_entries in entries_by_digest.items()
+    ]
+    plans.sort(key=lambda plan: len(plan["entries"]), reverse=True)
+    return plans
+
+
+def pending_snapshot_entries(plan: dict) -> list[dict]:
+    """The entries of a download plan whose snapshot is not saved yet"""
+    return [
+        entry
+        for entry in plan["entries"]
+        if not journal.is_committed("snapshot", entry["snapshot_dir"])
+        and not util.has_website_snapshot(entry["snapshot_dir"], plan["digest"])
+    ]
+
+
+def snapshot_plan_bytes(plan: dict) -> int:
+    """The estimated download size of a plan, from the CDX length of its first capture"""
+    return scheduler.cdx_length(plan["entries"][0]["cdx_entry"])
+
+
+@metrics.stage_item("snapshot_digest")
+def download_snapshot_group(plan: dict) -> dict:
+    """Fetch the payload of a digest once and materialize every snapshot sharing it (stage 2)
+    Returns a dict with the following keys:
+    - snapshots: the number of snapshots that were missing
+    - downloaded_bytes: the bytes downloaded for them
+    - saved_bytes: the bytes that downloading every snapshot separately would have added
+    """
+    pending = pending_snapshot_entries(plan)
+    if not pending:
+        return {"snapshots": 0, "downloaded_bytes": 0, "saved_bytes": 0}
+
+    cdx_entries = [entry["cdx_entry"] for entry in plan["entries"]]
+    downloaded_bytes = 0
+    for entry in pending:
+        # With the WARC backend, the first download already stored the payload for all of them
+        if util.has_website_snapshot(entry["snapshot_dir"], plan["digest"]):
+            continue
+        # Only the first snapshot can need a download, the others come from the cache
+        downloaded_bytes += fetch_website_snapshot(
+            "snapshot", entry["snapshot_dir"], cdx_entries[0], cdx_entries[1:]
+        )
+
+    cached_html_path = os.path.join(
+        util.cache_snapshot_dir(plan["digest"]), f"{plan['digest']}.html"
+    )
+    if downloaded_bytes:
+        payload_bytes = downloaded_bytes
+    elif os.path.exists(cached_html_path):
+        payload_bytes = os.path.getsize(cached_html_path)
+    else:
+        payload_bytes = int(cdx_entries[0]["length"])
+    saved_bytes = payload_bytes * len(pending) - downloaded_bytes
+    metrics.inc("snapshot_bytes_saved_total", saved_bytes)
+    return {
+        "snapshots": len(pending),
+        "downloaded_bytes": downloaded_bytes,
+        "saved_bytes": saved_bytes,
+    }
+
+
+###################
+##### STAGE 3 #####
+###################
+
+
+def parse_tags(snapshot_dir: str, digest: str, kind: str) -> list[dict] | None:
+    """The frame or image tags ("frame_tags" or "image_tags") of a saved website or frame snapshot
+    A payload is parsed once per digest, however many snapshots share it (see util.read_parse_memo)
+    Returns None if the snapshot has not been downloaded
+    """
+    from bs4 import BeautifulSoup
+
+    if not util.has_website_snapshot(snapshot_dir, digest):
+        return None
+    tags = util.read_parse_memo(digest, kind)
+    if tags is None:
+        html = util.read_website_snapshot_utf8(snapshot_dir, digest)
+        if html is None:
+            return None
+        with tracing.span("parse_html", "parse", digest=digest):
+            soup = BeautifulSoup(html, "html.parser")
+        if kind == "frame_tags":
+            tags = util.extract_frame_tag_attrs(soup)
+        else:
+            tags = util.extract_image_tag_attrs(soup)
+        util.write_parse_memo(digest, kind, tags)
+    return tags
+
+
+@metrics.stage_item("frame_tags")
+def detect_frame_tags(entry: dict) -> list[dict]:
+    """Detect and save the frame tags of a downloaded website snapshot (stage 3)
+    Returns the frame tags with parent info (same keys as util.retrieve_saved_frame_tags_with_parent_info)
+    """
+    snapshot_dir = entry["snapshot_dir"]
+    cdx_entry = entry["cdx_entry"]
+
+    util.log(f"{entry['website']} at {cdx_entry['timestamp']}")
+
+    # Check if snapshot has already been downloaded
+    frame_tags = parse_tags(snapshot_dir, cdx_entry["digest"], "frame_tags")
+    if frame_tags is None:
+        util.log(f"  Skipping {cdx_entry['timestamp']} - not downloaded")
+        return []
+
+    util.atomic_write_json(os.path.join(snapshot_dir, "frame_tags.json"), frame_tags)
+    util.log(f"  Found {len(frame_tags)} frame tags")
+
+    return [
+        {
+            "website_dir": snapshot_dir,
+            "website": entry["website"],
+            "parent_cdx_entry": cdx_entry,
+            "frame_tag": frame_tag,
+        }
+        for frame_tag in frame_tags
+    ]
+
+
+###################
+##### STAGE 4 #####
+###################
+
+
+def frame_snapshot_dir(frame_tag_with_parent_info: dict) -> str:
+    """The directory a frame tag is downloaded to"""
+    return util.url_dir(
+        os.path.join(frame_tag_with_parent_info["website_dir"], "frames"),
+        frame_tag_with_parent_info["frame_tag"]["src"],
+    )
+
+
+def frame_url(frame_tag_with_parent_info: dict) -> str:
+    """The URL of a frame, resolved against the URL of the document containing it"""
+    frame_tag_src = frame_tag_with_parent_info["frame_tag"]["src"].strip()
+    # If frame tag src is a full URL, use it as is, else join with original URL
+    if frame_tag_src.startswith("http"):
+        return frame_tag_src
+    return urllib.parse.urljoin(
+        frame_tag_with_parent_info["parent_cdx_entry"]["original"], frame_tag_src
+    )
+
+
+@metrics.stage_item("frame")
+def download_frame(frame_tag_with_parent_info: dict) -> dict | None:
+    """Find the closest capture of a frame and download it, or copy it from the cache (stage 4)
+    Returns the frame entry (same keys as util.retrieve_saved_website_and_frame_entries),
+    or None if the frame has no usable capture
+    """
+    frame_tag = frame_tag_with_parent_info["frame_tag"]
+    website = frame_tag_with_parent_info["website"]
+    cdx_entry = frame_tag_with_parent_info["parent_cdx_entry"]
+
+    util.log(f"Parent: {website} at {cdx_entry['timestamp']}")
+    frame_tag_src = frame_tag["src"]
+    util.log(f"    Frame src: {frame_tag_src}")
+
+    actual_frame_url = frame_url(frame_tag_with_parent_info)
+
+    frame_dir = frame_snapshot_dir(frame_tag_with_parent_info)
+    os.makedirs(frame_dir, exist_ok=True)
+    util.save_url_sidecar(frame_dir, frame_tag_src)
+
+    # Check if CDX entry already exists, if not, query CDX
+    frame_cdx_entry_path = os.path.join(frame_dir, "cdx_entry.json")
+    if os.path.exists(frame_cdx_entry_path):
+        with open(frame_cdx_entry_path, "r") as f:
+            frame_cdx_entry = json.load(f)
+        util.log(f"        Found CDX entry for {frame_tag_src}")
+    else:
+        util.log(
+            f"        Querying CDX for {actual_frame_url} at {cdx_entry['timestamp']}"
+        )
+        frame_cdx_entry = util.query_wm_cdx_closest_entry(
+            actual_frame_url, cdx_entry["timestamp"]
+        )
+        util.atomic_write_json(frame_cdx_entry_path, frame_cdx_entry)
+
+    # If CDX entry is not valid, there is nothing to download
+    if not frame_cdx_entry or frame_cdx_entry["statuscode"] != "200":
+        return None
+
+    frame_entry = {
+        "website_dir": frame_dir,
+        "website": website,
+        "cdx_entry": frame_cdx_entry,
+        "type": "frame",
+    }
+
+    # Check if snapshot already exists, if not, download snapshot
+    if journal.is_committed("frame", frame_dir) or util.has_website_snapshot(
+        frame_dir, frame_cdx_entry["digest"]
+    ):
+        util.log(f"        Skipping {frame_tag_src} - already downloaded")
+        return frame_entry
+
+    # Frames share the size cap, byte budget and rate of stages 2 and 6
+    reason = scheduler.deferral_reason(frame_cdx_entry)
+    if reason:
+        util.log(f"        Deferring {frame_tag_src} - {reason}")
+        metrics.inc("downloads_deferred_total", stage="frame")
+        return None
+
+    fetch_website_snapshot("frame", frame_dir, frame_cdx_entry)
+    return frame_entry
+
+
+def frame_document(frame_entry: dict) -> dict:
+    """A downloaded frame as an entry for detect_frame_tags, to find the frames nested in it"""
+    return {
+        "snapshot_dir": frame_entry["website_dir"],
+        "website": frame_entry["website"],
+        "cdx_entry": frame_entry["cdx_entry"],
+    }
+
+
+def load_frame_tags(entry: dict) -> list[dict]:
+    """The frame tags of a document saved by stage 3, detecting them if stage 3 has not run
+    Returns the frame tags with parent info (same keys as util.retrieve_saved_frame_tags_with_parent_info)
+    """
+    frame_tags_path = os.path.join(entry["snapshot_dir"], "frame_tags.json")
+    if not os.path.exists(frame_tags_path):
+        return detect_frame_tags(entry)
+    with open(frame_tags_path, "r") as f:
+        frame_tags = json.load(f)
+    return [
+        {
+            "website_dir": entry["snapshot_dir"],
+            "website": entry["website"],
+            "parent_cdx_entry": entry["cdx_entry"],
+            "frame_tag": frame_tag,
+        }
+        for frame_tag in frame_tags
+    ]
+
+
+def download_frame_or_none(frame_tag_with_parent_info: dict) -> dict | None:
+    """download_frame, logging errors instead of raising them, so one frame cannot stop the others"""
+    try:
+        return download_frame(frame_tag_with_parent_info)
+    except Exception as e:
+        timestamp = frame_tag_with_parent_info["parent_cdx_entry"]["timestamp"]
+        print(
+            f"    Error downloading {frame_tag_with_parent_info['frame_tag']['src']} at {timestamp}: {e}"
+        )
+        return None
+
+
+def resolve_frame_tree(
+    entry: dict,
+    max_depth: int = FRAME_MAX_DEPTH,
+    concurrency: int = FRAME_CONCURRENCY,
+) -> list[dict]:
+    """Download the frames and iframes of a website snapshot, and the frames nested in them,
+    down to max_depth levels (stage 4). Each level is fetched concurrently, and a frame URL
+    or digest that was already visited in this snapshot is not followed again.
+    The tree is saved to frame_tree.json in the snapshot directory.
+    Returns the frame entries (same keys as util.retrieve_saved_website_and_frame_entries)
+    """
+    snapshot_dir = entry["snapshot_dir"]
+    root = {
+        "url": entry["cdx_entry"]["original"],
+        "digest": entry["cdx_entry"]["digest"],
+        "children": [],
+    }
+    visited_urls = {entry["cdx_entry"]["original"]}
+    visited_digests = {entry["cdx_entry"]["digest"]}
+    frame_entries = []
+
+    level = [(root, frame_tag) for frame_tag in load_frame_tags(entry)]
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for depth in range(1, max_depth + 1):
+            to_download = []
+            for parent_node, frame_tag_with_parent_info in level:
+                if not frame_tag_with_parent_info["frame_tag"].get("src"):
+                    continue
+                url = frame_url(frame_tag_with_parent_info)
+                if not url.startswith("http"):
+                    # about:blank, javascript: and the like
+                    continue
+                node = {
+                    "url": url,
+                    "tag": frame_tag_with_parent_info["frame_tag"].get(
+                        "tag_name", "frame"
+                    ),
+                    "depth": depth,
+                    "children": [],
+                }
+                parent_node["children"].append(node)
+                if url in visited_urls:
+                    node["duplicate"] = "url"
+                    continue
+                visited_urls.add(url)
+                to_download.append((node, frame_tag_with_parent_info))
+
+            frame_entries_of_level = executor.map(
+                download_frame_or_none,
+                [
+                    frame_tag_with_parent_info
+                    for _, frame_tag_with_parent_info in to_download
+                ],
+            )
+            level = []
+            for (node, frame_tag_with_parent_info), frame_entry in zip(
+                to_download, frame_entries_of_level
+            ):
+                node["frame_dir"] = os.path.relpath(
+                    frame_snapshot_dir(frame_tag_with_parent_info), snapshot_dir
+                )
+                if frame_entry is None:
+                    continue
+                frame_entries.append(frame_entry)
+                node["timestamp"] = frame_entry["cdx_entry"]["timestamp"]
+                node["digest"] = frame_entry["cdx_entry"]["digest"]
+                if node["digest"] in visited_digests:
+                    node["duplicate"] = "digest"
+                    continue
+                visited_digests.add(node["digest"])
+
+                # Frames nested in this frame make up the next level
+                if depth < max_depth:
+                    level += [
+                        (node, nested_frame_tag)
+                        for nested_frame_tag in detect_frame_tags(
+                            frame_document(frame_entry)
+                        )
+                    ]
+
+    util.atomic_write_json(
+        os.path.join(snapshot_dir, "frame_tree.json"), root, indent=2
+    )
+    return frame_entries
+
+
+###################
+##### STAGE 5 #####
+###################
+
+
+@metrics.timed("parse_duration_seconds")
+def scan_ad_candidates(
+    website_dir: str, digest: str, image_tags: list[dict]
+) -> list[dict]:
+    """The ad candidates of a saved snapshot (see ad_scanner.py) that are not the src of an image tag"""
+    payload = util.read_website_snapshot_bytes(website_dir, digest)
+    if payload is None:
+        return []
+    image_tag_srcs = {image_tag.get("src") for image_tag in image_tags}
+    return [
+        ad_candidate
+        for ad_candidate in ad_scanner.scan_ad_candidates(payload)
+        if ad_candidate["src"] not in image_tag_srcs
+    ]
+
+
+@metrics.stage_item("image_tags")
+def detect_image_tags(entry: dict) -> list[dict]:
+    """Detect and save the image tags of a downloaded website or frame snapshot (stage 5)
+    Returns the image tags with parent info (same keys as util.retrieve_saved_image_tags_with_parent_info)
+    """
+    website_dir = entry["website_dir"]
+    cdx_entry = entry["cdx_entry"]
+    util.log(f"{entry['type']} Entry at {website_dir}")
+
+    # Check if snapshot has already been downloaded
+    image_tags = parse_tags(website_dir, cdx_entry["digest"], "image_tags")
+    if image_tags is None:
+        util.log(f"      Skipping {cdx_entry['timestamp']} - not downloaded")
+        return []
+
+    # Links are resolved against the URL of this snapshot, which its digest does not cover
+    image_tags = util.resolve_image_tag_attrs(image_tags, cdx_entry)
+    util.atomic_write_json(os.path.join(website_dir, "image_tags.json"), image_tags)
+    util.log(f"      Found {len(image_tags)} image tags")
+
+    if ad_scanner.AD_SCAN == "on":
+        ad_candidates = scan_ad_candidates(website_dir, cdx_entry["digest"], image_tags)
+        util.atomic_write_json(
+            os.path.join(website_dir, "ad_candidates.json"), ad_candidates
+        )
+        util.log(f"      Found {len(ad_candidates)} ad candidates outside image tags")
+        image_tags = image_tags + ad_candidates
+
+    return [
+        {
+            "website_dir": website_dir,
+            "website": entry["website"],
+            "cdx_entry": cdx_entry,
+            "image_tag": image_tag,
+        }
+        for image_tag in image_tags
+    ]
+
+
+###################
+##### STAGE 6 #####
+###################
+
+
+def banner_snapshot_dir(image_tag_with_parent_info: dict) -> str:
+    """The directory an image tag is downloaded to"""
+    return util.url_dir(
+        os.path.join(image_tag_with_parent_info["website_dir"], "banners"),
+        image_tag_with_parent_info["image_tag"]["src"],
+    )
+
+
+@metrics.stage_item("banner")
+def download_banner(image_tag_with_parent_info: dict, probe: str = BANNER_PROBE):
+    """Find the closest capture of a banner-sized image and download it, or copy it from the cache (stage 6)
+    probe is one of the BANNER_PROBE modes
+    """
+    image_tag = image_tag_with_parent_info["image_tag"]
+    website = image_tag_with_parent_info["website"]
+    cdx_entry = image_tag_with_parent_info["cdx_entry"]
+
+    # Ad candidates found outside image tags have no size, so their real size is always probed
+    is_ad_candidate = "ad_pattern" in image_tag
+    if is_ad_candidate:
+        probe = "missing"
+
+    # Skip if it's missing src, width, or height (unless the real size is probed)
+    has_tag_size = "width" in image_tag and "height" in image_tag
+    if "src" not in image_tag or (not has_tag_size and probe != "missing"):
+        util.log(f"Skipping {website} because it doesn't have src, width, or height")
+        return
+
+    image_tag_src = image_tag["src"]
+    # If image tag src is a full URL, use it as is, else join with original URL
+    if image_tag_src.startswith("http"):
+        actual_image_url = image_tag_src
+    else:
+        actual_image_url = urllib.parse.urljoin(cdx_entry["original"], image_tag_src)
+
+    if has_tag_size:
+        width = int(image_tag["width"])
+        height = int(image_tag["height"])
+        banner_properties = util.check_banner_properties(width, height)
+
+        if not banner_properties["is_banner_ad"]:
+            util.log(
+                f"Skipping {actual_image_url} because it's not a banner ad: {width}x{height}"
+            )
+            return
+
+        util.log(f"Banner ad found: {actual_image_url} {width}x{height}")
+    elif is_ad_candidate:
+        util.log(f"Ad candidate found: {actual_image_url} ({image_tag['ad_pattern']})")
+    else:
+        util.log(f"Image without size found: {actual_image_url}")
+
+    banner_dir = banner_snapshot_dir(image_tag_with_parent_info)
+    os.makedirs(banner_dir, exist_ok=True)
+    util.save_url_sidecar(banner_dir, image_tag_src)
+
+    # Check if CDX entry already exists, if not, query CDX
+    banner_cdx_entry_path = os.path.join(banner_dir, "cdx_entry.json")
+    if os.path.exists(banner_cdx_entry_path):
+        with open(banner_cdx_entry_path, "r") as f:
+            banner_cdx_entry = json.load(f)
+        util.log(f"        Found CDX entry for {image_tag_src}")
+    else:
+        util.log(
+            f"        Querying CDX for {actual_image_url} at {cdx_entry['timestamp']}"
+        )
+        banner_cdx_entry = util.query_wm_cdx_closest_entry(
+            actual_image_url, cdx_entry["timestamp"]
+        )
+        util.atomic_write_json(banner_cdx_entry_path, banner_cdx_entry)
+
+    # If CDX entry is not valid, there is nothing to download
+    if not banner_cdx_entry or banner_cdx_entry["statuscode"] != "200":
+        return
+
+    # Ad candidates can be scripts or pages as well as creatives
+    if is_ad_candidate and not banner_cdx_entry["mimetype"].startswith("image/"):
+        util.log(f"        Skipping {image_tag_src} - {banner_cdx_entry['mimetype']}")
+        return
+
+    banner_image_tag_file_path = os.path.join(banner_dir, "image_tag_attrs.json")
+    util.atomic_write_json(banner_image_tag_file_path, image_tag)
+
+    # Check if snapshot already exists, if not, proceed
+    if util.has_image_snapshot(banner_dir, banner_cdx_entry):
+        util.log(f"        Skipping {image_tag_src} - already downloaded")
+        return
+
+    cache_banner_snapshot_dir = util.cache_snapshot_dir(banner_cdx_entry["digest"])
+    # Check if snapshot already exists in cache, if not, proceed
+    if util.find_and_copy_cached_snapshot(cache_banner_snapshot_dir, banner_dir):
+        util.log(f"        Skipping {image_tag_src} - found in cache")
+        return
+
+    reason = scheduler.deferral_reason(banner_cdx_entry)
+    if reason:
+        util.log(f"        Deferring {image_tag_src} - {reason}")
+        metrics.inc("downloads_deferred_total", stage="banner")
+        return
+
+    if probe != "off" and not probe_banner(banner_dir, banner_cdx_entry):
+        util.log(f"        Skipping {image_tag_src} - real size is not a banner size")
+        return
+
+    util.log(f"        Downloading banner {image_tag_src}")
+    banner_snapshot = util.download_image_snapshot(banner_cdx_entry)
+    util.save_image_snapshot(banner_snapshot, banner_dir)
+    util.save_image_snapshot(banner_snapshot, cache_banner_snapshot_dir)
+
+    util.log(f"        Saved banner to {banner_dir}")
+
+
+def probe_banner(banner_dir: str, banner_cdx_entry: dict) -> bool:
+    """Check the real dimensions of an image before it is downloaded
+    The result is saved to image_probe.json, so that an image is probed only once
+    Returns False only if the image is known not to have a banner size
+    """
+    probe_path = os.path.join(banner_dir, "image_probe.json")
+    if os.path.exists(probe_path):
+        with open(probe_path, "r") as f:
+            image_probe = json.load(f)
+    else:
+        dimensions = util.probe_image_dimensions(banner_cdx_entry)
+        image_probe = {"width": None, "height": None, "is_banner_ad": None}
+        if dimensions:
+            width, height = dimensions
+            image_probe = {
+                "width": width,
+                "height": height,
+                "is_banner_ad": util.check_banner_properties(width, height)[
+                    "is_banner_ad"
+                ],
+            }
+        util.atomic_write_json(probe_path, image_probe)
+        metrics.inc(
+            "banner_probes_total",
+            result={True: "banner", False: "not_banner", None: "unknown"}[
+                image_probe["is_banner_ad"]
+            ],
+        )
+
+    # Images whose size could not be read are downloaded, as without probing
+    return image_probe["is_banner_ad"] is not False
@@ -0,0 +1,302 @@
+"""Write the banner summary of stage 7 in streaming batches, and read back only the columns needed.
+
+Stage 7 hands write_summary one batch of rows per snapshot, as columns (a dict
+of lists). Each batch is written to banner-ads-summary.csv as soon as it is
+complete, and buffered into large row groups of banner-ads-summary.parquet when
+the pyarrow package is installed (WAYBACK_SUMMARY_PARQUET=off to skip it, =on
+to require it). Both files have the columns of SUMMARY_SCHEMA, in that order,
+whatever the first row holds. The derived columns (time_skew and the banner sizes of the image
+tags) are computed a whole column at a time, once per distinct value.
+
+Consumers such as 8-generate-gallery.py load only the columns they need, with
+the types of SUMMARY_SCHEMA:
+
+    rows = summary_store.read_rows("banner-ads-summary.parquet", ["digest", "website"])
+
+Requires the pyarrow package (pip install pyarrow) for Parquet only.
+"""
+
+import os, csv, calendar, functools, threading
+import util
+
+SUMMARY_CSV = "banner-ads-summary.csv"
+SUMMARY_PARQUET = "banner-ads-summary.parquet"
+SUMMARY_PARQUET_MODE = os.environ.get("WAYBACK_SUMMARY_PARQUET", "auto")
+# Rows per row group of the Parquet summary: the batches of stage 7 (one per snapshot)
+# are buffered up to this size, so that each column is stored in a few large chunks
+PARQUET_ROW_GROUP_ROWS = 65536
+
+if SUMMARY_PARQUET_MODE not in ("auto", "on", "off"):
+    raise ValueError(
+        f"WAYBACK_SUMMARY_PARQUET must be auto, on or off, not {SUMMARY_PARQUET_MODE}"
+    )
+
+# The columns of the summary and their types: the snapshot, its CDX entry, the image
+# metadata (util.get_image_metadata), then the columns derived from the image tag
+SUMMARY_SCHEMA = {
+    "website": "string",
+    "website_timestamp": "string",
+    "urlkey": "string",
+    "timestamp": "string",
+    "original": "string",
+    "mimetype": "string",
+    "statuscode": "string",
+    "digest": "string",
+    "length": "int",
+    "width": "int",
+    "height": "int",
+    "size": "int",
+    "animated": "bool",
+    "frame_count": "int",
+    "animation_duration": "int",
+    "loop_count": "int",
+    "iab_size": "string",
+    "jiaa_size": "string",
+    "corrupt": "bool",
+    "time_skew": "float",
+    "image_tag_width": "string",
+    "image_tag_height": "string",
+    "image_tag_banner_iab_size": "string",
+    "image_tag_banner_jiaa_size": "string",
+    "image_tag_parent_href": "string",
+    "image_tag_full_parent_href": "string",
+    "image_tag_alt_text": "string",
+}
+
+
+def import_pyarrow():
+    try:
+        import pyarrow, pyarrow.parquet
+    except ImportError:
+        raise ImportError(
+            "The Parquet summary needs the pyarrow package: pip install pyarrow"
+        ) from None
+    return pyarrow
+
+
+def parquet_enabled() -> bool:
+    if SUMMARY_PARQUET_MODE == "off":
+        return False
+    try:
+        import_pyarrow()
+    except ImportError:
+        if SUMMARY_PARQUET_MODE == "on":
+            raise
+        return False
+    return True
+
+
+###########################
+##### DERIVED COLUMNS #####
+###########################
+
+
+@functools.lru_cache(maxsize=None)
+def timestamp_seconds(timestamp: str) -> int:
+    """Seconds since the epoch of a YYYYMMDDhhmmss timestamp"""
+    return calendar.timegm(
+        (
+            int(timestamp[:4]),
+            int(timestamp[4:6]),
+            int(timestamp[6:8]),
+            int(timestamp[8:10]),
+            int(timestamp[10:12]),
+            int(timestamp[12:14]),
+        )
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def tag_banner_sizes(width: str | None, height: str | None) -> tuple:
+    """The IAB and JIAA banner sizes of an image tag's width and height attributes"""
+    try:
+        banner_properties = util.check_banner_properties(int(width), int(height))
+    except (TypeError, ValueError):
+        return None, None
+    return banner_properties["iab_size"], banner_properties["jiaa_size"]
+
+
+def derive_columns(batch: dict) -> dict:
+    """Add time_skew (seconds between the snapshot and its image) and the banner sizes
+    of the image tags to a batch of columns
+    """
+    batch["time_skew"] = [
+        float(timestamp_seconds(image_timestamp) - timestamp_seconds(website_timestamp))
+        for website_timestamp, image_timestamp in zip(
+            batch["website_timestamp"], batch["timestamp"]
+        )
+    ]
+    sizes = [
+        tag_banner_sizes(width, height)
+        for width, height in zip(batch["image_tag_width"], batch["image_tag_height"])
+    ]
+    batch["image_tag_banner_iab_size"] = [iab_size for iab_size, jiaa_size in sizes]
+    batch["image_tag_banner_jiaa_size"] = [jiaa_size for iab_size, jiaa_size in sizes]
+    return batch
+
+
+#################
+##### TYPES #####
+#################
+
+
+def to_int(value) -> int | None:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def to_float(value) -> float | None:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def to_bool(value) -> bool | None:
+    if value in (None, ""):
+        return None
+    return value in (True, "True")
+
+
+def to_string(value) -> str | None:
+    return None if value is None else str(value)
+
+
+CONVERTERS = {"string": to_string, "int": to_int, "float": to_float, "bool": to_bool}
+
+
+def typed_column(name: str, values: list) -> list:
+    # Columns outside the schema (from older or hand-edited summaries) are text
+    convert = CONVERTERS[SUMMARY_SCHEMA.get(name, "string")]
+    return [convert(value) for value in values]
+
+
+def csv_text(value) -> str:
+    """A value as written to the CSV summary"""
+    return "" if value is None else str(value)
+
+
+def arrow_schema():
+    pyarrow = import_pyarrow()
+    arrow_types = {
+        "string": pyarrow.string(),
+        "int": pyarrow.int64(),
+        "float": pyarrow.float64(),
+        "bool": pyarrow.bool_(),
+    }
+    return pyarrow.schema(
+        [(name, arrow_types[type]) for name, type in SUMMARY_SCHEMA.items()]
+    )
+
+
+###############################
+##### WRITING AND READING #####
+###############################
+
+
+def write_summary(
+    batches,
+    csv_path: str = SUMMARY_CSV,
+    parquet_path: str | None = SUMMARY_PARQUET,
+) -> int:
+    """Write batches of rows (dicts of columns) to the CSV summary as they come, and to
+    the Parquet summary if enabled, in row groups of PARQUET_ROW_GROUP_ROWS rows. The
+    files replace the previous ones once complete
+    Returns the number of rows
+    """
+    if parquet_path is not None and not parquet_enabled():
+        if SUMMARY_PARQUET_MODE == "auto":
+            print(
+                f"Skipping {parquet_path}: pyarrow is not installed"
+                " (pip install pyarrow, or WAYBACK_SUMMARY_PARQUET=off)"
+            )
+        parquet_path = None
+    suffix = f".tmp-{os.getpid()}-{threading.get_ident()}"
+    tmp_paths = [path + suffix for path in (csv_path, parquet_path) if path]
+
+    num_rows = 0
+    parquet_writer = None
+    # Typed columns not yet written to the Parquet summary
+    pending = {name: [] for name in SUMMARY_SCHEMA}
+
+    def write_row_group():
+        parquet_writer.write_table(
+            pyarrow.table(pending, schema=schema),
+            row_group_size=PARQUET_ROW_GROUP_ROWS,
+        )
+        for values in pending.values():
+            values.clear()
+
+    try:
+        with open(csv_path + suffix, "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            writer.writerow(SUMMARY_SCHEMA)
+            if parquet_path:
+                pyarrow = import_pyarrow()
+                schema = arrow_schema()
+                parquet_writer = pyarrow.parquet.ParquetWriter(
+                    parquet_path + suffix, schema
+                )
+            for batch in batches:
+                columns = derive_columns(batch)
+                batch_rows = len(columns["digest"])
+                if not batch_rows:
+                    continue
+                writer.writerows(
+                    zip(*[map(csv_text, columns[name]) for name in SUMMARY_SCHEMA])
+                )
+                if parquet_writer is not None:
+                    for name in SUMMARY_SCHEMA:
+                        pending[name].extend(typed_column(name, columns[name]))
+                    if len(pending["digest"]) >= PARQUET_ROW_GROUP_ROWS:
+                        write_row_group()
+                num_rows += batch_rows
+        if parquet_writer is not None:
+            if pending["digest"]:
+                write_row_group()
+            parquet_writer.close()
+            parquet_writer = None
+        for path in (csv_path, parquet_path):
+            if path:
+                os.replace(path + suffix, path)
+    except BaseException:
+        if parquet_writer is not None:
+            parquet_writer.close()
+        for tmp_path in tmp_paths:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        raise
+    return num_rows
+
+
+def read_columns(path: str, columns: list[str]) -> dict:
+    """Load only some columns of a CSV or Parquet summary
+    Values have the types of SUMMARY_SCHEMA (None for missing values): use csv_text
+    where text is needed
+    """
+    if path.endswith(".parquet"):
+        pyarrow = import_pyarrow()
+        table = pyarrow.parquet.read_table(path, columns=columns)
+        return {name: table.column(name).to_pylist() for name in columns}
+
+    with open(path, "r", encoding="utf-8") as f:
+        reader = csv.reader(f)
+        header = next(reader, [])
+        # Summaries written before a column was added read as missing values
+        indexes = [header.index(name) if name in header else None for name in columns]
+        values = [[] for name in columns]
+        for row in reader:
+            for column_values, index in zip(values, indexes):
+                column_values.append(None if index is None else row[index])
+    return {
+        name: typed_column(name, column_values)
+        for name, column_values in zip(columns, values)
+    }
+
+
+def read_rows(path: str, columns: list[str]) -> list[dict]:
+    """Load only some columns of a CSV or Parquet summary, as one dict per row"""
+    loaded = read_columns(path, columns)
+    return [dict(zip(columns, row)) for row in zip(*loaded.values())]
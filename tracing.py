@@ -0,0 +1,204 @@
+"""Tracing spans around each unit of work, and opt-in profiles of each stage.
+
+Every stage item counted by metrics.stage_item (a website, a snapshot, a
+frame, a banner...) is also a span, labelled with the website, timestamp and
+digest it works on. Inside it, the HTTP requests (per endpoint), the charset
+detection, the HTML parsing, the parse helpers timed by metrics.timed and PIL
+are spans of their own, so a slow website shows which of them took the time.
+Set the environment variables below to turn them on:
+
+- WAYBACK_TRACE: write the spans of the run to this file as Chrome trace JSON,
+  for chrome://tracing or https://ui.perfetto.dev ("{pid}" in the name is
+  replaced by the process id, for runs with several workers)
+- WAYBACK_PROFILE: cpu, memory or cpu,memory to profile each stage with
+  cProfile and/or tracemalloc
+- WAYBACK_PROFILE_DIR: where the profiles are written (default profiles), as
+  <stage>.prof (load with pstats or snakeviz) and <stage>.cpu.txt for cProfile,
+  and <stage>.tracemalloc and <stage>.memory.txt for tracemalloc
+
+cProfile only follows the main thread: the frames that stage 4 fetches in its
+thread pool appear in the trace, not in the CPU profile.
+"""
+
+import os, json, time, atexit, threading, contextlib
+
+TRACE = os.environ.get("WAYBACK_TRACE")
+PROFILE = os.environ.get("WAYBACK_PROFILE", "")
+PROFILE_DIR = os.environ.get("WAYBACK_PROFILE_DIR", "profiles")
+
+PROFILE_KINDS = set(filter(None, PROFILE.split(",")))
+if not PROFILE_KINDS <= {"cpu", "memory"}:
+    raise ValueError(
+        f"WAYBACK_PROFILE must be cpu, memory or cpu,memory, not {PROFILE}"
+    )
+
+# Lines of the text summaries written next to the profiles
+PROFILE_TOP_LINES = 40
+
+# Chrome trace events, appended from every thread (list.append is atomic)
+events = []
+# {thread id: thread name}
+thread_names = {}
+
+
+def now_us() -> int:
+    return time.perf_counter_ns() // 1000
+
+
+#################
+##### SPANS #####
+#################
+
+
+@contextlib.contextmanager
+def span(name: str, category: str = "work", **args):
+    """Record the duration of a block as a span, with args shown next to it in the trace"""
+    if not TRACE:
+        yield
+        return
+    start = now_us()
+    try:
+        yield
+    finally:
+        thread = threading.current_thread()
+        thread_names[thread.ident] = thread.name
+        events.append(
+            {
+                "name": name,
+                "cat": category,
+                "ph": "X",
+                "ts": start,
+                "dur": now_us() - start,
+                "pid": os.getpid(),
+                "tid": thread.ident,
+                "args": {key: value for key, value in args.items() if value},
+            }
+        )
+
+
+def item_keys(item) -> dict:
+    """The website, timestamp and digest of a stage item, and the src of its frame or image tag
+    Items are seed websites (str), website or frame entries (see
+    util.retrieve_saved_website_and_frame_entries), download plans of stage 2, or
+    frame and image tags with parent info
+    """
+    if isinstance(item, str):
+        return {"website": item}
+    if not isinstance(item, dict):
+        return {}
+    digest = item.get("digest")
+    if item.get("entries"):
+        item = item["entries"][0]
+    cdx_entry = item.get("cdx_entry") or item.get("parent_cdx_entry") or {}
+    tag = item.get("frame_tag") or item.get("image_tag") or {}
+    return {
+        "website": item.get("website"),
+        "timestamp": cdx_entry.get("timestamp"),
+        "digest": digest or cdx_entry.get("digest"),
+        "src": tag.get("src"),
+    }
+
+
+def export_trace(path: str | None = TRACE):
+    """Write the spans recorded so far as a Chrome trace"""
+    if not path:
+        return
+    path = path.replace("{pid}", str(os.getpid()))
+    metadata = [
+        {
+            "name": "thread_name",
+            "ph": "M",
+            "pid": os.getpid(),
+            "tid": thread_id,
+            "args": {"name": thread_name},
+        }
+        for thread_id, thread_name in list(thread_names.items())
+    ]
+    # Rename into place so a viewer never reads a partial file
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"traceEvents": metadata + events, "displayTimeUnit": "ms"}, f)
+    os.replace(tmp_path, path)
+
+
+if TRACE:
+    atexit.register(export_trace)
+
+
+####################
+##### PROFILES #####
+####################
+
+# The stage being profiled: {"name", "start", "profiler"}
+current_stage = {}
+
+
+def begin_stage(script: str):
+    """Start the span and the profiles of a stage script (its __file__ or name)
+    The stage ends with end_stage, or when the process exits
+    """
+    end_stage()
+    name = os.path.splitext(os.path.basename(script))[0]
+    current_stage.update(name=name, start=now_us(), profiler=None)
+    if "memory" in PROFILE_KINDS:
+        import tracemalloc
+
+        tracemalloc.start()
+    if "cpu" in PROFILE_KINDS:
+        import cProfile
+
+        current_stage["profiler"] = cProfile.Profile()
+        current_stage["profiler"].enable()
+
+
+def end_stage():
+    """Stop the profiles of the current stage and write them to PROFILE_DIR"""
+    if not current_stage:
+        return
+    stage = dict(current_stage)
+    current_stage.clear()
+    if TRACE:
+        main_thread = threading.main_thread()
+        thread_names[main_thread.ident] = main_thread.name
+        events.append(
+            {
+                "name": stage["name"],
+                "cat": "stage",
+                "ph": "X",
+                "ts": stage["start"],
+                "dur": now_us() - stage["start"],
+                "pid": os.getpid(),
+                "tid": main_thread.ident,
+            }
+        )
+    if PROFILE_KINDS:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+    prefix = os.path.join(PROFILE_DIR, stage["name"])
+
+    if stage["profiler"] is not None:
+        import pstats
+
+        profiler = stage["profiler"]
+        profiler.disable()
+        profiler.dump_stats(f"{prefix}.prof")
+        with open(f"{prefix}.cpu.txt", "w", encoding="utf-8") as f:
+            stats = pstats.Stats(profiler, stream=f)
+            stats.sort_stats("cumulative").print_stats(PROFILE_TOP_LINES)
+
+    if "memory" in PROFILE_KINDS:
+        import tracemalloc
+
+        if not tracemalloc.is_tracing():
+            return
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        snapshot.dump(f"{prefix}.tracemalloc")
+        with open(f"{prefix}.memory.txt", "w", encoding="utf-8") as f:
+            f.write(f"current: {current} bytes, peak: {peak} bytes\n")
+            f.write(f"top {PROFILE_TOP_LINES} lines by memory still allocated:\n")
+            for statistic in snapshot.statistics("lineno")[:PROFILE_TOP_LINES]:
+                f.write(f"{statistic}\n")
+
+
+atexit.register(end_stage)
@@ -2,15 +2,198 @@
 ##### PART 1 #####
 ##################
 
-import requests, time, tenacity
+import os, time, functools, inspect, threading
+from concurrent.futures import Future
+from typing import TYPE_CHECKING
+import metrics, tracing, http_archive, cdxj_index
+
+# requests, tenacity, bs4 and PIL are imported by the functions that use them, so that
+# the stages and commands that never use them start quickly
+if TYPE_CHECKING:
+    import requests
+    from bs4 import BeautifulSoup
+
+
+def retry(fn):
+    """Decorator retrying a function with exponential backoff
+    tenacity is imported on the first call of the function
+    In replay mode nothing is retried: a replayed error would only be replayed again
+    """
+    retrying = None
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        nonlocal retrying
+        if http_archive.HTTP_MODE == "replay":
+            return fn(*args, **kwargs)
+        if retrying is None:
+            import tenacity
+
+            retrying = tenacity.retry(
+                stop=tenacity.stop_after_attempt(10),
+                wait=tenacity.wait_exponential(multiplier=1, min=2, max=32),
+                after=lambda _: time.sleep(2),
+                before_sleep=metrics.record_retry,
+            )(fn)
+        return retrying(*args, **kwargs)
+
+    return wrapper
+
+
+def single_flight(key=None):
+    """Decorator making concurrent calls with the same key share one call and its result
+    key is a function of the arguments of the decorated function, by default all of them
+    A call that finds an identical call in flight waits for it instead of making its own,
+    and gets its result (or its exception). Calls that do not overlap are not shared.
+    """
+
+    def decorator(fn):
+        lock = threading.Lock()
+        # {key: Future} of the calls in flight
+        in_flight = {}
+        signature = inspect.signature(fn)
+
+        def arguments_key(*args, **kwargs):
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            return repr(bound.arguments)
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            flight_key = (key or arguments_key)(*args, **kwargs)
+            with lock:
+                future = in_flight.get(flight_key)
+                is_leader = future is None
+                if is_leader:
+                    future = in_flight[flight_key] = Future()
+            if not is_leader:
+                metrics.inc("coalesced_requests_total", function=fn.__name__)
+                return future.result()
+            try:
+                result = fn(*args, **kwargs)
+                future.set_result(result)
+                return result
+            except BaseException as e:
+                future.set_exception(e)
+                raise
+            finally:
+                with lock:
+                    del in_flight[flight_key]
+
+        return wrapper
 
-retry = tenacity.retry(
-    stop=tenacity.stop_after_attempt(10),
-    wait=tenacity.wait_exponential(multiplier=1, min=2, max=32),
-    after=lambda _: time.sleep(2),
-)
+    return decorator
 
 
+# Per-item progress lines; set WAYBACK_QUIET=1 to turn them off on large crawls
+LOG_ITEMS = os.environ.get("WAYBACK_QUIET", "") != "1"
+
+
+def log(message: str):
+    """Print a per-item progress line, unless LOG_ITEMS is off"""
+    if LOG_ITEMS:
+        print(message)
+
+
+def http_get(
+    url: str, endpoint: str, headers: dict | None = None
+) -> "requests.Response":
+    """GET a Wayback Machine URL and record its latency and size per endpoint ("cdx", "id_" or "im_")
+    Depending on WAYBACK_HTTP_MODE, the exchange is also recorded to, or replayed from, the HTTP archive
+    """
+    start = time.perf_counter()
+    with tracing.span(f"http_get {endpoint}", "http", url=url):
+        if http_archive.HTTP_MODE == "replay":
+            response = http_archive.replay_exchange(url, headers)
+        else:
+            import requests
+
+            response = requests.get(url, headers=headers, timeout=30)
+            if http_archive.HTTP_MODE == "record":
+                http_archive.record_exchange(url, headers, response)
+    metrics.record_request(
+        endpoint,
+        time.perf_counter() - start,
+        len(response.content),
+        response.status_code,
+    )
+    response.raise_for_status()
+    return response
+
+
+import re, urllib.parse
+
+# Point the scraper at another Wayback-compatible server, e.g. the mock server in bench/
+WAYBACK_BASE_URL = os.environ.get("WAYBACK_BASE_URL", "https://web.archive.org")
+
+
+def surt_urlkey(url: str) -> str:
+    """Canonicalize a URL into the SURT form used in the urlkey field of the CDX API
+    e.g. http://www.infoseek.co.jp:80/ becomes jp,co,infoseek)/
+    """
+    if "://" not in url:
+        url = "http://" + url
+    parts = urllib.parse.urlsplit(url.strip().lower())
+    host = re.sub(r"^www\d*\.", "", parts.hostname or "")
+    try:
+        port = parts.port
+    except ValueError:
+        port = None
+    if port and port not in (80, 443):
+        host += f":{port}"
+    query = "&".join(sorted(param for param in parts.query.split("&") if param))
+    return (
+        ",".join(reversed(host.split(".")))
+        + ")"
+        + (parts.path or "/")
+        + (f"?{query}" if query else "")
+    )
+
+
+# Second-level labels under which domains are registered, e.g. example.co.jp
+SECOND_LEVEL_LABELS = {
+    "co",
+    "ne",
+    "or",
+    "ac",
+    "ad",
+    "ed",
+    "go",
+    "gr",
+    "lg",
+    "com",
+    "net",
+    "org",
+}
+
+
+def registered_domain(url: str) -> str:
+    """The domain a host was registered under, e.g. search.yahoo.co.jp becomes yahoo.co.jp"""
+    if "://" not in url:
+        url = "http://" + url
+    labels = (urllib.parse.urlsplit(url.strip().lower()).hostname or "").split(".")
+    if len(labels) >= 3 and len(labels[-1]) == 2 and labels[-2] in SECOND_LEVEL_LABELS:
+        return ".".join(labels[-3:])
+    return ".".join(labels[-2:])
+
+
+CDX_FIELDS = [
+    "urlkey",
+    "timestamp",
+    "original",
+    "mimetype",
+    "statuscode",
+    "digest",
+    "length",
+]
+
+
+def format_wm_cdx_line(cdx_entry: dict) -> str:
+    """Format a CDX entry as a line of the CDX API response"""
+    return " ".join(cdx_entry[field] for field in CDX_FIELDS)
+
+
+@metrics.timed("parse_duration_seconds")
 def parse_wm_cdx_api_response_str(response_str: str) -> list[dict]:
     """Parse the response from the Wayback Machine CDX API"""
     rows = [entry for entry in response_str.strip().split("\n") if entry != ""]
@@ -31,27 +214,158 @@ def parse_wm_cdx_api_response_str(response_str: str) -> list[dict]:
     return result
 
 
+# Time window of the case study, used by default by the CDX queries
+DEFAULT_FROM_TIME = "20000501000000"
+DEFAULT_TO_TIME = "20000531235959"
+
+
+@single_flight()
 @retry
 def query_wm_cdx_entries(
     url: str,
-    from_time: str = "20000501000000",
-    to_time: str = "20000531235959",
+    from_time: str = DEFAULT_FROM_TIME,
+    to_time: str = DEFAULT_TO_TIME,
 ):
     """Query the Wayback Machine CDX API for a given URL and time range"""
-    cdx_url = f"https://web.archive.org/cdx/search/cdx?url={url}&from={from_time}&to={to_time}"
+    # A local CDXJ index (see cdxj_index.py) answers without going to the network
+    if cdxj_index.open_index() is not None:
+        entries = cdxj_index.query_entries(surt_urlkey(url), from_time, to_time)
+        metrics.inc("cdx_index_lookups_total", result="hit" if entries else "miss")
+        if entries:
+            return entries
 
-    response = requests.get(cdx_url, timeout=30)
-    response.raise_for_status()
+    cdx_url = (
+        f"{WAYBACK_BASE_URL}/cdx/search/cdx?url={url}&from={from_time}&to={to_time}"
+    )
+
+    response = http_get(cdx_url, "cdx")
 
     return parse_wm_cdx_api_response_str(response.text)
 
 
+# Captures per page of the domain-wide CDX queries, which are paged with resume keys
+CDX_PAGE_LIMIT = int(os.environ.get("WAYBACK_CDX_PAGE_LIMIT", "10000"))
+
+
+def split_wm_cdx_resume_key(response_str: str) -> tuple[str, str | None]:
+    """Split a CDX API response queried with showResumeKey into its captures and its
+    resume key, which follows the captures after an empty line when more remain
+    """
+    captures, separator, resume_key = ("\n" + response_str.rstrip("\n")).rpartition(
+        "\n\n"
+    )
+    if not separator:
+        return response_str, None
+    return captures, resume_key.strip() or None
+
+
+@retry
+def query_wm_cdx_page(cdx_url: str) -> tuple[list[dict], str | None]:
+    """Query one page of the CDX API
+    Returns its CDX entries and the resume key of the next page (None on the last page)
+    """
+    response = http_get(cdx_url, "cdx")
+    captures, resume_key = split_wm_cdx_resume_key(response.text)
+    return parse_wm_cdx_api_response_str(captures), resume_key
+
+
+@single_flight()
+def query_wm_cdx_domain_entries(
+    domain: str,
+    urlkeys: list[str],
+    from_time: str = DEFAULT_FROM_TIME,
+    to_time: str = DEFAULT_TO_TIME,
+    collapse: str | None = None,
+) -> list[dict]:
+    """Query the CDX API for several URLs of a domain and its subdomains
+    The server only returns the captures of the given urlkeys (filter), and optionally
+    only the first of adjacent captures sharing a field prefix (collapse, e.g. "timestamp:10")
+    Results are fetched CDX_PAGE_LIMIT captures at a time, until the server returns no
+    resume key, so that large domains are not cut at the server's result limit
+    """
+    params = {
+        "url": domain,
+        "matchType": "domain",
+        "from": from_time,
+        "to": to_time,
+        "filter": "urlkey:^("
+        + "|".join(re.escape(urlkey) for urlkey in urlkeys)
+        + ")$",
+        "limit": CDX_PAGE_LIMIT,
+        "showResumeKey": "true",
+    }
+    if collapse:
+        params["collapse"] = collapse
+
+    cdx_entries = []
+    resume_key = None
+    while True:
+        page_params = dict(params, resumeKey=resume_key) if resume_key else params
+        cdx_url = (
+            f"{WAYBACK_BASE_URL}/cdx/search/cdx?{urllib.parse.urlencode(page_params)}"
+        )
+        page_entries, resume_key = query_wm_cdx_page(cdx_url)
+        cdx_entries.extend(page_entries)
+        if resume_key is None:
+            return cdx_entries
+
+
 ##################
 ##### PART 2 #####
 ##################
-import os, json
+import os, io, json
+import warc_store, local_warcs, zstd_store, cache_manager, scheduler
+
+OUTPUT_DIR = os.environ.get("WAYBACK_DATA_DIR", "data")
+CACHE_DIR = os.environ.get("WAYBACK_CACHE_DIR", "cache")
+
+# Where payloads are stored: "files" (data/ and cache/ folders), "zstd" (the same
+# folders, with pages compressed, see zstd_store.py) or "warc" (see warc_store.py)
+STORAGE_BACKEND = os.environ.get("WAYBACK_STORAGE", "files")
 
-OUTPUT_DIR = "data"
+
+def atomic_write(path: str, data: bytes | str, encoding: str = "utf-8"):
+    """Write a file through a temporary file and a rename, so that it is either complete or absent"""
+    tmp_path = f"{path}.tmp-{os.getpid()}-{threading.get_ident()}"
+    try:
+        if isinstance(data, bytes):
+            f = open(tmp_path, "wb")
+        else:
+            f = open(tmp_path, "w", encoding=encoding)
+        with f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def atomic_write_json(path: str, obj, indent: int | None = None):
+    """Write a JSON file atomically (see atomic_write)"""
+    atomic_write(path, json.dumps(obj, indent=indent))
+
+
+def is_temporary_file(filename: str) -> bool:
+    """Whether a file is a leftover of an interrupted atomic_write"""
+    return ".tmp-" in filename
+
+
+def link_or_copy_file(src: str, dst: str):
+    """Hard-link a file into place (atomically), or copy it where hard links are not possible
+    Files are only ever replaced, never modified in place, so linked copies cannot diverge
+    """
+    tmp_path = f"{dst}.tmp-{os.getpid()}-{threading.get_ident()}"
+    try:
+        os.link(src, tmp_path)
+        os.replace(tmp_path, dst)
+    except OSError:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        with open(src, "rb") as f:
+            atomic_write(dst, f.read())
 
 
 def retrieve_saved_website_entries() -> list[dict]:
@@ -65,6 +379,9 @@ def retrieve_saved_website_entries() -> list[dict]:
 
     for website in os.listdir(OUTPUT_DIR):
         website_dir = os.path.join(OUTPUT_DIR, website)
+        # Skip files such as the journal
+        if not os.path.isdir(website_dir):
+            continue
 
         for timestamp_dir in os.listdir(website_dir):
             if os.path.isdir(os.path.join(website_dir, timestamp_dir)):
@@ -88,43 +405,136 @@ def retrieve_saved_website_entries() -> list[dict]:
 ##################
 
 
+@single_flight(lambda cdx_entry, mode: (cdx_entry["digest"], mode))
 @retry
+def fetch_snapshot_payload(cdx_entry: dict, mode: str) -> "requests.Response":
+    """Fetch the payload of a capture, "id_" for a page or "im_" for an image
+    Concurrent fetches of the same digest (e.g. an ad creative repeated across sites) share one request
+    The bytes received are charged to the byte budget and the rate of the scheduler
+    """
+    # Our own WARC collections are tried before the Wayback Machine
+    response = local_warcs.find_response(cdx_entry)
+    if response is None:
+        wayback_url = f"{WAYBACK_BASE_URL}/web/{cdx_entry['timestamp']}{mode}/{cdx_entry['original']}"
+        response = http_get(wayback_url, mode)
+        scheduler.charge(len(response.content))
+    return response
+
+
 def download_website_snapshot(cdx_entry: dict) -> dict:
     """Download a website snapshot from the Wayback Machine
     Returns a dict with the following keys:
     - digest: the digest of the website
     - file: the website file
     - encoding: the encoding of the website
+    - cdx_entry: the CDX entry of the website
     """
-    wayback_url = f"https://web.archive.org/web/{cdx_entry['timestamp']}id_/{cdx_entry['original']}"
-    response = requests.get(wayback_url, timeout=30)
-    response.raise_for_status()
+    response = fetch_snapshot_payload(cdx_entry, "id_")
+    with tracing.span("detect_encoding", "charset", digest=cdx_entry["digest"]):
+        encoding = response.apparent_encoding
     return {
         "digest": cdx_entry["digest"],
         "file": response.content,
-        "encoding": response.apparent_encoding,
+        "encoding": encoding,
+        "cdx_entry": cdx_entry,
     }
 
 
+def website_snapshot_paths(save_dir: str, digest: str) -> list[str]:
+    """The files written by save_website_snapshot, in the order they are written"""
+    if STORAGE_BACKEND == "zstd":
+        return [
+            os.path.join(save_dir, "encoding.txt"),
+            os.path.join(save_dir, f"{digest}.html.zst"),
+        ]
+    return [
+        os.path.join(save_dir, f"{digest}_utf8.html"),
+        os.path.join(save_dir, "encoding.txt"),
+        os.path.join(save_dir, f"{digest}.html"),
+    ]
+
+
 def save_website_snapshot(snapshot: dict, save_dir: str):
     """Save a website snapshot (original and utf8 versions) and encoding information to a directory"""
-    os.makedirs(save_dir, exist_ok=True)
+    if STORAGE_BACKEND == "warc":
+        warc_store.store_payload(
+            snapshot["cdx_entry"], snapshot["file"], {"encoding": snapshot["encoding"]}
+        )
+        return
 
-    # Save main HTML file (original encoding)
-    html_filename = f"{snapshot['digest']}.html"
-    with open(os.path.join(save_dir, html_filename), "wb") as f:
-        f.write(snapshot["file"])
+    os.makedirs(save_dir, exist_ok=True)
+    if STORAGE_BACKEND == "zstd":
+        # Stored once, compressed, and decoded to UTF-8 when it is read
+        encoding_path, zst_path = website_snapshot_paths(save_dir, snapshot["digest"])
+        atomic_write(encoding_path, snapshot["encoding"])
+        atomic_write(zst_path, zstd_store.compress(snapshot["file"]))
+        cache_manager.record_save(save_dir)
+        return
+
+    utf8_html_path, encoding_path, html_path = website_snapshot_paths(
+        save_dir, snapshot["digest"]
+    )
 
     # Save decoded UTF-8 version of HTML
     decoded_content = snapshot["file"].decode(snapshot["encoding"], errors="replace")
-    with open(
-        os.path.join(save_dir, f"{snapshot['digest']}_utf8.html"), "w", encoding="utf-8"
-    ) as f:
-        f.write(decoded_content)
+    atomic_write(utf8_html_path, decoded_content)
 
     # Save encoding information
-    with open(os.path.join(save_dir, "encoding.txt"), "w") as f:
-        f.write(snapshot["encoding"])
+    atomic_write(encoding_path, snapshot["encoding"])
+
+    # Save main HTML file (original encoding) last, as stage 2 checks for it
+    atomic_write(html_path, snapshot["file"])
+    cache_manager.record_save(save_dir)
+
+
+def has_website_snapshot(snapshot_dir: str, digest: str) -> bool:
+    """Whether a website snapshot has been saved to a directory"""
+    if STORAGE_BACKEND == "warc":
+        return warc_store.find_record(digest) is not None
+    # Either storage mode, so that switching modes keeps the snapshots already saved
+    return os.path.exists(
+        os.path.join(snapshot_dir, f"{digest}.html")
+    ) or os.path.exists(os.path.join(snapshot_dir, f"{digest}.html.zst"))
+
+
+def read_website_snapshot_utf8(snapshot_dir: str, digest: str) -> str | None:
+    """Read the UTF-8 version of a saved website snapshot, or None if it was not saved"""
+    if STORAGE_BACKEND == "warc":
+        record = warc_store.find_record(digest)
+        if record is None:
+            return None
+        payload = warc_store.read_payload(digest)
+        return payload.decode(record["encoding"], errors="replace")
+
+    utf8_html_path = os.path.join(snapshot_dir, f"{digest}_utf8.html")
+    zst_path = os.path.join(snapshot_dir, f"{digest}.html.zst")
+    if os.path.exists(utf8_html_path):
+        with open(utf8_html_path, "r", encoding="utf-8") as f:
+            return f.read()
+    if os.path.exists(zst_path):
+        with open(os.path.join(snapshot_dir, "encoding.txt"), "r") as f:
+            encoding = f.read().strip()
+        with zstd_store.open_text(zst_path, encoding) as f:
+            return f.read()
+    return None
+
+
+def read_website_snapshot_bytes(snapshot_dir: str, digest: str) -> bytes | None:
+    """Read the original bytes of a saved website snapshot, or None if it was not saved"""
+    if STORAGE_BACKEND == "warc":
+        if warc_store.find_record(digest) is None:
+            return None
+        return warc_store.read_payload(digest)
+
+    html_path = os.path.join(snapshot_dir, f"{digest}.html")
+    zst_path = os.path.join(snapshot_dir, f"{digest}.html.zst")
+    if os.path.exists(html_path):
+        with open(html_path, "rb") as f:
+            return f.read()
+    if os.path.exists(zst_path):
+        with open(zst_path, "rb") as f:
+            return zstd_store.decompress(f.read())
+    return None
 
 
 ##################
@@ -133,39 +543,94 @@ def save_website_snapshot(snapshot: dict, save_dir: str):
 
 
 def find_and_copy_cached_snapshot(cached_snapshot_dir: str, save_dir: str) -> bool:
-    """Find and copy a cached snapshot to a directory if it exists. Return True if a snapshot was found and copied."""
-    if os.path.exists(cached_snapshot_dir):
-        files = os.listdir(cached_snapshot_dir)
-        # If no files, return False
-        if not files:
-            return False
-        for filename in files:
+    """Find and copy a cached snapshot to a directory if it exists. Return True if its payload
+    (<digest>.html, <digest>.html.zst or the image file) was found and copied.
+    """
+    if STORAGE_BACKEND == "warc":
+        # The WARC store holds each digest once, there is nothing to copy
+        return False
+    found = False
+    payload_prefix = f"{os.path.basename(cached_snapshot_dir)}."
+    try:
+        # Skip leftovers of an interrupted write
+        filenames = [
+            filename
+            for filename in os.listdir(cached_snapshot_dir)
+            if not is_temporary_file(filename)
+        ]
+        # Copy the payload last, as it marks a complete snapshot
+        filenames.sort(key=lambda filename: filename.startswith(payload_prefix))
+        for filename in filenames:
             src = os.path.join(cached_snapshot_dir, filename)
             dst = os.path.join(save_dir, filename)
             # If file already exists, copy it to the save_dir
             os.makedirs(os.path.dirname(dst), exist_ok=True)
-            with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
-                fdst.write(fsrc.read())
-        return True
-    return False
+            link_or_copy_file(src, dst)
+            # Without its payload, the cached snapshot is a miss
+            found = found or filename.startswith(payload_prefix)
+    except FileNotFoundError:
+        # Not cached, or evicted by cache_manager while being copied
+        found = False
+    metrics.record_cache_lookup(hit=found)
+    cache_manager.record_lookup(cached_snapshot_dir, found)
+    return found
 
 
 ##################
 ##### PART 5 #####
 ##################
 
-from bs4 import BeautifulSoup
+# The tags parsed out of each payload are kept by digest, so that a page captured
+# many times (or on several sites) is parsed once
+PARSE_MEMO_DIR = os.environ.get("WAYBACK_PARSE_MEMO_DIR", "parse-memo")
+# Bump when the tag extraction changes, so that older parse results are not reused
+PARSE_MEMO_VERSION = 1
+
+
+def parse_memo_path(digest: str, kind: str) -> str:
+    """The file holding the tags of a kind parsed out of a payload
+    Returns a path under PARSE_MEMO_DIR, versioned by PARSE_MEMO_VERSION
+    """
+    return os.path.join(
+        PARSE_MEMO_DIR, f"v{PARSE_MEMO_VERSION}", digest[:2], f"{digest}.{kind}.json"
+    )
+
+
+def read_parse_memo(digest: str, kind: str) -> list[dict] | None:
+    """The tags ("frame_tags" or "image_tags") parsed out of a payload earlier, or None"""
+    try:
+        with open(parse_memo_path(digest, kind), "r") as f:
+            tags = json.load(f)
+    except FileNotFoundError:
+        metrics.inc("parse_memo_lookups_total", kind=kind, result="miss")
+        return None
+    metrics.inc("parse_memo_lookups_total", kind=kind, result="hit")
+    return tags
+
+
+def write_parse_memo(digest: str, kind: str, tags: list[dict]):
+    """Keep the tags ("frame_tags" or "image_tags") parsed out of a payload, for read_parse_memo"""
+    path = parse_memo_path(digest, kind)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    atomic_write_json(path, tags)
+
+
+@metrics.timed("parse_duration_seconds")
+def extract_frame_tag_attrs(soup: "BeautifulSoup") -> list[dict]:
+    """Find all frame and iframe tags with their attributes and return a list of dicts
+    The name of the tag is added to the attributes as tag_name
+    """
+    all_frame_tags = soup.find_all(["frame", "iframe"])
+    return [{**frame.attrs, "tag_name": frame.name} for frame in all_frame_tags]
 
 
 def detect_and_save_frame_tag_attrs(
-    soup: BeautifulSoup,
+    soup: "BeautifulSoup",
     website_dir: str,
 ) -> list[dict]:
-    """Find all frame tag with their attribute and return a list of dicts"""
-    all_frame_tags = soup.find_all("frame")
-    frame_tag_attrs = [frame.attrs for frame in all_frame_tags]
-    with open(os.path.join(website_dir, "frame_tags.json"), "w") as f:
-        json.dump(frame_tag_attrs, f)
+    """Find all frame and iframe tags with their attributes, save them to frame_tags.json and return them"""
+    frame_tag_attrs = extract_frame_tag_attrs(soup)
+    atomic_write_json(os.path.join(website_dir, "frame_tags.json"), frame_tag_attrs)
 
     return frame_tag_attrs
 
@@ -222,18 +687,71 @@ def url_to_filename(url: str) -> str:
     return "".join(c if c.isalnum() or c in "._-" else "_" for c in url)
 
 
+import hashlib
+
+# Readable part of the directory names made by url_to_dirname, well below the 255-byte limit
+URL_DIRNAME_MAX_LENGTH = 80
+
+
+def url_to_dirname(url: str) -> str:
+    """Convert a URL into a directory name that no other URL maps to
+    The name is a readable (truncated) url_to_filename followed by a hash of the whole URL,
+    e.g. a/b_c and a_b/c no longer share a directory. The URL itself is kept in url.txt.
+    """
+    url_hash = hashlib.sha1(url.encode("utf-8")).hexdigest()[:16]
+    return f"{url_to_filename(url)[:URL_DIRNAME_MAX_LENGTH]}-{url_hash}"
+
+
+def url_dir(parent_dir: str, url: str) -> str:
+    """The directory of a URL (e.g. a frame or a banner) under parent_dir
+    Trees saved before url_to_dirname keep their url_to_filename directories until
+    migrate-layout.py renames them
+    """
+    path = os.path.join(parent_dir, url_to_dirname(url))
+    legacy_path = os.path.join(parent_dir, url_to_filename(url))
+    if not os.path.exists(path) and os.path.exists(legacy_path):
+        return legacy_path
+    return path
+
+
+def save_url_sidecar(save_dir: str, url: str):
+    """Record the URL a directory was named after in its url.txt"""
+    url_path = os.path.join(save_dir, "url.txt")
+    if not os.path.exists(url_path):
+        atomic_write(url_path, url)
+
+
+def cache_snapshot_dir(digest: str) -> str:
+    """The cache directory of a digest, fanned out as cache/AB/CD/<digest> so that no
+    directory holds more than 32 * 32 entries before the last level
+    Caches saved before the fan-out keep their flat cache/<digest> directories until
+    migrate-layout.py moves them
+    """
+    path = os.path.join(CACHE_DIR, digest[:2], digest[2:4], digest)
+    legacy_path = os.path.join(CACHE_DIR, digest)
+    if not os.path.exists(path) and os.path.exists(legacy_path):
+        return legacy_path
+    return path
+
+
 ##################
 ##### PART 8 #####
 ##################
 
 
+@single_flight()
 @retry
 def query_wm_cdx_closest_entry(url: str, timestamp: str) -> dict | None:
     """Get the closest snapshot entry for a given URL and timestamp"""
-    cdx_url = f"https://web.archive.org/cdx/search/cdx?limit=1&sort=closest&url={url}&closest={timestamp}"
+    if cdxj_index.open_index() is not None:
+        entry = cdxj_index.query_closest_entry(surt_urlkey(url), timestamp)
+        metrics.inc("cdx_index_lookups_total", result="hit" if entry else "miss")
+        if entry:
+            return entry
 
-    response = requests.get(cdx_url, timeout=30)
-    response.raise_for_status()
+    cdx_url = f"{WAYBACK_BASE_URL}/cdx/search/cdx?limit=1&sort=closest&url={url}&closest={timestamp}"
+
+    response = http_get(cdx_url, "cdx")
 
     entries = parse_wm_cdx_api_response_str(response.text)
     return entries[0] if entries else None
@@ -244,8 +762,11 @@ def query_wm_cdx_closest_entry(url: str, timestamp: str) -> dict | None:
 ##################
 
 
-def retrieve_saved_website_and_frame_entries() -> list[dict]:
-    """Retrieve all the saved frame tags for a given website directory
+def retrieve_saved_website_and_frame_entries(
+    website_entries: list[dict] | None = None,
+) -> list[dict]:
+    """Retrieve the website entries and the saved frame entries of their snapshots
+    website_entries defaults to all the saved website entries
     Returns a list of dicts with the following keys:
     - website_dir: the directory of the website
     - website: the website name
@@ -253,7 +774,9 @@ def retrieve_saved_website_and_frame_entries() -> list[dict]:
     - type: "website" or "frame"
     """
     all_website_and_frame_entries = []
-    all_website_entries = retrieve_saved_website_entries()
+    all_website_entries = (
+        retrieve_saved_website_entries() if website_entries is None else website_entries
+    )
     for entry in all_website_entries:
         website = entry["website"]
         website_dir = entry["snapshot_dir"]
@@ -268,21 +791,15 @@ def retrieve_saved_website_and_frame_entries() -> list[dict]:
             }
         )
 
-        # Add the frame entries
-        frames_dir = os.path.join(website_dir, "frames")
-
-        # If frames directory does not exist, skip
-        if not os.path.exists(frames_dir):
-            continue
-
-        for frame_name in os.listdir(frames_dir):
-            frame_cdx_entry_path = os.path.join(
-                frames_dir, frame_name, "cdx_entry.json"
-            )
+        # Add the frame entries, nested frames included
+        for frame_dir in retrieve_saved_frame_dirs(website_dir):
+            frame_cdx_entry_path = os.path.join(frame_dir, "cdx_entry.json")
             try:
                 with open(frame_cdx_entry_path, "r") as f:
                     frame_cdx_entry = json.load(f)
-                frame_dir = os.path.join(frames_dir, frame_name)
+                # Frames without a capture have an empty CDX entry
+                if not frame_cdx_entry:
+                    continue
                 all_website_and_frame_entries.append(
                     {
                         "website_dir": frame_dir,
@@ -296,31 +813,81 @@ def retrieve_saved_website_and_frame_entries() -> list[dict]:
     return all_website_and_frame_entries
 
 
+def retrieve_saved_frame_dirs(website_dir: str) -> list[str]:
+    """The directories of the frames of a website snapshot, at every depth
+    Read from the frame_tree.json written by stage 4, or found by walking the frames/ directories
+    """
+    frame_tree_path = os.path.join(website_dir, "frame_tree.json")
+    if os.path.exists(frame_tree_path):
+        with open(frame_tree_path, "r") as f:
+            nodes = json.load(f)["children"]
+        frame_dirs = []
+        while nodes:
+            node = nodes.pop(0)
+            nodes += node["children"]
+            # Frames already visited elsewhere in the tree are listed once
+            if "frame_dir" in node and node.get("duplicate") != "url":
+                frame_dirs.append(os.path.join(website_dir, node["frame_dir"]))
+        return frame_dirs
+
+    frame_dirs = []
+    frames_dir = os.path.join(website_dir, "frames")
+    if os.path.exists(frames_dir):
+        for frame_name in os.listdir(frames_dir):
+            frame_dir = os.path.join(frames_dir, frame_name)
+            frame_dirs.append(frame_dir)
+            frame_dirs += retrieve_saved_frame_dirs(frame_dir)
+    return frame_dirs
+
+
 ###################
 ##### PART 10 #####
 ###################
 
-import urllib.parse
-
 
-def detect_and_save_image_tag_attrs(
-    soup: BeautifulSoup, website_dir: str, parent_cdx_entry: dict
-) -> list[dict]:
-    """Detect all images in a BeautifulSoup object and return a list of dicts"""
+@metrics.timed("parse_duration_seconds")
+def extract_image_tag_attrs(soup: "BeautifulSoup") -> list[dict]:
+    """Detect all images in a BeautifulSoup object and return a list of dicts
+    The href of a link around an image is added as parent_href, as written in the page
+    """
     image_tags = []
     for img in soup.find_all("img"):
         image_tag_attrs = img.attrs
         if img.parent.name == "a":
             image_tag_attrs["parent_href"] = img.parent["href"]
-            if img.parent["href"].startswith("http"):
-                image_tag_attrs["full_parent_href"] = img.parent["href"]
+        image_tags.append(image_tag_attrs)
+    return image_tags
+
+
+def resolve_image_tag_attrs(
+    image_tags: list[dict], parent_cdx_entry: dict
+) -> list[dict]:
+    """Add the full_parent_href of each linked image, resolved against the URL of its page
+    This is the only part of the image tags that depends on where the page was captured
+    """
+    resolved_image_tags = []
+    for image_tag_attrs in image_tags:
+        if "parent_href" in image_tag_attrs:
+            parent_href = image_tag_attrs["parent_href"]
+            if parent_href.startswith("http"):
+                full_parent_href = parent_href
             else:
-                image_tag_attrs["full_parent_href"] = urllib.parse.urljoin(
-                    parent_cdx_entry["original"], img.parent["href"]
+                full_parent_href = urllib.parse.urljoin(
+                    parent_cdx_entry["original"], parent_href
                 )
-        image_tags.append(image_tag_attrs)
-    with open(os.path.join(website_dir, "image_tags.json"), "w") as f:
-        json.dump(image_tags, f)
+            image_tag_attrs = {**image_tag_attrs, "full_parent_href": full_parent_href}
+        resolved_image_tags.append(image_tag_attrs)
+    return resolved_image_tags
+
+
+def detect_and_save_image_tag_attrs(
+    soup: "BeautifulSoup", website_dir: str, parent_cdx_entry: dict
+) -> list[dict]:
+    """Detect all images in a BeautifulSoup object, save them to image_tags.json and return them"""
+    image_tags = resolve_image_tag_attrs(
+        extract_image_tag_attrs(soup), parent_cdx_entry
+    )
+    atomic_write_json(os.path.join(website_dir, "image_tags.json"), image_tags)
 
     return image_tags
 
@@ -381,38 +948,43 @@ def check_banner_properties(width: int, height: int) -> dict:
 ###################
 
 
-def retrieve_saved_image_tags_with_parent_info() -> list[dict]:
-    """Retrieve all the saved image tags for all the website and frame entries
+def retrieve_saved_image_tags_with_parent_info(
+    website_entries: list[dict] | None = None,
+) -> list[dict]:
+    """Retrieve the saved image tags of the website and frame entries
+    website_entries defaults to all the saved website entries
     Returns a list of dicts with the following keys:
     - website_dir: the directory of the website
     - website: the website name
     - cdx_entry: the CDX entry of the website
-    - image_tag: the image tag
+    - image_tag: the image tag, or an ad candidate found outside image tags (see ad_scanner.py)
     """
-    all_website_and_frame_entries = retrieve_saved_website_and_frame_entries()
+    all_website_and_frame_entries = retrieve_saved_website_and_frame_entries(
+        website_entries
+    )
     all_image_tags_with_parent_info = []
     for entry in all_website_and_frame_entries:
         website = entry["website"]
         website_dir = entry["website_dir"]
         cdx_entry = entry["cdx_entry"]
-        image_tags_path = os.path.join(website_dir, "image_tags.json")
-
-        try:
-            with open(image_tags_path, "r") as f:
-                image_tags = json.load(f)
-                all_image_tags_with_parent_info.extend(
-                    [
-                        {
-                            "website_dir": website_dir,
-                            "website": website,
-                            "cdx_entry": cdx_entry,
-                            "image_tag": image_tag,
-                        }
-                        for image_tag in image_tags
-                    ]
-                )
-        except FileNotFoundError:
-            continue
+        # Ad candidates found outside <img> tags are downloaded like image tags
+        for tags_filename in ["image_tags.json", "ad_candidates.json"]:
+            try:
+                with open(os.path.join(website_dir, tags_filename), "r") as f:
+                    image_tags = json.load(f)
+            except FileNotFoundError:
+                continue
+            all_image_tags_with_parent_info.extend(
+                [
+                    {
+                        "website_dir": website_dir,
+                        "website": website,
+                        "cdx_entry": cdx_entry,
+                        "image_tag": image_tag,
+                    }
+                    for image_tag in image_tags
+                ]
+            )
     return all_image_tags_with_parent_info
 
 
@@ -460,45 +1032,138 @@ def get_image_file_extension(cdx_entry: dict) -> str:
     return url_extension or mime_type_extension
 
 
-@retry
 def download_image_snapshot(cdx_entry: dict) -> dict:
     """Download an image snapshot from the Wayback Machine
     Returns a dict with the following keys:
     - digest: the digest of the image
     - file: the image file
     - extension: the extension of the image
+    - cdx_entry: the CDX entry of the image
     """
-    wayback_url = f"https://web.archive.org/web/{cdx_entry['timestamp']}im_/{cdx_entry['original']}"
-    response = requests.get(wayback_url, timeout=30)
-    response.raise_for_status()
+    response = fetch_snapshot_payload(cdx_entry, "im_")
     extension = get_image_file_extension(cdx_entry)
     return {
         "digest": cdx_entry["digest"],
         "file": response.content,
         "extension": extension,
+        "cdx_entry": cdx_entry,
     }
 
 
+# Bytes requested by probe_image_dimensions: GIF and PNG headers fit in a few bytes,
+# JPEG headers usually fit in the first, and almost always in the second
+PROBE_BYTES = [4096, 65536]
+
+
+def parse_image_dimensions(data: bytes) -> tuple[int, int] | None:
+    """Read the width and height from the first bytes of a GIF, PNG or JPEG image
+    Returns None if the format is unknown or the header is not complete
+    """
+    if data[:6] in (b"GIF87a", b"GIF89a") and len(data) >= 10:
+        return int.from_bytes(data[6:8], "little"), int.from_bytes(data[8:10], "little")
+
+    if data[:8] == b"\x89PNG\r\n\x1a\n" and len(data) >= 24 and data[12:16] == b"IHDR":
+        return int.from_bytes(data[16:20], "big"), int.from_bytes(data[20:24], "big")
+
+    if data[:2] == b"\xff\xd8":
+        # Walk the JPEG segments up to the start of frame marker
+        offset = 2
+        while offset + 9 <= len(data):
+            if data[offset] != 0xFF:
+                return None
+            marker = data[offset + 1]
+            if marker == 0xFF:
+                # Fill byte
+                offset += 1
+                continue
+            if marker in (0xD8, 0x01) or 0xD0 <= marker <= 0xD7:
+                # Markers without a length
+                offset += 2
+                continue
+            if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+                height = int.from_bytes(data[offset + 5 : offset + 7], "big")
+                width = int.from_bytes(data[offset + 7 : offset + 9], "big")
+                return width, height
+            offset += 2 + int.from_bytes(data[offset + 2 : offset + 4], "big")
+    return None
+
+
+@single_flight(lambda cdx_entry: cdx_entry["digest"])
+@retry
+def probe_image_dimensions(cdx_entry: dict) -> tuple[int, int] | None:
+    """Get the real dimensions of an image snapshot with small Range requests, without downloading all of it
+    Returns None if they could not be read from the first bytes
+    """
+    # Images in our own WARC collections cost nothing to read
+    response = local_warcs.find_response(cdx_entry)
+    if response is not None:
+        return parse_image_dimensions(response.content)
+
+    wayback_url = (
+        f"{WAYBACK_BASE_URL}/web/{cdx_entry['timestamp']}im_/{cdx_entry['original']}"
+    )
+    for num_bytes in PROBE_BYTES:
+        response = http_get(wayback_url, "im_", {"Range": f"bytes=0-{num_bytes - 1}"})
+        scheduler.charge(len(response.content))
+        dimensions = parse_image_dimensions(response.content)
+        # A server ignoring the Range header sends the whole image at once
+        if (
+            dimensions
+            or response.status_code != 206
+            or len(response.content) < num_bytes
+        ):
+            return dimensions
+    return None
+
+
 def save_image_snapshot(img_snapshot: dict, save_dir: str):
     """Save an image to a directory"""
+    if STORAGE_BACKEND == "warc":
+        warc_store.store_payload(
+            img_snapshot["cdx_entry"],
+            img_snapshot["file"],
+            {"extension": img_snapshot["extension"]},
+        )
+        return
+
     os.makedirs(save_dir, exist_ok=True)
     img_filename = f"{img_snapshot['digest']}.{img_snapshot['extension']}"
     img_path = os.path.join(save_dir, img_filename)
-    print("Image filename:")
-    print(img_filename)
-    print(f"Saving image to {img_path}")
-    with open(img_path, "wb") as f:
-        f.write(img_snapshot["file"])
+    log("Image filename:")
+    log(img_filename)
+    log(f"Saving image to {img_path}")
+    atomic_write(img_path, img_snapshot["file"])
+    cache_manager.record_save(save_dir)
+
+
+def find_image_snapshot(snapshot_dir: str, cdx_entry: dict) -> str | io.BytesIO | None:
+    """Find a saved image snapshot
+    Returns the path of the image file, a file object for images in the WARC store,
+    or None if the image was not saved
+    """
+    if STORAGE_BACKEND == "warc":
+        return warc_store.open_payload(cdx_entry["digest"])
+
+    extension = get_image_file_extension(cdx_entry)
+    img_path = os.path.join(snapshot_dir, f"{cdx_entry['digest']}.{extension}")
+    return img_path if os.path.exists(img_path) else None
+
+
+def has_image_snapshot(snapshot_dir: str, cdx_entry: dict) -> bool:
+    """Whether an image snapshot has been saved to a directory"""
+    if STORAGE_BACKEND == "warc":
+        return warc_store.find_record(cdx_entry["digest"]) is not None
+    return find_image_snapshot(snapshot_dir, cdx_entry) is not None
 
 
 ###################
 ##### PART 14 #####
 ###################
-from PIL import Image
 
 
-def get_image_metadata(image_path: str) -> dict:
-    """Get the metadata of an image
+@metrics.timed("parse_duration_seconds")
+def get_image_metadata(image_path: str | io.BytesIO) -> dict:
+    """Get the metadata of an image (a path, or a file object as returned by find_image_snapshot)
     Returns a dict with the following keys:
     - width: the width of the image
     - height: the height of the image
@@ -511,6 +1176,7 @@ def get_image_metadata(image_path: str) -> dict:
     - jiaa_size: the JIAA banner category (if fits)
     - corrupt: whether the image is corrupt
     """
+    from PIL import Image
 
     metadata = {
         "width": None,
@@ -529,7 +1195,11 @@ def get_image_metadata(image_path: str) -> dict:
             metadata = {
                 "width": img.width,
                 "height": img.height,
-                "size": os.path.getsize(image_path),
+                "size": (
+                    os.path.getsize(image_path)
+                    if isinstance(image_path, str)
+                    else image_path.getbuffer().nbytes
+                ),
                 "animated": False,
                 "frame_count": 1,
                 "animation_duration": 0,
@@ -0,0 +1,233 @@
+"""One command line for every stage of the pipeline, and for looking at its results.
+
+    python wayback.py query                 # stage 1: find the snapshots of the seed websites
+    python wayback.py download              # stage 2
+    python wayback.py run --from frame-tags # stages 3-8, in order
+    python wayback.py status                # what has been saved so far
+    python wayback.py inspect data/asahi.com/20000510120000
+    python wayback.py inspect IF3OMLFL5DFM4I5GWUY3GTFDYOMPLFVN
+
+Every subcommand takes the same options: --data-dir, --cache-dir, --concurrency,
+--base-url and --quiet. They set the environment variables the stages read
+(WAYBACK_DATA_DIR, WAYBACK_CACHE_DIR, WAYBACK_FRAME_CONCURRENCY,
+WAYBACK_BASE_URL, WAYBACK_QUIET), so the numbered scripts, which the stage
+subcommands run, behave the same when run on their own.
+
+Nothing is imported before the options are applied, and util imports
+requests, tenacity, BeautifulSoup and PIL only when a stage first needs them,
+so status, inspect and the short stages start without loading them.
+"""
+
+import os, json, time, runpy, argparse
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# (subcommand, script, help), in pipeline order
+STAGES = [
+    ("query", "1-query-cdx.py", "query the CDX API for the seed websites (stage 1)"),
+    ("download", "2-download-snapshot.py", "download the website snapshots (stage 2)"),
+    ("frame-tags", "3-detect-frame-tags.py", "detect frame tags (stage 3)"),
+    ("frames", "4-download-frames.py", "download the frames, recursively (stage 4)"),
+    ("image-tags", "5-detect-image-tags.py", "detect image tags and ads (stage 5)"),
+    ("banners", "6-download-banner-ads.py", "download the banner ads (stage 6)"),
+    ("summarize", "7-summarize-banner-ads.py", "write the banner summary (stage 7)"),
+    ("gallery", "8-generate-gallery.py", "generate gallery.html (stage 8)"),
+]
+STAGE_NAMES = [name for name, script, help in STAGES]
+
+# Summary columns shown by inspect for a digest
+INSPECT_COLUMNS = ["digest", "website", "website_timestamp", "original"]
+
+
+def apply_options(args: argparse.Namespace):
+    """Set the environment variables of the shared options, before the stages import util"""
+    options = {
+        "WAYBACK_DATA_DIR": args.data_dir,
+        "WAYBACK_CACHE_DIR": args.cache_dir,
+        "WAYBACK_FRAME_CONCURRENCY": args.concurrency,
+        "WAYBACK_BASE_URL": args.base_url,
+        "WAYBACK_QUIET": "1" if args.quiet else None,
+    }
+    for name, value in options.items():
+        if value is not None:
+            os.environ[name] = str(value)
+
+
+def run_stage(name: str):
+    """Run the script of a stage in this process, as if it was run on its own"""
+    script = dict((name, script) for name, script, help in STAGES)[name]
+    print(f"##### {script} #####")
+    start = time.perf_counter()
+    runpy.run_path(os.path.join(REPO_DIR, script), run_name="__main__")
+    # Write the profiles of this stage now, rather than those of every stage at exit
+    import tracing
+
+    tracing.end_stage()
+    print(f"##### {script} done in {time.perf_counter() - start:.1f}s #####")
+
+
+##################
+##### STATUS #####
+##################
+
+
+def tree_status() -> dict:
+    """Returns a dict with the following keys:
+    - websites, snapshots, downloaded_snapshots: the websites and snapshots saved by stages 1 and 2
+    - frame_tags, image_tags: the documents whose tags were detected (stages 3 and 5)
+    - frames: the frame directories of stage 4, at every depth
+    - ad_candidates: the ad URLs found outside image tags (stage 5)
+    - banners, banner_images: the banner directories of stage 6, and those holding an image
+    - cache_digests, cache_bytes: the payloads in the cache
+    - summary_rows: the rows of the banner summary (stage 7)
+    """
+    import util, summary_store
+
+    status = dict.fromkeys(
+        [
+            "websites",
+            "snapshots",
+            "downloaded_snapshots",
+            "frame_tags",
+            "frames",
+            "image_tags",
+            "ad_candidates",
+            "banners",
+            "banner_images",
+        ],
+        0,
+    )
+    image_suffixes = tuple(f".{extension}" for extension in util.image_extensions)
+    if os.path.isdir(util.OUTPUT_DIR):
+        status["websites"] = sum(
+            os.path.isdir(os.path.join(util.OUTPUT_DIR, name))
+            for name in os.listdir(util.OUTPUT_DIR)
+        )
+    for entry in util.retrieve_saved_website_entries() if status["websites"] else []:
+        status["snapshots"] += 1
+        cdx_entry = entry["cdx_entry"]
+        if cdx_entry and util.has_website_snapshot(
+            entry["snapshot_dir"], cdx_entry["digest"]
+        ):
+            status["downloaded_snapshots"] += 1
+
+    for root, dirs, files in os.walk(util.OUTPUT_DIR):
+        parent = os.path.basename(os.path.dirname(root))
+        status["frame_tags"] += "frame_tags.json" in files
+        status["image_tags"] += "image_tags.json" in files
+        if "ad_candidates.json" in files:
+            with open(os.path.join(root, "ad_candidates.json"), "r") as f:
+                status["ad_candidates"] += len(json.load(f))
+        if parent == "frames":
+            status["frames"] += 1
+        elif parent == "banners":
+            status["banners"] += 1
+            status["banner_images"] += any(
+                filename.endswith(image_suffixes) for filename in files
+            )
+
+    cache_digests, cache_bytes = 0, 0
+    for root, dirs, files in os.walk(util.CACHE_DIR):
+        # Payload directories have no subdirectories
+        if files and not dirs and root != util.CACHE_DIR:
+            cache_digests += 1
+            cache_bytes += sum(
+                os.path.getsize(os.path.join(root, filename)) for filename in files
+            )
+    status["cache_digests"] = cache_digests
+    status["cache_bytes"] = cache_bytes
+
+    status["summary_rows"] = None
+    if os.path.exists(summary_store.SUMMARY_CSV):
+        digests = summary_store.read_columns(summary_store.SUMMARY_CSV, ["digest"])
+        status["summary_rows"] = len(digests["digest"])
+    return status
+
+
+def inspect_target(target: str):
+    """Print what was saved for a snapshot, frame or banner directory, or for a digest
+    and the summary rows of its image
+    """
+    import util, summary_store
+
+    if os.path.isdir(target):
+        directory = target
+    else:
+        directory = util.cache_snapshot_dir(target)
+        if not os.path.isdir(directory):
+            raise SystemExit(f"{target} is neither a directory nor a cached digest")
+        if os.path.exists(summary_store.SUMMARY_CSV):
+            rows = summary_store.read_rows(summary_store.SUMMARY_CSV, INSPECT_COLUMNS)
+            rows = [row for row in rows if row["digest"] == target]
+            print(f"{len(rows)} rows in {summary_store.SUMMARY_CSV}:")
+            for row in rows:
+                print(
+                    f"  {row['website']} {row['website_timestamp']} {row['original']}"
+                )
+
+    cdx_entry_path = os.path.join(directory, "cdx_entry.json")
+    if os.path.exists(cdx_entry_path):
+        with open(cdx_entry_path, "r") as f:
+            cdx_entry = json.load(f)
+        for name, value in (cdx_entry or {}).items():
+            print(f"{name}: {value}")
+    if os.path.exists(os.path.join(directory, "url.txt")):
+        with open(os.path.join(directory, "url.txt"), "r") as f:
+            print(f"url: {f.read().strip()}")
+
+    print(f"files in {directory}:")
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if os.path.isdir(path):
+            print(f"  {name}/ ({len(os.listdir(path))} entries)")
+            continue
+        details = ""
+        if name.endswith(".json"):
+            with open(path, "r") as f:
+                content = json.load(f)
+            if isinstance(content, list):
+                details = f" - {len(content)} items"
+        print(f"  {name} ({os.path.getsize(path)} bytes){details}")
+
+
+if __name__ == "__main__":
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--data-dir", help="snapshots directory (default: data)")
+    common.add_argument("--cache-dir", help="payload cache directory (default: cache)")
+    common.add_argument(
+        "--concurrency", type=int, help="frames fetched at once by stage 4"
+    )
+    common.add_argument("--base-url", help="Wayback Machine or mock server URL")
+    common.add_argument(
+        "--quiet", action="store_true", help="no per-item progress lines"
+    )
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    for name, script, help in STAGES:
+        subparsers.add_parser(name, parents=[common], help=help)
+    run_parser = subparsers.add_parser(
+        "run", parents=[common], help="run several stages in order"
+    )
+    run_parser.add_argument("--from", dest="first", choices=STAGE_NAMES)
+    run_parser.add_argument("--to", dest="last", choices=STAGE_NAMES)
+    subparsers.add_parser("status", parents=[common], help="count what has been saved")
+    inspect_parser = subparsers.add_parser(
+        "inspect", parents=[common], help="show a saved directory or digest"
+    )
+    inspect_parser.add_argument("target", help="a directory under data/, or a digest")
+    args = parser.parse_args()
+    apply_options(args)
+
+    if args.command in STAGE_NAMES:
+        run_stage(args.command)
+    elif args.command == "run":
+        first = STAGE_NAMES.index(args.first or STAGE_NAMES[0])
+        last = STAGE_NAMES.index(args.last or STAGE_NAMES[-1])
+        for name in STAGE_NAMES[first : last + 1]:
+            run_stage(name)
+    elif args.command == "status":
+        for name, value in tree_status().items():
+            print(f"{name}: {value}")
+    elif args.command == "inspect":
+        inspect_target(args.target)
@@ -0,0 +1,339 @@
+"""Durable work queue for splitting a crawl across processes and hosts.
+
+The queue is a single SQLite file. Every unit of work (a website, a snapshot,
+a frame or a banner) is a row that a worker leases for a limited time. A
+worker that dies simply stops renewing its leases, and once they expire the
+units are handed to another worker. Units are sharded by website, so that
+`--shard 0/4` ... `--shard 3/4` split a crawl into four disjoint parts.
+
+SQLite relies on file locks, so when hosts share the queue over a network
+filesystem, that filesystem must implement POSIX locks correctly (NFSv4 does).
+"""
+
+import os, json, time, socket, sqlite3, threading, zlib
+import stages, journal
+
+QUEUE_PATH = "crawl-queue.sqlite"
+LEASE_SECONDS = 300
+MAX_ATTEMPTS = 5
+NUM_SHARDS = 64
+
+# Downstream units first, so that a snapshot is finished before the next one starts
+PRIORITY = {"website": 0, "snapshot": 1, "frame": 2, "banner": 3}
+
+
+def open_queue(queue_path: str = QUEUE_PATH) -> sqlite3.Connection:
+    """Open (and create if needed) the work queue database"""
+    conn = sqlite3.connect(queue_path, timeout=60, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("""CREATE TABLE IF NOT EXISTS tasks (
+            id INTEGER PRIMARY KEY,
+            kind TEXT NOT NULL,
+            key TEXT NOT NULL,
+            website TEXT NOT NULL,
+            shard INTEGER NOT NULL,
+            priority INTEGER NOT NULL,
+            payload TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            available_at REAL NOT NULL DEFAULT 0,
+            lease_owner TEXT,
+            lease_expires REAL,
+            last_error TEXT,
+            UNIQUE (kind, key)
+        )""")
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS tasks_claim ON tasks (status, priority, id)"
+    )
+    return conn
+
+
+def website_shard(website: str) -> int:
+    """Stable shard number of a website"""
+    return zlib.crc32(website.encode("utf-8")) % NUM_SHARDS
+
+
+def enqueue_tasks(conn: sqlite3.Connection, tasks: list[dict]) -> int:
+    """Add tasks to the queue, ignoring the ones that were already added
+    Each task is a dict with the following keys:
+    - kind: "website", "snapshot", "frame" or "banner"
+    - key: a unique key for this kind of task (e.g. the output directory)
+    - website: the website the task belongs to, used for sharding
+    - payload: the JSON-serializable argument of the stage function
+    Returns the number of newly added tasks
+    """
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        added = 0
+        for task in tasks:
+            cursor = conn.execute(
+                """INSERT OR IGNORE INTO tasks (kind, key, website, shard, priority, payload)
+                VALUES (?, ?, ?, ?, ?, ?)""",
+                (
+                    task["kind"],
+                    task["key"],
+                    task["website"],
+                    website_shard(task["website"]),
+                    PRIORITY[task["kind"]],
+                    json.dumps(task["payload"]),
+                ),
+            )
+            added += cursor.rowcount
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    return added
+
+
+def claim_task(
+    conn: sqlite3.Connection,
+    worker_id: str,
+    shard: tuple[int, int] | None = None,
+    lease_seconds: int = LEASE_SECONDS,
+) -> dict | None:
+    """Lease the next available task, including tasks whose lease has expired
+    shard is an optional (index, count) pair; only websites with shard % count == index are claimed
+    Returns the task as a dict, or None if no task is available right now
+    """
+    now = time.time()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        # Tasks that keep killing their workers are not retried forever
+        conn.execute(
+            """UPDATE tasks SET status = 'failed', last_error = 'lease expired too often'
+            WHERE status = 'leased' AND lease_expires < ? AND attempts >= ?""",
+            (now, MAX_ATTEMPTS),
+        )
+        shard_index, shard_count = shard or (0, 1)
+        row = conn.execute(
+            """SELECT * FROM tasks
+            WHERE ((status = 'pending' AND available_at <= ?)
+                OR (status = 'leased' AND lease_expires < ?))
+              AND shard % ? = ?
+            ORDER BY priority DESC, id LIMIT 1""",
+            (now, now, shard_count, shard_index),
+        ).fetchone()
+        if row is None:
+            conn.execute("COMMIT")
+            return None
+        conn.execute(
+            """UPDATE tasks SET status = 'leased', lease_owner = ?, lease_expires = ?,
+            attempts = attempts + 1 WHERE id = ?""",
+            (worker_id, now + lease_seconds, row["id"]),
+        )
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+
+    task = dict(row)
+    task["payload"] = json.loads(task["payload"])
+    task["attempts"] += 1
+    return task
+
+
+def renew_lease(
+    conn: sqlite3.Connection,
+    task: dict,
+    worker_id: str,
+    lease_seconds: int = LEASE_SECONDS,
+) -> bool:
+    """Extend the lease of a task. Return False if the lease was lost to another worker."""
+    cursor = conn.execute(
+        """UPDATE tasks SET lease_expires = ?
+        WHERE id = ? AND status = 'leased' AND lease_owner = ?""",
+        (time.time() + lease_seconds, task["id"], worker_id),
+    )
+    return cursor.rowcount == 1
+
+
+def complete_task(conn: sqlite3.Connection, task: dict, worker_id: str) -> bool:
+    """Mark a task as done. Return False if the lease was lost to another worker."""
+    cursor = conn.execute(
+        """UPDATE tasks SET status = 'done', lease_owner = NULL, lease_expires = NULL
+        WHERE id = ? AND status = 'leased' AND lease_owner = ?""",
+        (task["id"], worker_id),
+    )
+    return cursor.rowcount == 1
+
+
+def fail_task(conn: sqlite3.Connection, task: dict, worker_id: str, error: str) -> bool:
+    """Put a failed task back in the queue with exponential backoff, or give up after MAX_ATTEMPTS
+    Return False if the lease was lost to another worker, which then owns the task
+    """
+    if task["attempts"] >= MAX_ATTEMPTS:
+        cursor = conn.execute(
+            """UPDATE tasks SET status = 'failed', last_error = ?,
+            lease_owner = NULL, lease_expires = NULL
+            WHERE id = ? AND status = 'leased' AND lease_owner = ?""",
+            (error, task["id"], worker_id),
+        )
+    else:
+        backoff = min(2 ** task["attempts"] * 15, 900)
+        cursor = conn.execute(
+            """UPDATE tasks SET status = 'pending', last_error = ?, available_at = ?,
+            lease_owner = NULL, lease_expires = NULL
+            WHERE id = ? AND status = 'leased' AND lease_owner = ?""",
+            (error, time.time() + backoff, task["id"], worker_id),
+        )
+    return cursor.rowcount == 1
+
+
+def count_unfinished_tasks(
+    conn: sqlite3.Connection, shard: tuple[int, int] | None = None
+) -> int:
+    """Count the pending and leased tasks of a shard"""
+    shard_index, shard_count = shard or (0, 1)
+    return conn.execute(
+        """SELECT COUNT(*) FROM tasks
+        WHERE status IN ('pending', 'leased') AND shard % ? = ?""",
+        (shard_count, shard_index),
+    ).fetchone()[0]
+
+
+def queue_status(conn: sqlite3.Connection) -> dict:
+    """Count the tasks per kind and status
+    Returns a dict of {kind: {status: count}}
+    """
+    status = {}
+    for row in conn.execute(
+        "SELECT kind, status, COUNT(*) AS n FROM tasks GROUP BY kind, status"
+    ):
+        status.setdefault(row["kind"], {})[row["status"]] = row["n"]
+    return status
+
+
+#################
+##### TASKS #####
+#################
+
+
+def website_task(website: str) -> dict:
+    return {"kind": "website", "key": website, "website": website, "payload": website}
+
+
+def snapshot_task(entry: dict) -> dict:
+    return {
+        "kind": "snapshot",
+        "key": entry["snapshot_dir"],
+        "website": entry["website"],
+        "payload": entry,
+    }
+
+
+def frame_task(frame_tag_with_parent_info: dict) -> dict | None:
+    # Frames without src (or with about:blank and the like) have nothing to download
+    if not frame_tag_with_parent_info["frame_tag"].get("src", "").strip() or not (
+        stages.frame_url(frame_tag_with_parent_info).startswith("http")
+    ):
+        return None
+    return {
+        "kind": "frame",
+        "key": stages.frame_snapshot_dir(frame_tag_with_parent_info),
+        "website": frame_tag_with_parent_info["website"],
+        "payload": frame_tag_with_parent_info,
+    }
+
+
+def banner_task(image_tag_with_parent_info: dict) -> dict | None:
+    # Image tags without src can never become a banner
+    if "src" not in image_tag_with_parent_info["image_tag"]:
+        return None
+    return {
+        "kind": "banner",
+        "key": stages.banner_snapshot_dir(image_tag_with_parent_info),
+        "website": image_tag_with_parent_info["website"],
+        "payload": image_tag_with_parent_info,
+    }
+
+
+def run_task(task: dict) -> list[dict]:
+    """Run the stage functions of a task
+    Returns the follow-up tasks that the task discovered
+    """
+    payload = task["payload"]
+    follow_ups = []
+
+    if task["kind"] == "website":
+        for entry in stages.query_website(payload):
+            follow_ups.append(snapshot_task(entry))
+
+    elif task["kind"] == "snapshot":
+        stages.download_snapshot(payload)
+        for frame_tag_with_parent_info in stages.detect_frame_tags(payload):
+            follow_ups.append(frame_task(frame_tag_with_parent_info))
+        website_entry = {
+            "website_dir": payload["snapshot_dir"],
+            "website": payload["website"],
+            "cdx_entry": payload["cdx_entry"],
+            "type": "website",
+        }
+        for image_tag_with_parent_info in stages.detect_image_tags(website_entry):
+            follow_ups.append(banner_task(image_tag_with_parent_info))
+
+    elif task["kind"] == "frame":
+        frame_entry = stages.download_frame(payload)
+        if frame_entry:
+            for image_tag_with_parent_info in stages.detect_image_tags(frame_entry):
+                follow_ups.append(banner_task(image_tag_with_parent_info))
+            # Frames nested in this frame, down to stages.FRAME_MAX_DEPTH levels
+            depth = payload.get("depth", 1)
+            if depth < stages.FRAME_MAX_DEPTH:
+                frame_document = stages.frame_document(frame_entry)
+                for nested_frame_tag in stages.detect_frame_tags(frame_document):
+                    follow_ups.append(
+                        frame_task({**nested_frame_tag, "depth": depth + 1})
+                    )
+
+    elif task["kind"] == "banner":
+        stages.download_banner(payload)
+
+    return [follow_up for follow_up in follow_ups if follow_up]
+
+
+def work(
+    queue_path: str = QUEUE_PATH,
+    worker_id: str | None = None,
+    shard: tuple[int, int] | None = None,
+    lease_seconds: int = LEASE_SECONDS,
+    idle_exit: bool = True,
+):
+    """Drain the queue. Exit when no task is left, unless idle_exit is False."""
+    worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+    conn = open_queue(queue_path)
+    journal.recover_journal()
+
+    while True:
+        task = claim_task(conn, worker_id, shard, lease_seconds)
+        if task is None:
+            if idle_exit and count_unfinished_tasks(conn, shard) == 0:
+                print(f"[{worker_id}] Queue drained")
+                return
+            # Other workers may still add follow-up tasks, or retries may be backing off
+            time.sleep(5)
+            continue
+
+        # Keep the lease alive while the task runs
+        stop_heartbeat = threading.Event()
+
+        def heartbeat():
+            heartbeat_conn = open_queue(queue_path)
+            while not stop_heartbeat.wait(lease_seconds / 3):
+                renew_lease(heartbeat_conn, task, worker_id, lease_seconds)
+            heartbeat_conn.close()
+
+        heartbeat_thread = threading.Thread(target=heartbeat, daemon=True)
+        heartbeat_thread.start()
+        try:
+            follow_ups = run_task(task)
+            enqueue_tasks(conn, follow_ups)
+            if not complete_task(conn, task, worker_id):
+                print(f"[{worker_id}] Lost the lease of {task['kind']} {task['key']}")
+        except Exception as e:
+            print(f"[{worker_id}] Error in {task['kind']} {task['key']}: {e}")
+            fail_task(conn, task, worker_id, str(e))
+        finally:
+            stop_heartbeat.set()
+            heartbeat_thread.join()
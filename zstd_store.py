@@ -0,0 +1,183 @@
+"""Store website snapshots compressed with zstd and a dictionary trained on the corpus.
+
+With WAYBACK_STORAGE=zstd, util.save_website_snapshot writes each page once,
+as <digest>.html.zst (the original bytes) next to encoding.txt, instead of
+writing both <digest>.html and <digest>_utf8.html. The readers in util
+decompress on demand, streaming the decompressed bytes into the decoder.
+
+Portal pages share most of their markup, so a dictionary trained on a sample
+of them compresses small pages much better than zstd alone:
+
+    python zstd_store.py train            # sample the pages under data/
+    python bench/bench_compression.py     # disk space and read throughput
+
+Each dictionary is saved as WAYBACK_ZSTD_DICT_DIR/<dict id>.dict (by default
+zstd-dicts/). New pages are compressed with the latest one, and each page is
+decompressed with the dictionary whose id is in its zstd frame, so training a
+new dictionary never makes older pages unreadable.
+
+Requires the zstandard package (pip install zstandard).
+"""
+
+import os, io, glob, random, argparse, threading
+import util
+
+DICT_DIR = os.environ.get("WAYBACK_ZSTD_DICT_DIR", "zstd-dicts")
+LEVEL = int(os.environ.get("WAYBACK_ZSTD_LEVEL", "10"))
+# zstd's default dictionary size (110 KB)
+DICT_SIZE = 112640
+
+lock = threading.Lock()
+# {dict id: zstandard.ZstdCompressionDict}, loaded from DICT_DIR on first use
+dictionaries = None
+# (mtime of DICT_DIR, latest dictionary), so that compress does not list DICT_DIR each time
+latest = (None, None)
+
+
+def import_zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError(
+            "WAYBACK_STORAGE=zstd needs the zstandard package: pip install zstandard"
+        ) from None
+    return zstandard
+
+
+def load_dictionaries(reload: bool = False) -> dict:
+    """The trained dictionaries by id (loaded once per process, unless reload is set)"""
+    global dictionaries
+    if dictionaries is None or reload:
+        with lock:
+            if dictionaries is None or reload:
+                zstandard = import_zstandard()
+                loaded = {}
+                for path in glob.glob(os.path.join(DICT_DIR, "*.dict")):
+                    with open(path, "rb") as f:
+                        dictionary = zstandard.ZstdCompressionDict(f.read())
+                    loaded[dictionary.dict_id()] = dictionary
+                dictionaries = loaded
+    return dictionaries
+
+
+def get_dictionary(dict_id: int):
+    """The dictionary with this id, reloading DICT_DIR if another process trained it since"""
+    dictionary = load_dictionaries().get(dict_id)
+    if dictionary is None:
+        dictionary = load_dictionaries(reload=True).get(dict_id)
+    return dictionary
+
+
+def dict_dir_mtime() -> int | None:
+    try:
+        return os.stat(DICT_DIR).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def latest_dictionary():
+    """The most recently trained dictionary, or None if none has been trained
+    DICT_DIR is only listed again when its mtime changes, as it does when a dictionary
+    is saved to it, by this process or another
+    """
+    global latest
+    mtime = dict_dir_mtime()
+    if mtime is None:
+        return None
+    latest_mtime, dictionary = latest
+    if mtime == latest_mtime:
+        return dictionary
+    paths = glob.glob(os.path.join(DICT_DIR, "*.dict"))
+    dictionary = None
+    if paths:
+        dict_id = int(os.path.basename(max(paths, key=os.path.getmtime)).split(".")[0])
+        dictionary = get_dictionary(dict_id)
+        if dictionary is None:
+            raise ValueError(f"Unreadable zstd dictionary {dict_id} in {DICT_DIR}")
+    latest = (mtime, dictionary)
+    return dictionary
+
+
+def compress(data: bytes) -> bytes:
+    zstandard = import_zstandard()
+    dictionary = latest_dictionary()
+    compressor = zstandard.ZstdCompressor(
+        level=LEVEL, dict_data=dictionary, write_content_size=True
+    )
+    return compressor.compress(data)
+
+
+def decompressor_for(header: bytes):
+    """A decompressor with the dictionary named in the header of a zstd frame"""
+    zstandard = import_zstandard()
+    dict_id = zstandard.get_frame_parameters(header).dict_id
+    if not dict_id:
+        return zstandard.ZstdDecompressor()
+    dictionary = get_dictionary(dict_id)
+    if dictionary is None:
+        raise ValueError(f"Missing zstd dictionary {dict_id} in {DICT_DIR}")
+    return zstandard.ZstdDecompressor(dict_data=dictionary)
+
+
+def decompress(data: bytes) -> bytes:
+    return decompressor_for(data[:18]).decompress(data)
+
+
+def open_text(path: str, encoding: str) -> io.TextIOWrapper:
+    """Open a compressed file for reading as text, decompressing and decoding as it is read"""
+    f = open(path, "rb")
+    # A frame header is at most 18 bytes
+    header = f.read(18)
+    f.seek(0)
+    reader = decompressor_for(header).stream_reader(f, closefd=True)
+    return io.TextIOWrapper(
+        io.BufferedReader(reader), encoding=encoding, errors="replace"
+    )
+
+
+def sample_pages(data_dir: str, max_samples: int) -> list[bytes]:
+    """A random sample of the original HTML files saved under data_dir"""
+    paths = [
+        path
+        for path in glob.glob(os.path.join(data_dir, "**", "*.html"), recursive=True)
+        if not path.endswith("_utf8.html") and os.path.isfile(path)
+    ]
+    random.shuffle(paths)
+    samples = []
+    for path in paths[:max_samples]:
+        with open(path, "rb") as f:
+            samples.append(f.read())
+    return samples
+
+
+def train_dictionary(samples: list[bytes], dict_size: int = DICT_SIZE) -> str:
+    """Train a dictionary on sample pages and save it to DICT_DIR
+    Returns the path of the dictionary
+    """
+    global dictionaries, latest
+    zstandard = import_zstandard()
+    dictionary = zstandard.train_dictionary(dict_size, samples)
+    os.makedirs(DICT_DIR, exist_ok=True)
+    path = os.path.join(DICT_DIR, f"{dictionary.dict_id()}.dict")
+    util.atomic_write(path, dictionary.as_bytes())
+    # Reload, so that this process compresses with the new dictionary
+    dictionaries = None
+    latest = (None, None)
+    return path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    train_parser = subparsers.add_parser("train", help="train a dictionary")
+    train_parser.add_argument("--data-dir", default=util.OUTPUT_DIR)
+    train_parser.add_argument("--samples", type=int, default=2000)
+    train_parser.add_argument("--dict-size", type=int, default=DICT_SIZE)
+    args = parser.parse_args()
+
+    if args.command == "train":
+        samples = sample_pages(args.data_dir, args.samples)
+        if not samples:
+            raise SystemExit(f"No HTML files under {args.data_dir} to train on")
+        path = train_dictionary(samples, args.dict_size)
+        print(f"Trained {path} on {len(samples)} pages")